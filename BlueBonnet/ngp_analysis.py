@@ -6,19 +6,40 @@ Created on Mon Sep  6 15:37:12 2021
 """
 
 import os
+import argparse
+import hashlib
 import pandas as pd
 from matplotlib import pyplot as plt
 from matplotlib import dates as mdates
 import numpy as np
 import datetime
 
+parser = argparse.ArgumentParser(description='Analysis of NGP donation data')
+#Always read the NGP Excel export, instead of the cached copy saved by the last run
+parser.add_argument('--no_cache','--no-cache',action='store_true')
+args = parser.parse_args()
+
 os.chdir(r'..\..\data\processed\ngp_analysis')
 
 ngp_excel = r'..\..\raw\ngp\ngp_all_3.xlsx'
+ngp_cache = 'ngp_all_3_cache.pkl' #Copy of the NGP data saved by the last run, reused until the contents of the Excel file change
 
 end_date = '2021-10-01'
 
-ngp_excel_df = pd.read_excel(ngp_excel)
+def read_ngp_excel(path, cache_path, use_cache=True):
+    #Parsing the Excel export is the slowest part of the script, so the data is saved to a pickle with the hash of the Excel file and read from there on later runs
+    with open(path,'rb') as f:
+        file_hash = hashlib.sha256(f.read()).hexdigest()
+    if use_cache and os.path.exists(cache_path):
+        cached = pd.read_pickle(cache_path)
+        if cached['sha256'] == file_hash:
+            return cached['data']
+    print('NGP cache is missing or out of date, read ' + path)
+    df = pd.read_excel(path)
+    pd.to_pickle({'sha256': file_hash, 'data': df}, cache_path)
+    return df
+
+ngp_excel_df = read_ngp_excel(ngp_excel,ngp_cache,not args.no_cache)
 
 # ACCES GOOGLE SHEET
 
@@ -39,84 +39,124 @@ Karamoja only has one crop production season, and long rains WRSI is used for th
 import pandas as pd
 import math
 import numpy as np
-import arcpy
-import arcgis 
 import os
-import sys
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+import gdhi_calc
+import gdhi_io
+import gdhi_crosswalk
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
-wrsi_folder = sys.argv[1]
-year_folder = sys.argv[2]
-month_folder = sys.argv[3]
-arcpy.env.workspace = os.path.join(wrsi_folder,'GDHI_Admin_Units.gdb')
-
-fc_list = arcpy.ListFeatureClasses() #Create list of feature classes from GDB containing WRSI Data
-fc_list.remove('EA_GDHI_Admin_Units')
-
-WRSI_data = {}
-
-def get_product(product):
-    if product == 'ee':
-        full_product = 'MaizeL'
-    elif product == 'el':
-        full_product = 'GrainsL'
-    elif product == 'ek':
-        full_product = 'GrainsB'
-    elif product == 'e2':
-        full_product = 'RangeL'
-    elif product == 'e1':
-        full_product = 'RangeS'
-    elif product == 'et':
-        full_product = 'MaizeS'
-    return full_product
-
-def get_wrsi_data():
-#This function imports WRSI data from feature classes into a dictionary of pandas dfs. Key in dictionary is the WRSI Product name, value is the df containing the data.
-    print('Read WRSI Data')
-    WRSI_data = {}
-    for fc in fc_list:    
-        fc_path = os.path.join(arcpy.env.workspace,fc)
-        sdf = pd.DataFrame.spatial.from_featureclass(fc_path) #Import feature class into pandas df using fuction from ArcGIS Python API.
-        sdf.set_index('FNID',inplace=True) #Make FNID the Index
-        sdf.drop(['SHAPE'],inplace=True,axis=1) #Drop GIS/geometry column, which is included because we imported GIS data
-        for col in ['WRSI_2020','WRSI_2021','WRSI_2022','WRSI_2023','WRSI_2024','WRSI_2025']:
-            sdf[col] = sdf[col].astype(float)
-        product = fc[-2:]
-        full_product = get_product(product)
-        WRSI_data[full_product] = sdf
-    return WRSI_data
-
-WRSI_data = get_wrsi_data()
+parser = argparse.ArgumentParser(description='Calculate WRSI based crop production estimates for Somalia, Kenya, and Uganda')
+parser.add_argument('wrsi_folder')
+parser.add_argument('year_folder')
+parser.add_argument('month_folder')
+#Engine used to calculate WRSI percent ranks and Somalia / Kenya quantiles - legacy loops through each row / year, vectorized calculates all rows / years in one pass. Both give the same results.
+parser.add_argument('--engine',choices=['legacy','vectorized'],default='vectorized')
+#Admin1 units in Kenya which are part of the GDHI, crop production time series is read for each of these units.
+parser.add_argument('--ke_admin1',nargs='+',default=['Mandera','Wajir','Turkana','Marsabit'])
+#Only recalculate estimates for the current rains year and merge them into the results saved by the last run. All years are recalculated if crop production
+#data or WRSI data for earlier years has changed since the last run.
+parser.add_argument('--incremental',action='store_true')
+#Folder of WRSI tables exported to csv (ea_wrsi_ee.csv, etc.) to use instead of the feature classes in GDHI_Admin_Units.gdb, allows the script to run without ArcGIS.
+parser.add_argument('--wrsi_table')
+#Formats to export results to, results are always exported to Excel as well (i.e: --output_formats csv saves the xlsx and csv files). Parquet files can be
+#read quickly by other tools (requires pyarrow).
+parser.add_argument('--output_formats',nargs='+',choices=['xlsx','parquet','csv'],default=['xlsx'])
+#Always read the crop production Excel files, instead of the cached copy saved by the last run
+parser.add_argument('--no_cache','--no-cache',action='store_true')
+#Number of bootstrap resamples of each Somalia / Kenya production time series, used to report percentile bands around each estimate. 0 to skip.
+parser.add_argument('--bootstrap',type=int,default=0)
+parser.add_argument('--bands',type=float,nargs='+',default=[5,50,95]) #Percentiles of the bootstrap estimates to report
+parser.add_argument('--bootstrap_workers',type=int,default=os.cpu_count())
+parser.add_argument('--seed',type=int,default=0)
 
 #Excel Files to import containg crop production data 
 so_crop_prod = r'.\Crop Production Data\SO_agprod_data.xlsx'
 ke_crop_prod = r'.\Crop Production Data\KE_agprod_data.xlsx'
-
-fnids = WRSI_data['MaizeL'].iloc[:,:7] #Get just FNIDs in a seperate Datafarame
-
-
-def wrsi_rank(): 
+#Columns read from the Excel files
+so_crop_cols = ['fnid','admin_1','admin_2','period_date','season_name','season_year','value','product','crop_production_system','status']
+ke_crop_cols = ['fnid','admin_1','admin_2','period_date','season_name','season_year','value','product','status']
+
+result_names = ['KEUGSO_long_results','KEUGSO_short_results']
+bootstrap_name = 'KESO_bootstrap_bands'
+
+baseline_cols = ['WRSI_' + str(year) for year in range(2001,2016)] #WRSI columns for the static 2001 - 2015 period of comparison
+
+#Fallback logic for Somalia, crops used to fill in missing estimates for each crop in priority order. Crops are filled in this order.
+so_crops = ['Maize','Sorghum','Cowpeas']
+so_fallbacks = {'Cowpeas':['Sorghum','Maize'],'Sorghum':['Maize'],'Maize':['Sorghum']}
+
+def get_fnids(WRSI_data):
+    return WRSI_data['MaizeL'].iloc[:,:7] #Get just FNIDs in a seperate Datafarame
+
+def get_crop_inputs():
+    return gdhi_io.file_fingerprint([so_crop_prod,ke_crop_prod,gdhi_crosswalk.crosswalk_file])
+
+def get_inputs(args, WRSI_data):
+    #Crop production files and WRSI data for earlier years the results are calculated from, saved with the results
+    return {'crop': get_crop_inputs(), 'wrsi': gdhi_io.get_wrsi_inputs(WRSI_data,gdhi_calc.get_rains_year(args.year_folder,args.month_folder))}
+
+def get_previous_results(args, inputs):
+    #In incremental mode load results from the last run, if results for both seasons are available only the current rains year needs to be calculated.
+    if not args.incremental:
+        return {}
+    previous_results = {name: gdhi_io.load_previous_results(os.path.abspath(args.wrsi_folder),name,inputs) for name in result_names}
+    if any(results is None for results in previous_results.values()):
+        return {}
+    return previous_results
+
+def get_est_years(args, wrsi_years, previous_results):
+    #Years to calculate crop production estimates for, all years with WRSI data unless results from the last run are being updated
+    if previous_results:
+        rains_year = gdhi_calc.get_rains_year(args.year_folder,args.month_folder)
+        print('Incremental mode - calculate crop production estimates for ' + str(rains_year))
+        return [year for year in wrsi_years if year == rains_year] #Only current rains year can change between runs
+    return wrsi_years
+
+def wrsi_rank_legacy(WRSI_data): 
 #This function calcuates precentile rank for all five WRSI product for all areas that are part of analysis in KE/SO and writes results to a dictinary of dfs. 
     df_WRSI_percentile = {}
+    fnids = get_fnids(WRSI_data)
+    post2015_cols = ['WRSI_' + str(year) for year in gdhi_io.get_wrsi_years(WRSI_data) if year > 2015]
     for key, value in WRSI_data.items():
         print("Calculate wrsi percentiles for " + key)
         df_WRSI=WRSI_data[key]
         df_WRSI_KE_SO = df_WRSI[df_WRSI["ADMIN0"].isin(['Kenya','Somalia'])]
         #Percent ranking based on 2001 - 2015 data, decided to keep WRSI period of comparison static so tht historical estimates do not change between runs of the GDHI.
-        df_new=df_WRSI_KE_SO.iloc[:,7:22].rank(axis=1, method='average', numeric_only=True, na_option='keep', ascending=True, pct=True)
-        post2015_col = list(range(22,32))
-        pre2015_col = list(range(7,22))
-        for col in post2015_col: #Compute percent rank for all years after 2015, years after 2015 use data for 2002 - 2015 plus the current year
-            year_col = df_WRSI_KE_SO.columns[col]
-            rank_col_list = pre2015_col + [col]
-            df_new[year_col] = (df_WRSI_KE_SO.iloc[:,rank_col_list] \
+        df_new=df_WRSI_KE_SO.loc[:,baseline_cols].rank(axis=1, method='average', numeric_only=True, na_option='keep', ascending=True, pct=True)
+        for year_col in post2015_cols: #Compute percent rank for all years after 2015, years after 2015 use data for 2002 - 2015 plus the current year
+            rank_col_list = baseline_cols + [year_col]
+            df_new[year_col] = (df_WRSI_KE_SO.loc[:,rank_col_list] \
             .rank(axis=1, method='average', numeric_only=True, na_option='keep', ascending=True, pct=True)).loc[:,year_col]
         df_new=fnids.merge(df_new,left_index=True,right_index=True)
         df_WRSI_percentile[key] = df_new #Key in dictionary is the name of WRSI product - value is the df containing the percentiles.
     return df_WRSI_percentile
 
-df_WRSI_percentile = wrsi_rank()
+def wrsi_rank_vectorized(WRSI_data, est_years):
+#Same results as wrsi_rank_legacy. The 2001 - 2015 baseline is sorted once per product into a rank index, and the percent rank for every year after 2015
+#is looked up against the index instead of re-ranking the baseline plus the year column for each year. Only the years being estimated are ranked.
+    df_WRSI_percentile = {}
+    fnids = get_fnids(WRSI_data)
+    rank_cols = ['WRSI_' + str(year) for year in est_years]
+    for key, value in WRSI_data.items():
+        print("Calculate wrsi percentiles for " + key)
+        df_WRSI_KE_SO = value[value["ADMIN0"].isin(['Kenya','Somalia'])]
+        index = gdhi_calc.rank_index(df_WRSI_KE_SO[baseline_cols].to_numpy(dtype=float))
+        baseline_pct = pd.DataFrame(index.baseline_rank(),index=df_WRSI_KE_SO.index,columns=baseline_cols)
+        new_cols = [col for col in rank_cols if col not in baseline_cols]
+        post2015_pct = pd.DataFrame(index.percent_rank(df_WRSI_KE_SO[new_cols].to_numpy(dtype=float)),index=df_WRSI_KE_SO.index,columns=new_cols)
+        df_new = pd.concat([baseline_pct,post2015_pct],axis=1)[rank_cols]
+        df_new=fnids.merge(df_new,left_index=True,right_index=True)
+        df_WRSI_percentile[key] = df_new #Key in dictionary is the name of WRSI product - value is the df containing the percentiles.
+    return df_WRSI_percentile
+
+def wrsi_rank(WRSI_data, est_years, engine):
+    if engine == 'legacy':
+        return wrsi_rank_legacy(WRSI_data)
+    return wrsi_rank_vectorized(WRSI_data, est_years)
 
 def set_so_rains(admin1):
 #Function to set name for 2nd rainy season in Somalia, in three admin units in Northern SO rains are Gu/Karen instead of Gu/Deyr. These three admin units use different WRSI products.
@@ -129,13 +169,13 @@ def set_so_rains(admin1):
 class so_crop_data(): 
     def read_so_data():
         print("Read SO Crop Data")
-        so_crop_raw = pd.read_excel(so_crop_prod,sheet_name ='SO_prod_FDW')
+        so_crop_raw = gdhi_io.read_excel_cached(so_crop_prod,sheet_name='SO_prod_FDW',usecols=so_crop_cols)
         return so_crop_raw
     
     def clean_so_data():
         so_crop = so_crop_data.read_so_data()
         print("Clean SO Crop Data")
-        so_crop = so_crop[['fnid','admin_1','admin_2','period_date','season_name','season_year','value','product','crop_production_system','status']] #Select relevant columns
+        so_crop = so_crop[so_crop_cols] #Select relevant columns
         so_crop = so_crop[so_crop['status'] != 'Not Collected'] #Filter out data which is null / Not Collected.
         so_crop = so_crop[so_crop['product'].isin(['Maize (Corn)','Sorghum','Cowpeas (Mixed)'])] #filter to only the relevant three crops
         so_crop['year'] = so_crop['season_year'].str[-4:].astype(int) #Create a year field
@@ -143,54 +183,36 @@ class so_crop_data():
         so_crop['season_name'] = so_crop['season_name'].replace(to_replace='Gu off-season', value='Gu') #Replace Gu Off-Season with Gu
         so_crop['product'] = so_crop['product'].replace(to_replace='Maize (Corn)',value='Maize') #Simplify crop name
         so_crop['product'] = so_crop['product'].replace(to_replace='Cowpeas (Mixed)',value='Cowpeas') #Simplify crop name
-        so_crop.loc[so_crop['admin_2'] == 'Afmadow', 'fnid'] = 'SO1990A22802' #Update FNIDs for Afmadow - Crop Production data has a different FNIDs for Afmadow - unsure why this is the case.
+        so_crop = gdhi_crosswalk.set_fnid(so_crop,'SO') #Update FNIDs for Afmadow - Crop Production data has a different FNIDs for Afmadow - unsure why this is the case.
         return so_crop
 
-so_crop_v1 = so_crop_data.clean_so_data()
-
 #Continue to process and reformat crop production data form FDW
 class pivot_clean_so_crop():    
     def so_pivot(df): #Aggregate SO Crop Production Data at admin2 level combine off-season data with regular season data
-        so_pivot = df.pivot_table(index=['fnid','admin_1','admin_2','season_name','product'],columns='year',values='value',aggfunc='sum')
+        so_pivot = df.fillna({'admin_2':''}).pivot_table(index=['fnid','admin_1','admin_2','season_name','product'],columns='year',values='value',aggfunc='sum') #Admin1 level data has no admin_2, kept until crosswalk is applied
         so_pivot.reset_index(inplace=True)
-        so_pivot['rains'] = so_pivot['admin_1'].apply(set_so_rains) #Figure out name of 2nd rainy season for each admin unit using function
         return so_pivot
     
-    def adwal_case(): #Handle data for Adwal which reports at the Admin 1 level, set crop production for Admin2 units with production in Adwal equal to Admin 1 values for all crops / seasons and merge data
+    def crosswalk_case(so_crop_v1):
+        #Handle units in crosswalk table which use crop production data from another unit. Adwal reports at the Admin 1 level, set crop production for Admin2 units with production
+        #in Adwal (Borama, Baki) equal to Admin 1 values. Cell waq does not have crop production data, set equal to Beled Xaawo which is a neighboring district.
         so_crop_aggregate = pivot_clean_so_crop.so_pivot(so_crop_v1)
-        df_so_list = []
-        print("Handle Adwal Speacial Case")
-        df_so_list.append(so_crop_aggregate)
-        Awdal_admin2 = {'Borama':'SO1990A21101', 'Baki':'SO1990A21102'} 
-        for key, value in Awdal_admin2.items(): #Create two identical dataframes containing data for Adwal - difference between them is that a different admin2 unit name & FNID is specified in each
-            so_adwal = so_crop_v1[so_crop_v1['admin_1'] == 'Awdal'] 
-            so_adwal = so_adwal.assign(admin_2=key) #Set values in Admin2 column equal to key
-            so_adwal = so_adwal.assign(fnid=value) #Set values in FNID column equal to FNID for admin unit
-            so_adwal_pivot = pivot_clean_so_crop.so_pivot(so_adwal)
-            df_so_list.append(so_adwal_pivot) #Append to list
-        so_crop_rev = pd.concat(df_so_list,ignore_index=True) #Merge together data for Adwal, with data for all other regions
+        print("Handle Adwal and Cell Waq Special Cases")
+        year_cols = [col for col in so_crop_aggregate.columns.tolist() if type(col) is int]
+        so_crop_rev = gdhi_crosswalk.copy_units(so_crop_aggregate,'SO',['admin_1','season_name','product'],year_cols)
+        so_crop_rev = so_crop_rev[so_crop_rev['admin_2'] != ''] #Drop Admin1 level data, only needed for units in crosswalk
+        so_crop_rev['rains'] = so_crop_rev['admin_1'].apply(set_so_rains) #Figure out name of 2nd rainy season for each admin unit using function
         return so_crop_rev
     
-    def cell_waq_case(): 
-        #Function to handle data for Cell waq which does not have crop production data, set equal to Beled Xaawo which is a neighboring district.
-        so_crop_rev = pivot_clean_so_crop.adwal_case()
-        print("Handle Cell Waq Special Case")
-        so_crop_rev_beled_xaawo = so_crop_rev[so_crop_rev['fnid'] == 'SO1990A22603']
-        so_crop_rev_cell_waq = so_crop_rev_beled_xaawo.assign(admin_2='Ceel Waaq',fnid='SO1990A22604')
-        so_crop_rev = pd.concat([so_crop_rev,so_crop_rev_cell_waq],ignore_index=True)
-        return so_crop_rev
-    
-    def filter_data():
+    def filter_data(so_crop_v1):
         # Function tofilter out production time series with less than 5 data points - can not use time series in qunatile function unless it has at least 5 data points.
-        so_crop_rev = pivot_clean_so_crop.cell_waq_case()
+        so_crop_rev = pivot_clean_so_crop.crosswalk_case(so_crop_v1)
         print("Filter out instances where there is not enough crop production data for quantile calcuations")
         so_crop_rev['count'] = so_crop_rev.count(axis=1,numeric_only=True) #Count the number of data points per season, geographic unit, crop combination
         so_crop_rev = so_crop_rev[so_crop_rev['count'] >= 5]
         so_crop_rev.drop(labels='count',axis=1,inplace=True) 
         return so_crop_rev
 
-so_crop_final = pivot_clean_so_crop.filter_data() #Clean so crop data using chain of functions above
-
 def set_so_wrsi_product(season,crop,second_rains):
     #Function to set WRSI Product to use for each row of crop production data
     if season == 'Gu' and crop == 'Maize' and second_rains == 'Deyr':
@@ -212,13 +234,11 @@ def calc_quantile(quant,row):
         return row.quantile(quant)
 
 #Calculate crop production for Somalia estimate based on percent ranking from WRSI data for each FNID, Crop, Season, and year combination for Somalia
-col_list=[]
-def calc_so_wrsi_prod_est():
+def calc_so_wrsi_prod_est_legacy(so_crop_final, df_WRSI_percentile, est_years):
     numeric_col = [col for col in so_crop_final.columns.tolist() if type(col) is int] #Select just columns containing crop production data (column names are intigers (i.e: Year))
-    for year in range(2001,2026): 
+    for year in est_years: 
         print ("Calcuate Crop Production Estimates for Somalia for " + str(year))
         new_col = "p" + str(year)
-        col_list.append(new_col)
         for index, row in so_crop_final.iterrows(): #Loop through all rows for a specific year and calculate crop production estimate for each area
             fnid = row['fnid']
             wrsi_product = set_so_wrsi_product(row['season_name'],row['product'],row['rains']) #Select WRSI product to use for row
@@ -231,8 +251,34 @@ def calc_so_wrsi_prod_est():
             so_crop_final.loc[index, new_col] = v #write crop production estimate to datafarame
     return so_crop_final
 
-def transform_so_data(): #Transform WRSI production estimate data into format needed for GDHI and create seperate dfs for Gu and Deyr, implement fall back logic to fill NAs
+def get_so_quants(so_crop_final, df_WRSI_percentile, est_years):
+    #Production time series (rows x years of production data) and WRSI percent ranks (rows x years to estimate) for each row of Somalia crop production data
+    numeric_col = [col for col in so_crop_final.columns.tolist() if type(col) is int] #Select just columns containing crop production data (column names are intigers (i.e: Year))
+    wrsi_cols = ['WRSI_' + str(year) for year in est_years]
+    products = np.array([set_so_wrsi_product(season,crop,rains) for season, crop, rains in \
+                         zip(so_crop_final['season_name'],so_crop_final['product'],so_crop_final['rains'])]) #Select WRSI product to use for each row
+    quants = np.full((len(so_crop_final),len(wrsi_cols)),np.nan)
+    for product in np.unique(products):
+        rows = products == product
+        wrsi_pct_df = df_WRSI_percentile[product] #Select appropriate df with percentiles based on product
+        quants[rows] = wrsi_pct_df.loc[so_crop_final.loc[rows,'fnid'],wrsi_cols].to_numpy(dtype=float) #Get percent rank for every year for all rows using this product
+    return so_crop_final[numeric_col].to_numpy(dtype=float), quants
+
+def calc_so_wrsi_prod_est_vectorized(so_crop_final, df_WRSI_percentile, est_years):
+    #Same calculation as calc_so_wrsi_prod_est_legacy, but gathers the WRSI percent ranks for all rows and years into one matrix and calculates all estimates in one pass.
+    print ("Calcuate Crop Production Estimates for Somalia for " + ', '.join(str(year) for year in est_years))
+    estimates = gdhi_calc.quantile_map(*get_so_quants(so_crop_final,df_WRSI_percentile,est_years))
+    estimates = pd.DataFrame(estimates,index=so_crop_final.index,columns=['p' + str(year) for year in est_years])
+    return pd.concat([so_crop_final,estimates],axis=1)
+
+def calc_so_wrsi_prod_est(so_crop_final, df_WRSI_percentile, est_years, engine):
+    if engine == 'legacy':
+        return calc_so_wrsi_prod_est_legacy(so_crop_final, df_WRSI_percentile, est_years)
+    return calc_so_wrsi_prod_est_vectorized(so_crop_final, df_WRSI_percentile, est_years)
+
+def transform_so_data(so_wrsi_crop_est, fnids, est_years): #Transform WRSI production estimate data into format needed for GDHI and create seperate dfs for Gu and Deyr, implement fall back logic to fill NAs
     print('Transform SO Results into appropriate format')
+    col_list = ['p' + str(year) for year in est_years]
     seasons= ['Gu','Deyr']
     so_fnids = fnids[fnids['COUNTRY'] == 'SO']
     so_results = {}
@@ -244,20 +290,18 @@ def transform_so_data(): #Transform WRSI production estimate data into format ne
         so_crop_pivot = so_fnids.merge(so_crop_pivot,left_index=True,right_index=True,how='left') #Merge to full FNIDS so that output table includes all Admin2 FNIDs, even areas without crop production.
         #Implement fall back logic to fill in as many N/As as possible
         print('Implement fallback logic for SO' + season + 'results')
-        for col in col_list:
-            maize_col = col + '_Maize'
-            sorghum_col = col + '_Sorghum'
-            cowpeas_col = col + '_Cowpeas'
-            so_crop_pivot[cowpeas_col].fillna(so_crop_pivot[sorghum_col], inplace=True)
-            so_crop_pivot[cowpeas_col].fillna(so_crop_pivot[maize_col], inplace=True)
-            so_crop_pivot[sorghum_col].fillna(so_crop_pivot[maize_col], inplace=True)
-            so_crop_pivot[maize_col].fillna(so_crop_pivot[sorghum_col], inplace=True)
-            #Save results to a dictionary with season name as key
-        so_results[season] = so_crop_pivot
+        crop_cols = [col + '_' + crop for col in col_list for crop in so_crops]
+        values = so_crop_pivot[crop_cols].to_numpy(dtype=float).reshape(len(so_crop_pivot),len(col_list),len(so_crops)) #units x years x crops
+        so_crop_pivot[crop_cols] = gdhi_calc.crop_fallback(values,so_crops,so_fallbacks).reshape(len(so_crop_pivot),-1)
+        so_results[season] = so_crop_pivot #Save results to a dictionary with season name as key
     return so_results
 
-so_wrsi_crop_est = calc_so_wrsi_prod_est()
-so_results = transform_so_data()
+def estimate_so(WRSI_data, df_WRSI_percentile, est_years, engine):
+    #Calculate crop production estimates for Somalia, returns a dictionary with the Gu and Deyr results
+    so_crop_v1 = so_crop_data.clean_so_data()
+    so_crop_final = pivot_clean_so_crop.filter_data(so_crop_v1) #Clean so crop data using chain of functions above
+    so_wrsi_crop_est = calc_so_wrsi_prod_est(so_crop_final, df_WRSI_percentile, est_years, engine)
+    return transform_so_data(so_wrsi_crop_est, get_fnids(WRSI_data), est_years)
 
 #Export SO data to a csv - can activitate if you want to just results for SOmalia instead of all results
 #so_results['Gu'].to_csv('SO_crop_rev_gu_fallback.csv')
@@ -268,30 +312,30 @@ class ke_crop_data():
     #Chain of functions to read and clean KE Crop production data from FDW    
     def read_ke_data(): #Read KE Crop Production data into df
         print('Read KE Crop Data')
-        ke_crop_raw = pd.read_excel(ke_crop_prod,sheet_name ='KE_prod_FDW')
+        ke_crop_raw = gdhi_io.read_excel_cached(ke_crop_prod,sheet_name='KE_prod_FDW',usecols=ke_crop_cols)
         return ke_crop_raw
     
-    def clean_ke_data(): #Clean / pivot KE Crop Data
+    def clean_ke_data(admin1_units): #Clean / pivot KE Crop Data
         print('Clean KE Crop Data')
         ke_crop = ke_crop_data.read_ke_data()
-        ke_crop = ke_crop[['fnid','admin_1','admin_2','period_date','season_name','season_year','value','product','status']] #Select relevant columns
+        ke_crop = ke_crop[ke_crop_cols] #Select relevant columns
         ke_crop = ke_crop[ke_crop['status'] != 'Not Collected'] #Filter out not collected data
         ke_crop = ke_crop[ke_crop['product'].isin(['Maize Grain (White)'])] #filter to only the relevant crop
         ke_crop['year'] = ke_crop['season_year'].str[-4:].astype(int) #Create a year field
         ke_crop['product'] = ke_crop['product'].replace(to_replace='Maize (Corn)',value='1_Maize') #Simplify name
         ke_crop.loc[ke_crop['year'] < 2015, 'admin_1'] = ke_crop['admin_2'] #Move Admin2 units to Admin 1 column to account for old admin unit structure present before 2015
-        ke_crop = ke_crop[ke_crop['admin_1'].isin(['Mandera','Wajir','Turkana','Marsabit'])] #Filter to just include admin 1 units in GDHI
+        ke_crop = ke_crop[ke_crop['admin_1'].isin(admin1_units)] #Filter to just include admin 1 units in GDHI
         ke_crop = ke_crop.pivot_table(index='admin_1',columns='year',values='value',aggfunc='sum') #Pivot data (data for each year in seperate columns) and aggregate data
         return ke_crop
 
-def calc_ke_wrsi_prod_est(): 
+def calc_ke_wrsi_prod_est_legacy(ke_crop, df_WRSI_percentile, est_years): 
     #Function to calcuation WRSI based crop production estimates for Long and Short rains in Kenya based on percent ranking for each FNID, for each year
     ke_results = {}
     for season in ['L','S']: #L stands for L, S standard for short
         wrsi_product = 'Range' + season
         ke_pct = df_WRSI_percentile[wrsi_product] #Get percent rank for select product
         ke_pct = ke_pct[ke_pct['ADMIN0'] == 'Kenya'] #Filter WRSI percent ranks to just included data for Kenya
-        for year in range(2001,2026):
+        for year in est_years:
             print('Calculate crop production estimates for Kenya for ' + str(year) + ' ' + season + ' Rains' )
             maize_col = ('p' + str(year) + '_Maize')
             ke_pct.loc[:,maize_col] = np.nan
@@ -299,7 +343,7 @@ def calc_ke_wrsi_prod_est():
             for index, row in ke_pct.iterrows(): #Loop through all rows for a specific year and calculate crop production estimate for each area
                 admin1 = row['ADMIN1']
                 quant = row[col_name]
-                time_series = ke_crop_data.loc[admin1]
+                time_series = ke_crop.loc[admin1]
                 v = calc_quantile(quant,time_series)
                 ke_pct.loc[index,maize_col] = v
             sorghum_col = ('p' + str(year) + '_Sorghum') #Set Sorghum estimates equal to Maize, both crops use same WRSI and crop production time series in Kenya so values will be equal.
@@ -307,11 +351,96 @@ def calc_ke_wrsi_prod_est():
             ke_pct.loc[:,sorghum_col] = ke_pct.loc[:,maize_col] #Set Sorghum estimates equal to Maize, both crops use same WRSI and crop production time series in Kenya so values will be equal.
             ke_pct.loc[:,cowpea_col] = -99 #Set Cowpeas equal to -99 - no Cowpeas production in KE
             ke_pct.drop(col_name,axis=1,inplace=True) #Drop year column with origional WRSI value, not needed in final output.
-        ke_results[season] = ke_pct
+        ke_results[season] = ke_pct.drop([col for col in ke_pct.columns if col.startswith('WRSI_')],axis=1) #Drop WRSI for years not being calculated in incremental mode
     return ke_results
- 
-ke_crop_data = ke_crop_data.clean_ke_data()      
-ke_WRSI_crop_est = calc_ke_wrsi_prod_est()
+
+def get_ke_quants(ke_crop, df_WRSI_percentile, est_years, admin1_units):
+    #WRSI percent ranks for Kenya FNIDs for each season, and the production time series (rows x years of production data) and percent ranks (rows x years to
+    #estimate) for the rows of both seasons stacked on top of each other (Long rains rows first)
+    wrsi_cols = ['WRSI_' + str(year) for year in est_years]
+    ke_pct = {}
+    for season in ['L','S']: #L stands for L, S standard for short
+        wrsi_product = 'Range' + season
+        ke_pct[season] = df_WRSI_percentile[wrsi_product][df_WRSI_percentile[wrsi_product]['ADMIN0'] == 'Kenya'] #Filter WRSI percent ranks to just included data for Kenya
+        ke_pct[season] = ke_pct[season][ke_pct[season]['ADMIN1'].isin(admin1_units)]
+    ke_rows = pd.concat([ke_pct['L'],ke_pct['S']]) #Rows for both seasons stacked on top of each other
+    time_series = ke_crop.reindex(ke_rows['ADMIN1']).to_numpy(dtype=float) #Annual maize production time series for the ADMIN1 unit of each row, same series used for both seasons
+    return ke_pct, time_series, ke_rows[wrsi_cols].to_numpy(dtype=float)
+
+def calc_ke_wrsi_prod_est_vectorized(ke_crop, df_WRSI_percentile, est_years, admin1_units):
+    #Same results as calc_ke_wrsi_prod_est_legacy. Each Kenya FNID is mapped to the annual maize time series for its ADMIN1 once, estimates for all years
+    #and both seasons are calculated in one call to quantile_map, and the output columns are built in a single concat.
+    print('Calculate crop production estimates for Kenya for ' + ', '.join(str(year) for year in est_years) + ' Long and Short Rains')
+    wrsi_cols = ['WRSI_' + str(year) for year in est_years]
+    ke_pct, time_series, quants = get_ke_quants(ke_crop,df_WRSI_percentile,est_years,admin1_units)
+    estimates = gdhi_calc.quantile_map(time_series,quants)
+    ke_results = {}
+    start = 0
+    for season in ['L','S']:
+        season_est = estimates[start:start + len(ke_pct[season])]
+        start = start + len(ke_pct[season])
+        est_cols = {}
+        for i, year in enumerate(est_years):
+            est_cols['p' + str(year) + '_Maize'] = season_est[:,i]
+            est_cols['p' + str(year) + '_Sorghum'] = season_est[:,i] #Set Sorghum estimates equal to Maize, both crops use same WRSI and crop production time series in Kenya so values will be equal.
+            est_cols['p' + str(year) + '_Cowpeas'] = np.full(len(season_est),-99) #Set Cowpeas equal to -99 - no Cowpeas production in KE
+        est_df = pd.DataFrame(est_cols,index=ke_pct[season].index)
+        ke_results[season] = pd.concat([ke_pct[season].drop(wrsi_cols,axis=1),est_df],axis=1)
+    return ke_results
+
+def calc_ke_wrsi_prod_est(ke_crop, df_WRSI_percentile, est_years, engine, admin1_units):
+    start = time.perf_counter()
+    if engine == 'legacy':
+        ke_results = calc_ke_wrsi_prod_est_legacy(ke_crop, df_WRSI_percentile, est_years)
+    else:
+        ke_results = calc_ke_wrsi_prod_est_vectorized(ke_crop, df_WRSI_percentile, est_years, admin1_units)
+    print('Kenya crop production estimates calculated in ' + str(round(time.perf_counter() - start,3)) + ' seconds (' + engine + ' engine)')
+    return ke_results
+
+def estimate_ke(df_WRSI_percentile, est_years, engine, admin1_units):
+    #Calculate crop production estimates for Kenya, returns a dictionary with the Long (L) and Short (S) rains results
+    ke_crop = ke_crop_data.clean_ke_data(admin1_units)
+    return calc_ke_wrsi_prod_est(ke_crop, df_WRSI_percentile, est_years, engine, admin1_units)
+
+#Bootstrap uncertainty bands for Somalia and Kenya. Production time series can have as few as 5 data points, so each series is resampled with replacement and
+#the estimate is recalculated for every resample to show how much the estimate depends on the years with production data.
+def calc_bootstrap_bands(series, quants, args):
+    #Rows are split into batches so the resamples for a batch fit in memory, batches are calculated in a process pool. Each batch gets its own random
+    #seed from args.seed, and batch size does not depend on the number of workers, so results are the same for any number of workers.
+    if len(series) == 0:
+        return np.empty((0,quants.shape[1],len(args.bands)))
+    batch_rows = max(1,4000000 // (args.bootstrap * series.shape[1]))
+    starts = range(0,len(series),batch_rows)
+    seeds = np.random.SeedSequence(args.seed).spawn(len(starts))
+    batches = [(series[start:start + batch_rows],quants[start:start + batch_rows],args.bootstrap,args.bands,seed) for start, seed in zip(starts,seeds)]
+    with ProcessPoolExecutor(max_workers=args.bootstrap_workers) as executor:
+        bands = list(executor.map(gdhi_calc.bootstrap_bands,*zip(*batches)))
+    return np.concatenate(bands)
+
+def bands_table(keys, series, quants, bands, est_years, band_names):
+    #Long table with one row per unit, crop, season and year, with the point estimate and the bootstrap percentiles
+    estimates = gdhi_calc.quantile_map(series,quants)
+    tables = []
+    for i, year in enumerate(est_years):
+        table = keys.assign(year=year,estimate=estimates[:,i])
+        tables.append(table.assign(**{name: bands[:,i,j] for j, name in enumerate(band_names)}))
+    return pd.concat(tables,ignore_index=True)
+
+def estimate_bootstrap(df_WRSI_percentile, est_years, args):
+    #Bootstrap percentile bands for every Somalia and Kenya production time series, before fallback logic is applied. Kenya Sorghum is not included
+    #as it is equal to Maize.
+    start = time.perf_counter()
+    print('Calculate bootstrap percentile bands with ' + str(args.bootstrap) + ' resamples')
+    band_names = ['pct' + format(band,'g') for band in args.bands]
+    so_crop_final = pivot_clean_so_crop.filter_data(so_crop_data.clean_so_data())
+    so_series, so_quants = get_so_quants(so_crop_final,df_WRSI_percentile,est_years)
+    so_keys = pd.DataFrame({'fnid':so_crop_final['fnid'].to_numpy(),'country':'SO','season':so_crop_final['season_name'].to_numpy(),'crop':so_crop_final['product'].to_numpy()})
+    ke_pct, ke_series, ke_quants = get_ke_quants(ke_crop_data.clean_ke_data(args.ke_admin1),df_WRSI_percentile,est_years,args.ke_admin1)
+    ke_keys = pd.concat([pd.DataFrame({'fnid':ke_pct[season].index,'country':'KE','season':season,'crop':'Maize'}) for season in ['L','S']],ignore_index=True)
+    tables = [bands_table(so_keys,so_series,so_quants,calc_bootstrap_bands(so_series,so_quants,args),est_years,band_names),
+              bands_table(ke_keys,ke_series,ke_quants,calc_bootstrap_bands(ke_series,ke_quants,args),est_years,band_names)]
+    print('Bootstrap percentile bands calculated in ' + str(round(time.perf_counter() - start,3)) + ' seconds')
+    return pd.concat(tables,ignore_index=True).set_index('fnid')
 
 #You can turn on these functions if you want to view just the results for Kenya
 #ke_WRSI_crop_est['long'].to_csv('KE_crop_rev_long.csv')
@@ -327,69 +456,79 @@ def get_crop(product):
 
 class ug_process_wrsi():
     #This fucntion gets the long rains WRSI data for Maize and Grains for Karamoja, returns a list with two dfs, one more for Maize and one for Sorghum
-    def process():
+    def process(WRSI_data, est_years):
         print ('Proces UG WRSI Data')
         ug_wrsi_all= []
         for product in ['MaizeL','GrainsL']:
             crop = get_crop(product)
             wrsi = WRSI_data[product]
             ug_wrsi = wrsi[wrsi['COUNTRY'] == 'UG']
-            for year in range(2001,2026):
+            for year in est_years:
                 col = 'p' + str(year) + '_' + crop
                 wrsi_col = 'WRSI_' + str(year)
                 ug_wrsi.loc[:,col] = ug_wrsi.loc[:,wrsi_col]
                 ug_wrsi.drop(wrsi_col,axis=1,inplace=True)
+            ug_wrsi = ug_wrsi.drop([col for col in ug_wrsi.columns if col.startswith('WRSI_')],axis=1) #Drop WRSI for years not being calculated in incremental mode
             ug_wrsi_all.append(ug_wrsi)
         return ug_wrsi_all
                 
-    def merge():
+    def merge(WRSI_data, est_years):
         #This fucntion merges together the long and Maize grains WRSI data into one df.
-        ug_wrsi_list = ug_process_wrsi.process()
+        ug_wrsi_list = ug_process_wrsi.process(WRSI_data, est_years)
         cols_to_use = ug_wrsi_list[0].columns.difference(ug_wrsi_list[1].columns) #This is so that output does not include columns present in both dfs
         ug_wrsi_final = ug_wrsi_list[1].merge(ug_wrsi_list[0][cols_to_use],left_index=True,right_index=True)
         return ug_wrsi_final
 
-ug_wrsi_results = ug_process_wrsi.merge()
-ug_fnids = fnids[fnids['COUNTRY'] == 'UG']
+def estimate_ug(WRSI_data, est_years):
+    #Uganda results are the raw WRSI values, returns the Long rains results. No short rains in Karamoja.
+    return ug_process_wrsi.merge(WRSI_data, est_years)
 
 #Merge results together for all three countries
-def concat_ke_so_ug_data():
-    os.chdir(os.path.join(wrsi_folder,year_folder,month_folder))
-    print('Merge results and export to Excel')
-    long_results = pd.concat([ke_WRSI_crop_est['L'],so_results['Gu'],ug_wrsi_results]) #Concatenate, results for Uganda, Somalia, and Kenya for Gu/Long Season
-    #Calculate averages - averages are only through 2020 so that that they do not change over time
-    long_results['Maize_av'] = long_results[['p2001_Maize','p2002_Maize','p2003_Maize','p2004_Maize','p2005_Maize','p2006_Maize','p2007_Maize','p2008_Maize','p2009_Maize','p2010_Maize','p2011_Maize', \
-                                             'p2012_Maize','p2013_Maize','p2014_Maize','p2015_Maize','p2016_Maize','p2017_Maize','p2018_Maize','p2019_Maize','p2020_Maize']].mean(axis=1)
-    long_results['Sorghum_av'] = long_results[['p2001_Sorghum','p2002_Sorghum','p2003_Sorghum','p2004_Sorghum','p2005_Sorghum','p2006_Sorghum','p2007_Sorghum','p2008_Sorghum','p2009_Sorghum','p2010_Sorghum', \
-                                               'p2011_Sorghum','p2012_Sorghum', 'p2013_Sorghum','p2014_Sorghum','p2015_Sorghum','p2016_Sorghum','p2017_Sorghum','p2018_Sorghum','p2019_Sorghum','p2020_Sorghum']].mean(axis=1)
-    long_results['Cowpeas_av'] = long_results[['p2001_Cowpeas','p2002_Cowpeas','p2003_Cowpeas','p2004_Cowpeas','p2005_Cowpeas','p2006_Cowpeas','p2007_Cowpeas','p2008_Cowpeas','p2009_Cowpeas','p2010_Cowpeas',\
-                                               'p2011_Cowpeas','p2012_Cowpeas', 'p2013_Cowpeas','p2014_Cowpeas','p2015_Cowpeas','p2016_Cowpeas','p2017_Cowpeas','p2018_Cowpeas','p2019_Cowpeas','p2020_Cowpeas']].mean(axis=1)
-    long_results.drop(['OBJECTID','PCODE'],axis=1,inplace=True)
-    long_results.fillna(-99,inplace=True) #Set instances of no data to -99
-    #Write results to Excel
-    writer = pd.ExcelWriter('KEUGSO_long_results.xlsx',engine='xlsxwriter')
-    long_results.to_excel(writer, sheet_name='Sheet1')
-    worksheet = writer.sheets['Sheet1']
-    worksheet.set_column(0, 120, 15)
-    writer.save()
-    
+def calc_average(results):
     #Calculate averages - averages are only through 2020 so that that they do not change over time
-    short_results = pd.concat([ke_WRSI_crop_est['S'],so_results['Deyr'],ug_fnids]) #Concatenate, results for Uganda, Somalia, and Kenya for Gu/Long Season - Uganda rows will be blank as no short rains in Karamoja.
-    short_results.drop(['OBJECTID','PCODE'],axis=1,inplace=True)
-    short_results['Maize_av'] = short_results[['p2001_Maize','p2002_Maize','p2003_Maize','p2004_Maize','p2005_Maize','p2006_Maize','p2007_Maize','p2008_Maize','p2009_Maize','p2010_Maize','p2011_Maize', \
-                                             'p2012_Maize','p2013_Maize','p2014_Maize','p2015_Maize','p2016_Maize','p2017_Maize','p2018_Maize','p2019_Maize','p2020_Maize']].mean(axis=1)
-    short_results['Sorghum_av'] = short_results[['p2001_Sorghum','p2002_Sorghum','p2003_Sorghum','p2004_Sorghum','p2005_Sorghum','p2006_Sorghum','p2007_Sorghum','p2008_Sorghum','p2009_Sorghum','p2010_Sorghum', \
-                                               'p2011_Sorghum','p2012_Sorghum', 'p2013_Sorghum','p2014_Sorghum','p2015_Sorghum','p2016_Sorghum','p2017_Sorghum','p2018_Sorghum','p2019_Sorghum','p2020_Sorghum']].mean(axis=1)
-    short_results['Cowpeas_av'] = short_results[['p2001_Cowpeas','p2002_Cowpeas','p2003_Cowpeas','p2004_Cowpeas','p2005_Cowpeas','p2006_Cowpeas','p2007_Cowpeas','p2008_Cowpeas','p2009_Cowpeas','p2010_Cowpeas',\
-                                               'p2011_Cowpeas','p2012_Cowpeas', 'p2013_Cowpeas','p2014_Cowpeas','p2015_Cowpeas','p2016_Cowpeas','p2017_Cowpeas','p2018_Cowpeas','p2019_Cowpeas','p2020_Cowpeas']].mean(axis=1)
-    short_results.fillna(-99,inplace=True) #Set instances of no data to -99
-    #Write resulrs to Excel
-    writer = pd.ExcelWriter('KEUGSO_short_results.xlsx',engine='xlsxwriter')
-    short_results.to_excel(writer, sheet_name='Sheet1')
-    worksheet = writer.sheets['Sheet1']
-    worksheet.set_column(0, 120, 15)
-    writer.save()
-
-concat_ke_so_ug_data()
-
-print("Script Complete")
\ No newline at end of file
+    for crop in ['Maize','Sorghum','Cowpeas']:
+        results[crop + '_av'] = results[['p' + str(year) + '_' + crop for year in range(2001,2021)]].mean(axis=1)
+    return results
+
+def export_results(results,name,output_formats):
+    results = calc_average(results)
+    results = results.drop(['OBJECTID','PCODE'],axis=1)
+    results.fillna(-99,inplace=True) #Set instances of no data to -99
+    gdhi_io.export_results(results,name,output_formats) #Write results to Excel
+
+def concat_ke_so_ug_data(args, ke_WRSI_crop_est, so_results, ug_wrsi_results, fnids, previous_results, est_years, inputs):
+    print('Merge results and export to Excel')
+    wrsi_folder = os.path.abspath(args.wrsi_folder)
+    ug_fnids = fnids[fnids['COUNTRY'] == 'UG']
+    all_results = {}
+    all_results['KEUGSO_long_results'] = pd.concat([ke_WRSI_crop_est['L'],so_results['Gu'],ug_wrsi_results]) #Concatenate, results for Uganda, Somalia, and Kenya for Gu/Long Season
+    all_results['KEUGSO_short_results'] = pd.concat([ke_WRSI_crop_est['S'],so_results['Deyr'],ug_fnids]) #Concatenate, results for Uganda, Somalia, and Kenya for Deyr/Short Season - Uganda rows will be blank as no short rains in Karamoja.
+    for name, results in all_results.items():
+        if previous_results: #In incremental mode, replace current rains year columns in results from last run
+            est_cols = [col for col in results.columns if col.startswith(tuple('p' + str(year) + '_' for year in est_years))]
+            results = gdhi_io.merge_results(previous_results[name],results,est_cols)
+        gdhi_io.save_results(wrsi_folder,name,results,inputs)
+        all_results[name] = results
+    os.chdir(os.path.join(wrsi_folder,args.year_folder,args.month_folder))
+    for name, results in all_results.items():
+        export_results(results,name,args.output_formats)
+
+def main(args):
+    args.wrsi_folder = os.path.abspath(args.wrsi_folder) #Resolved once, before the script moves into the export folder
+    gdhi_io.excel_cache = not args.no_cache
+    WRSI_data = gdhi_io.get_wrsi_data(gdhi_io.get_wrsi_source(os.path.abspath(args.wrsi_folder),args.wrsi_table))
+    inputs = get_inputs(args,WRSI_data)
+    previous_results = get_previous_results(args,inputs)
+    est_years = get_est_years(args,gdhi_io.get_wrsi_years(WRSI_data),previous_results) #Years with WRSI data, based on WRSI_YYYY columns in feature classes
+    df_WRSI_percentile = wrsi_rank(WRSI_data,est_years,args.engine)
+    so_results = estimate_so(WRSI_data,df_WRSI_percentile,est_years,args.engine)
+    ke_WRSI_crop_est = estimate_ke(df_WRSI_percentile,est_years,args.engine,args.ke_admin1)
+    ug_wrsi_results = estimate_ug(WRSI_data,est_years)
+    bootstrap_bands = estimate_bootstrap(df_WRSI_percentile,est_years,args) if args.bootstrap else None #Read crop data before moving to the export folder
+    concat_ke_so_ug_data(args,ke_WRSI_crop_est,so_results,ug_wrsi_results,get_fnids(WRSI_data),previous_results,est_years,inputs)
+    if bootstrap_bands is not None:
+        gdhi_io.export_results(bootstrap_bands,bootstrap_name,args.output_formats) #Saved to the export folder next to the results
+    print("Script Complete")
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -1,7 +1,7 @@
 #-------------------------------------------------------------------------------
 # Name:       WRSI Zonal Statistics
-# Purpose:    Download selected WRSI file from USGS website, unzip it, and summarize WRSI data by adminstration units of interest using zonal statistics tools. 
-#             Requires Arcpy and spatial analayst extension to run.
+# Purpose:    Download selected WRSI file from USGS website, unzip it, and summarize WRSI data by adminstration units of interest using zonal statistics tools.
+#             Requires Arcpy to update the geodatabase, and the spatial analayst extension when run with --zonal_engine arcpy.
 # Author:      Richard Barad, FEWS NET
 #
 # Created:    18/06/2020
@@ -11,126 +11,271 @@
 
 '''
 This script downloads data from USGS WEbsite and runs zonal stats.
-'''
 
-import arcpy
-import os
-import requests
-import zipfile
-import sys
-
-arcpy.env.overwriteOutput = True #Allow file overwrites
-
-arcpy.CheckOutExtension("Spatial") #Checkout Spatial Analyst Extention - script requires access to a Spatial Analyst Extension to run 
-
-baseurl = r'https://edcftp.cr.usgs.gov/project/fews/africa/east/dekadal/wrsi-chirps-etos' #url to USGS website where data can be downloaded
-
-wrsi_folder = sys.argv[1]
-print("The wrsi folder is " + wrsi_folder)
-year_folder = sys.argv[2]
-print("The year folder is " + year_folder)
-month_folder = sys.argv[3]
-print("The Month folder is " + month_folder)
-file_download = sys.argv[4]
-print("The download file is " + file_download)
-
-file_split = file_download.split('_')
-product = file_split[0]
-folder = 'east' + product[1]
-year = int(file_split[1])
-month = int(file_split[2])
-dekad = int(file_split[3])
-
-def set_dekad():
-    #Convert dekad of month to dekad on an annual 1-36 scale, file name on USGS website is in a 1-36 format, with values 1 through 9 written as 01,02, etc.
-    dekad_annual = (month - 1) * 3 + dekad
-    if dekad_annual < 10:
-        dekad_string = '0' + str(dekad_annual)
-    else:
-        dekad_string = str(dekad_annual)
-    return dekad_string 
+    python WRSI_Download_CHIRPS.py <wrsi_folder> <year_folder> <month_folder> ee_2023_6_3 [el_2023_6_3 ...]
 
-url_dekad = set_dekad()
+Backfill mode downloads every dekad from --start to --end for each product in --products, and runs zonal stats for each file in date order in one run
+(arcpy is imported and the Spatial Analyst license checked out once):
 
-#Code below figures out the url, zipfile name, and tif file for the WRSI extended product based on the inputed parameters 
+    python WRSI_Download_CHIRPS.py <wrsi_folder> <year_folder> <month_folder> --products ee el --start 2023_3_1 --end 2023_6_3 [--workers 4]
 
-zipfilename = 'w' + str(year) + url_dekad + product + '.zip'
-url = baseurl + '/' + folder + '/' + zipfilename
-tiffile = 'w' + str(year) + url_dekad + 'eo.tif'
+Downloads run at the same time on a shared HTTP session (see gdhi_download.py), and files already downloaded by an earlier run are skipped, so an
+interrupted backfill can be run again with the same arguments. Use --source to download from a local folder with the same layout as the USGS website,
+and --download_only to download the files without running zonal stats.
 
-inpoly=os.path.join(wrsi_folder,'GDHI_Admin_Units.gdb\EA_GDHI_Admin_Units') #Set path to polygon featureclass, used for runnning zonal statistics
+Zonal statistics for all files are written to the ea_wrsi_<product> feature classes at the end of the run, in one write for each product. WRSI columns
+are saved as DOUBLE fields. Use --wrsi_table to update a folder of WRSI tables exported to csv instead of the geodatabase. The zonal statistics for
+every dekad are also saved to the WRSI cube in the WRSI folder (see gdhi_cube.py), which keeps the WRSI of each dekad of the season, and the standing
+of each dekad compared to the 2001 - 2015 dekadal climatology is saved to WRSI_dekad_standing.xlsx in the month folder (see gdhi_climatology.py).
 
-#Move to wrsi_folder
-os.chdir(wrsi_folder)
+Watch mode polls the source every --poll_seconds for new files of each product in --products from --start onwards, and downloads and processes new
+files as they are published (see gdhi_watch.py). Files already processed are kept in a ledger in the WRSI folder, so the watch can be stopped (Ctrl+C)
+and started again without processing files again. Each batch of new files is saved to the year and month folders of the date it is processed (i.e:
+2023/07 for a batch processed in July 2023), the same folders as a run started by hand that month, so year_folder and month_folder are not used:
 
-#Create year folder in WRSI if it does not exist, and move into that directory
-try:
-    tiff_directory = os.path.join(os.getcwd(),str(year_folder))
-    os.mkdir(tiff_directory)
-    os.chdir(tiff_directory)
-except:
-    os.chdir(tiff_directory)
+    python WRSI_Download_CHIRPS.py <wrsi_folder> <year_folder> <month_folder> --watch --products ee el --start 2023_3_1 [--poll_seconds 3600]
 
-#Create month folder in WRSI folder if it does not exist, and move into that directory.
-try:
-    tiff_directory = os.path.join(os.getcwd(),str(month_folder))
-    os.mkdir(tiff_directory)
-    os.chdir(tiff_directory)
-except:
-    os.chdir(tiff_directory)
+Zonal stats are calculated with NumPy by default (see gdhi_zonal.py), the admin units are rasterized once and the rasterized admin units are reused by
+later runs, so the Spatial Analyst extension is not needed. The WRSI tif is read from the downloaded zip file without extracting it, and only the windows
+of the raster covering the admin units of each country are read. The windows are saved to a compressed archive in GDHI_WRSI_Clipped, which is used
+instead of the zip file when a dekad is processed again, also if the zip file is no longer on the USGS website or in the Tiffs folder. Use --zonal_engine arcpy to extract the zip file and run ZonalStatisticsAsTable with Spatial Analyst instead.
+'''
 
-#Try to create a new folder called "tiffs" and then move to that directory- if it allready exists and was created through a previous run than just change to the directory.
-try:
-    tiff_directory = os.path.join(os.getcwd(),'Tiffs')
-    os.mkdir(tiff_directory)
-    os.chdir(tiff_directory)
-except:
-    os.chdir(tiff_directory)
+import argparse
+import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+import gdhi_climatology
+import gdhi_cube
+import gdhi_download
+import gdhi_io
+import gdhi_watch
+import gdhi_zonal
 
-def download_unzip_data(): #Download the WRSI File for the relevant year and save it to the workspace  
-    WRSI_download = requests.get(url)
-    print ("Download Status code: " + str(WRSI_download.status_code))
-    if WRSI_download.status_code == 404:
-        raise Exception( zipfilename + ' is not available on USGS website')
-    else:
-        open(zipfilename,'wb').write(WRSI_download.content) #Save zipped file to working directory
-        print ("Extracting WRSI zipped file")
-        with zipfile.ZipFile(zipfilename,'r') as zipobj: #Extract zipped file contents
-            zipobj.extractall()
-            print ("Zip file extracted")
+parser = argparse.ArgumentParser(description='Download WRSI data from the USGS website and run zonal statistics for the GDHI admin units')
+parser.add_argument('wrsi_folder')
+parser.add_argument('year_folder')
+parser.add_argument('month_folder')
+parser.add_argument('file_download',nargs='*') #One or more product_year_month_dekad strings (i.e: ee_2023_6_3)
+#Backfill - download all dekads from start to end (year_month_dekad, i.e: 2023_3_1) for each product
+parser.add_argument('--products',nargs='+',choices=['ee','el','ek','e2','e1','et'],default=[])
+parser.add_argument('--start')
+parser.add_argument('--end')
+parser.add_argument('--source',default=gdhi_download.baseurl) #USGS website, or a local folder with the same layout (i.e: a copy of the website for testing)
+parser.add_argument('--workers',type=int,default=4) #Maximum number of downloads (and NumPy zonal stats) at the same time
+parser.add_argument('--retries',type=int,default=5)
+parser.add_argument('--verify',choices=['size','checksum'],default='size') #How files from an earlier run are checked before they are skipped
+parser.add_argument('--download_only',action='store_true')
+parser.add_argument('--zonal_engine',choices=['numpy','arcpy'],default='numpy')
+parser.add_argument('--rebuild_labels',action='store_true') #Rasterize the admin units again, needed if the admin unit polygons are changed
+parser.add_argument('--wrsi_table') #Update a folder of WRSI tables exported to csv instead of the geodatabase (same as the crop production estimate scripts)
+#Watch - poll the source for new files of each product in --products from --start onwards, and process new files as they are published
+parser.add_argument('--watch',action='store_true')
+parser.add_argument('--poll_seconds',type=int,default=3600) #Time between polls of the source in watch mode
+
+def set_tiff_directory(wrsi_folder, year_folder, month_folder):
+    #Create the <year>/<month>/Tiffs folder in the WRSI folder if it does not exist, and move into that directory. Downloaded zip files are saved here.
+    tiff_directory = os.path.join(wrsi_folder,str(year_folder),str(month_folder),'Tiffs')
+    os.makedirs(tiff_directory,exist_ok=True)
+    os.chdir(tiff_directory)
+    return tiff_directory
 
-download_unzip_data()
+def unzip_data(zipfilename):
+    print ("Extracting WRSI zipped file")
+    with zipfile.ZipFile(zipfilename,'r') as zipobj: #Extract zipped file contents
+        zipobj.extractall()
+        print ("Zip file extracted")
 
-def reclass_raster(): #Reclass raster, set no start values to 0 (instead of 253) and yet to start values to Null/ no data (instead of 254) and return raster in memory
+def reclass_raster(arcpy, tiffile, year, product): #Reclass raster, set no start values to 0 (instead of 253) and yet to start values to Null/ no data (instead of 254) and return raster in memory
     print ("Reclassifying " + str(year) +" "+ product + " raster - set no start values to 0")
     outCon = arcpy.sa.Con(tiffile,0,tiffile,"value=253")
     print ("Reclassifying " + str(year) +" "+ product + " raster - set yet to start values to null")
     outSetNull = arcpy.sa.SetNull(outCon, outCon, "value=254")
     return outSetNull
 
-def zonal_stats_updatetable():
-    reclassed_raster = reclass_raster()
+def zonal_stats_arcpy(arcpy, wrsi_folder, tiffile, product, year):
+    inpoly=os.path.join(wrsi_folder,'GDHI_Admin_Units.gdb\EA_GDHI_Admin_Units') #Set path to polygon featureclass, used for runnning zonal statistics
+    reclassed_raster = reclass_raster(arcpy,tiffile,year,product)
     #Run Zonal statistics on reclassified raster
     print ("Running Zonal Statistics for " + str(year) + " "+ product + " exported in memory")
     outtable= os.path.join('in_memory','zonal_stats') #set file path for results of zonal statistics, save in memory
     arcpy.env.workspace = os.path.join(wrsi_folder,'GDHI_Admin_Units.gdb') #Set workspace to GDB containing historical WRSI data
     arcpy.sa.ZonalStatisticsAsTable(inpoly,"FNID",reclassed_raster,outtable,"DATA","MEAN") #Run zonal statisitcs
-    print ("Zonal Statistcs for " + str(year) + " "+ product + " exported in memory")
-    feature_class = 'ea_wrsi_' + product #Figure out featureclass in workspace to update, based on WRSI product
-    arcpy.management.MakeFeatureLayer(feature_class, 'GIS_layer') #Create layer from featureclass
-    print ("Joining Zonal Statistics to Feature Class and update column")
-    table_join = arcpy.management.AddJoin('GIS_layer', "FNID", outtable, "FNID", "KEEP_ALL") #Create join between layer and results of zonal statistics
-    #Figure out which year column to update in feature class
-    if product in ('et','e1') and month < 3: #If product is for short rains and month is January or February need to subtract one from year since column is dated by year of rains.
-        col_update = feature_class + '.WRSI_' + str(year - 1)
+    table = arcpy.da.TableToNumPyArray(outtable,['FNID','MEAN'])
+    return pd.Series(table['MEAN'],index=table['FNID'].astype(object),name='MEAN')
+
+def zonal_stats(arcpy, wrsi_folder, tiffile, product, year, zonal_engine='numpy', rebuild_labels=False, archive=None):
+    #Mean WRSI of each FNID for one WRSI raster, returns a Series indexed by FNID. The NumPy engine runs in several threads at once, so progress is printed
+    #by run_zonal_stats in the main thread instead.
+    if zonal_engine == 'arcpy':
+        return zonal_stats_arcpy(arcpy,wrsi_folder,tiffile,product,year)
+    #Calculate zonal statistics with gdhi_zonal, tiffile is the path to the tif file inside the zip file, the zip file is not extracted.
+    return gdhi_zonal.zonal_stats(wrsi_folder,tiffile,rebuild_labels,archive)
+
+def file_stats(arcpy, args, wrsi_folder, tiff_directory, file_download, rebuild_labels=False):
+    #Zonal stats for one downloaded file, returns a Series of the mean WRSI indexed by FNID
+    product, year, month, dekad = gdhi_download.parse_file(file_download)
+    zipfilename = os.path.join(tiff_directory,gdhi_download.zip_name(product,year,month,dekad))
+    tiffile = 'w' + str(year) + gdhi_download.set_dekad(month,dekad) + 'eo.tif'
+    if args.zonal_engine == 'arcpy':
+        os.chdir(tiff_directory) #Zonal stats changes the workspace, extract each file into the Tiffs folder
+        unzip_data(zipfilename)
+        tiffile = os.path.join(tiff_directory,tiffile)
+    else:
+        tiffile = gdhi_zonal.zip_member(zipfilename,tiffile) #Read from the zip file
+    archive = gdhi_zonal.get_archive_path(wrsi_folder,zipfilename) #Windows of the raster covering the admin units are kept for reprocessing
+    return zonal_stats(arcpy,wrsi_folder,tiffile,product,year,args.zonal_engine,rebuild_labels,archive)
+
+def is_archived(args, wrsi_folder, tiff_directory, file_download):
+    #Files not available on the USGS website can be processed from the archive saved by an earlier run (NumPy engine only)
+    zipfilename = os.path.join(tiff_directory,gdhi_download.zip_name(*gdhi_download.parse_file(file_download)))
+    return args.zonal_engine != 'arcpy' and os.path.exists(gdhi_zonal.get_archive_path(wrsi_folder,zipfilename))
+
+def try_file_stats(arcpy, args, wrsi_folder, tiff_directory, file_download, errors, rebuild_labels=False):
+    #Zonal stats for one file in watch mode. If the file can not be processed (i.e: a corrupt zip file) the error is added to errors and None is returned,
+    #so one bad file does not stop the other files in the batch.
+    try:
+        return file_stats(arcpy,args,wrsi_folder,tiff_directory,file_download,rebuild_labels)
+    except Exception as error:
+        errors[file_download] = type(error).__name__ + ': ' + str(error)
+        return None
+
+def print_stats(file_download, mean):
+    if mean is not None: #Files which failed in watch mode are reported by process_files
+        product, year, month, dekad = gdhi_download.parse_file(file_download)
+        print ("Zonal Statistcs for " + str(year) + " " + product + " (" + file_download + ") calculated for " + str(len(mean)) + " admin units")
+
+def run_zonal_stats(arcpy, args, wrsi_folder, tiff_directory, files, errors=None):
+    #Zonal stats for a list of downloaded files, returns a list of Series in the same order. The first file is run on its own (the admin units are
+    #rasterized if needed) and the other files are run at most --workers at a time. The arcpy engine runs one file at a time in the main thread.
+    #If errors is a dictionary, files which fail are added to it and their Series is None, otherwise the error is raised.
+    if not files:
+        return []
+    if errors is None:
+        stats = lambda file_download, rebuild_labels=False: file_stats(arcpy,args,wrsi_folder,tiff_directory,file_download,rebuild_labels)
     else:
-        col_update = feature_class + '.WRSI_' + str(year)
-    print(col_update)
-    #Set appropriate year column in feature class to results of zonal statistics
-    arcpy.management.CalculateField(table_join, col_update, "!zonal_stats.MEAN!", "PYTHON3", '', "TEXT", "NO_ENFORCE_DOMAINS")
-    print("Join complete, removing join")
-    arcpy.management.RemoveJoin(table_join)
+        stats = lambda file_download, rebuild_labels=False: try_file_stats(arcpy,args,wrsi_folder,tiff_directory,file_download,errors,rebuild_labels)
+    if args.zonal_engine != 'arcpy':
+        print('Running Zonal Statistics for ' + str(len(files)) + ' files with NumPy, ' + str(args.workers) + ' at a time')
+    means = {files[0]: stats(files[0],args.rebuild_labels)}
+    print_stats(files[0],means[files[0]])
+    args.rebuild_labels = False #Admin units only need to be rasterized again once
+    if args.zonal_engine == 'arcpy':
+        for file_download in files[1:]:
+            means[file_download] = stats(file_download)
+            print_stats(file_download,means[file_download])
+    else:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(stats,file_download): file_download for file_download in files[1:]}
+            for future in as_completed(futures): #Progress is printed from the main thread as each file completes, so lines from the threads are not mixed
+                means[futures[future]] = future.result()
+                print_stats(futures[future],means[futures[future]])
+    return [means[file_download] for file_download in files]
+
+def update_tables(wrsi_source, results):
+    #Write the zonal statistics to the WRSI feature classes, one write per product. results is a dictionary with the WRSI column and Series of zonal
+    #statistics for each product. When several dekads update the same column the last dekad is written.
+    for product, columns in results.items():
+        gdhi_io.write_wrsi_columns(wrsi_source,product,columns)
+
+def export_standing(cube_folder, dekad_results, month_directory):
+    #Save the standing of each dekad compared to the 2001 - 2015 dekadal climatology (see gdhi_climatology.py) to WRSI_dekad_standing in the month folder
+    standing = pd.concat([gdhi_climatology.dekad_standing(cube_folder,product,year,month,dekad,mean) for product, year, month, dekad, mean in dekad_results])
+    if standing['percent_rank'].isna().all():
+        print('No dekadal WRSI for the 2001 - 2015 baseline in the WRSI cube, run a backfill for 2001 - 2015 to calculate the in-season standing')
+    gdhi_io.export_results(standing,os.path.join(month_directory,'WRSI_dekad_standing'))
+    print('In-season standing saved to ' + os.path.join(month_directory,'WRSI_dekad_standing.xlsx'))
+
+def get_files(args):
+    #List of files to download, files passed on the command line followed by the backfill files. Backfill files are in date order, so when several dekads
+    #update the same year column the last dekad is written last.
+    files = list(args.file_download)
+    if args.products:
+        if not (args.start and args.end):
+            parser.error('--start and --end are required with --products')
+        files = files + gdhi_download.backfill_files(args.products,args.start,args.end)
+    if not files:
+        parser.error('no files to download, list product_year_month_dekad files or use --products with --start and --end')
+    return files
+
+def get_arcpy(args):
+    #arcpy is only needed for the arcpy zonal engine
+    if args.download_only or args.zonal_engine != 'arcpy':
+        return None
+    import arcpy
+    arcpy.env.overwriteOutput = True #Allow file overwrites
+    arcpy.CheckOutExtension("Spatial") #Checkout Spatial Analyst Extention - the arcpy zonal engine requires access to a Spatial Analyst Extension to run
+    return arcpy
+
+def process_files(arcpy, args, wrsi_folder, files, year_folder, month_folder, errors=None):
+    #Download a list of files to the Tiffs folder of the year and month folder, run zonal stats for each file, save the zonal stats to the WRSI cube and
+    #WRSI tables, and export the in-season standing to the month folder. Returns the status of each file (see gdhi_download.download_files).
+    #If errors is a dictionary, files which can not be processed are added to it with the error and left out, and the other files are still saved.
+    tiff_directory = set_tiff_directory(wrsi_folder,year_folder,month_folder)
+    statuses = gdhi_download.download_files(files,tiff_directory,args.source,args.workers,args.verify,args.retries)
+    missing = [file_download for file_download, status in statuses.items() if status == 'missing']
+    archived = [] if args.download_only else [file_download for file_download in missing if is_archived(args,wrsi_folder,tiff_directory,file_download)]
+    missing = [file_download for file_download in missing if file_download not in archived]
+    if missing and len(files) == 1 and not args.watch:
+        raise Exception(gdhi_download.zip_name(*gdhi_download.parse_file(files[0])) + ' is not available on USGS website')
+    if missing:
+        print('Not available on USGS website, skipped: ' + ', '.join(missing))
+    if archived:
+        print('Not available on USGS website, processed from the clipped archive: ' + ', '.join(archived))
+    if args.download_only:
+        return statuses
+    downloaded = [file_download for file_download in files if statuses[file_download] in ('downloaded','skipped') or file_download in archived]
+    results = {}
+    dekad_results = []
+    for file_download, mean in zip(downloaded,run_zonal_stats(arcpy,args,wrsi_folder,tiff_directory,downloaded,errors)):
+        if mean is None:
+            print('Zonal statistics failed for ' + file_download + ', skipped (' + errors[file_download] + ')')
+            continue
+        product, year, month, dekad = gdhi_download.parse_file(file_download)
+        results.setdefault(product,{})[gdhi_io.get_wrsi_column(product,year,month)] = mean
+        dekad_results.append((product,year,month,dekad,mean))
+    wrsi_source = gdhi_io.get_wrsi_source(wrsi_folder,args.wrsi_table)
+    if dekad_results:
+        cube_folder = gdhi_cube.get_cube_folder(wrsi_folder,wrsi_source) #Cube is created from the WRSI tables before they are updated
+        gdhi_cube.append_dekads(cube_folder,dekad_results)
+        export_standing(cube_folder,dekad_results,os.path.join(wrsi_folder,str(year_folder),str(month_folder)))
+    update_tables(wrsi_source,results)
+    return statuses
+
+def process_batch(arcpy, args, wrsi_folder, files):
+    #Process a batch of new files in watch mode, saved to the year and month folder of the date the batch is processed (a watch can run for several months).
+    #Returns the status of each file, and the error for each file which could not be processed.
+    print('Save batch to the ' + time.strftime('%Y') + '/' + time.strftime('%m') + ' folder')
+    errors = {}
+    statuses = process_files(arcpy,args,wrsi_folder,files,time.strftime('%Y'),time.strftime('%m'),errors)
+    return statuses, errors
 
-zonal_stats_updatetable()
+def main(args):
+    print("The wrsi folder is " + args.wrsi_folder)
+    print("The year folder is " + args.year_folder)
+    print("The Month folder is " + args.month_folder)
+    wrsi_folder = os.path.abspath(args.wrsi_folder)
+    if args.wrsi_table: #WRSI tables and a local mirror are read after the script moves into the Tiffs folder
+        args.wrsi_table = os.path.abspath(args.wrsi_table)
+    if gdhi_download.is_mirror(args.source):
+        args.source = os.path.abspath(args.source)
+    if args.watch:
+        if not (args.products and args.start):
+            parser.error('--products and --start are required with --watch')
+        if args.download_only:
+            parser.error('--download_only can not be used with --watch')
+        arcpy = get_arcpy(args)
+        gdhi_watch.watch(wrsi_folder,args.source,args.products,args.start,args.poll_seconds,lambda files: process_batch(arcpy,args,wrsi_folder,files))
+        return
+    files = get_files(args)
+    print("Files to download: " + ', '.join(files))
+    statuses = process_files(get_arcpy(args),args,wrsi_folder,files,args.year_folder,args.month_folder)
+    failed = [file_download for file_download, status in statuses.items() if status == 'failed']
+    if failed:
+        raise Exception('Download failed for ' + ', '.join(failed) + ', run the script again to resume')
+    print ("Script complete")
 
-print ("Script complete")
\ No newline at end of file
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Entry point for running the GDHI crop production estimates for all four countries in one command, instead of running WRSI_Crop_Est_ET.py and
+WRSI_Crop_Est_UGSOKE.py one after the other:
+
+    python gdhi.py estimate <wrsi_folder> <year_folder> <month_folder> [--incremental] [--wrsi_table <folder>] [--workers 4] [--et_workers 1]
+
+WRSI data is read once and saved to the columnar snapshot (see gdhi_io.py). The Ethiopia, Somalia, Kenya and Uganda estimates are then calculated at
+the same time in separate worker processes. Each worker memory maps the WRSI snapshot when it starts, so the read-only WRSI arrays are shared through
+the snapshot files instead of a copy being pickled and sent to every worker. Results are sent back to the main process, which saves and exports them in
+the same way as the two scripts, so the run takes about as long as the slowest country. The Somalia and Kenya estimates use the same WRSI percent
+ranks, which are calculated once in the main process while the Ethiopia and Uganda estimates run, and sent to the Somalia and Kenya workers.
+
+What-if estimates for hypothetical WRSI values are calculated from response curves (see gdhi_scenario.py):
+
+    python gdhi.py curves <wrsi_folder> [--wrsi_table <folder>]
+    python gdhi.py whatif <wrsi_folder> <queries.csv> [--output <results.csv>]
+
+The quantile mapping and linear scaling methods are compared with a leave one year out backtest (see gdhi_backtest.py):
+
+    python gdhi.py backtest <wrsi_folder> [--wrsi_table <folder>] [--workers 4] [--output_folder <folder>]
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import gdhi_io
+import gdhi_backtest
+import gdhi_scenario
+import WRSI_Crop_Est_ET as et_est
+import WRSI_Crop_Est_UGSOKE as ugsoke_est
+
+parser = argparse.ArgumentParser(description='GDHI crop production estimates')
+subparsers = parser.add_subparsers(dest='command',required=True)
+estimate_parser = subparsers.add_parser('estimate',description='Calculate WRSI based crop production estimates for Ethiopia, Somalia, Kenya, and Uganda')
+estimate_parser.add_argument('wrsi_folder')
+estimate_parser.add_argument('year_folder')
+estimate_parser.add_argument('month_folder')
+#Same options as WRSI_Crop_Est_UGSOKE.py and WRSI_Crop_Est_ET.py
+estimate_parser.add_argument('--engine',choices=['legacy','vectorized'],default='vectorized')
+estimate_parser.add_argument('--ke_admin1',nargs='+',default=['Mandera','Wajir','Turkana','Marsabit'])
+estimate_parser.add_argument('--incremental',action='store_true')
+estimate_parser.add_argument('--wrsi_table')
+estimate_parser.add_argument('--output_formats',nargs='+',choices=['xlsx','parquet','csv'],default=['xlsx'])
+estimate_parser.add_argument('--no_cache','--no-cache',action='store_true')
+#Number of worker processes, one per country is enough for all four countries to run at the same time
+estimate_parser.add_argument('--workers',type=int,default=4)
+#Number of worker processes used by the Ethiopia worker for the region / season / crop units of work
+estimate_parser.add_argument('--et_workers',type=int,default=1)
+curves_parser = subparsers.add_parser('curves',description='Calculate what-if response curves (WRSI 0 - 100 to crop production estimate) for Ethiopia, Somalia, and Kenya')
+whatif_parser = subparsers.add_parser('whatif',description='Crop production estimates for hypothetical WRSI values, read from a csv file with fnid, season, crop, and wrsi columns')
+for scenario_parser in [curves_parser,whatif_parser]:
+    scenario_parser.add_argument('wrsi_folder')
+    scenario_parser.add_argument('--wrsi_table')
+    scenario_parser.add_argument('--ke_admin1',nargs='+',default=['Mandera','Wajir','Turkana','Marsabit'])
+    scenario_parser.add_argument('--no_cache','--no-cache',action='store_true')
+whatif_parser.add_argument('queries')
+whatif_parser.add_argument('--output') #csv file to save estimates to, estimates are printed if not set
+backtest_parser = subparsers.add_parser('backtest',description='Leave one year out backtest of the quantile mapping and linear scaling methods')
+backtest_parser.add_argument('wrsi_folder')
+backtest_parser.add_argument('--wrsi_table')
+backtest_parser.add_argument('--ke_admin1',nargs='+',default=['Mandera','Wajir','Turkana','Marsabit'])
+backtest_parser.add_argument('--no_cache','--no-cache',action='store_true')
+backtest_parser.add_argument('--workers',type=int,default=4)
+backtest_parser.add_argument('--output_folder') #Folder to export the backtest tables to, by default the WRSI folder
+backtest_parser.add_argument('--output_formats',nargs='+',choices=['xlsx','parquet','csv'],default=['xlsx'])
+
+countries = ['ET','UG'] #Submitted before the WRSI percent ranks are calculated, Ethiopia is submitted first as it takes the longest
+rank_countries = ['SO','KE'] #Submitted with the WRSI percent ranks
+
+def init_worker(wrsi_source, excel_cache):
+    #Runs once in each worker process, memory map the WRSI snapshot written by the main process. WRSI_data is None if the WRSI data has changed since the
+    #main process read it, checked in estimate_country so the error is sent back to the main process.
+    global WRSI_data, WRSI_source
+    WRSI_data = gdhi_io.load_wrsi_snapshot(wrsi_source)
+    WRSI_source = wrsi_source
+    gdhi_io.excel_cache = excel_cache
+
+def estimate_country(country, args, est_years, df_WRSI_percentile=None):
+    #Calculate crop production estimates for one country in a worker process, returns results and the time taken. df_WRSI_percentile is the WRSI percent
+    #ranks calculated by the main process, used for Somalia and Kenya.
+    start = time.perf_counter()
+    if WRSI_data is None:
+        raise Exception('WRSI data in ' + WRSI_source + ' changed after the estimate started, the WRSI snapshot could not be read. Run the estimate again.')
+    if country == 'ET':
+        results = et_est.estimate_et(WRSI_data,est_years['ET'],args.et_workers)
+    elif country == 'SO':
+        results = ugsoke_est.estimate_so(WRSI_data,df_WRSI_percentile,est_years['UGSOKE'],args.engine)
+    elif country == 'KE':
+        results = ugsoke_est.estimate_ke(df_WRSI_percentile,est_years['UGSOKE'],args.engine,args.ke_admin1)
+    elif country == 'UG':
+        results = ugsoke_est.estimate_ug(WRSI_data,est_years['UGSOKE'])
+    return results, time.perf_counter() - start
+
+def estimate(args):
+    start = time.perf_counter()
+    args.wrsi_folder = os.path.abspath(args.wrsi_folder) #Resolved once, the KE/SO/UG export moves into the month folder before the ET results are exported
+    wrsi_source = gdhi_io.get_wrsi_source(os.path.abspath(args.wrsi_folder),args.wrsi_table)
+    WRSI_data = gdhi_io.get_wrsi_data(wrsi_source) #Read WRSI data once, creates the snapshot used by the workers if it is missing or out of date
+    wrsi_years = gdhi_io.get_wrsi_years(WRSI_data)
+    #Results from the last run are saved seperately for ET and KE/SO/UG, so in incremental mode each group can be on a different set of years
+    inputs = {'ET': et_est.get_inputs(args,WRSI_data), 'UGSOKE': ugsoke_est.get_inputs(args,WRSI_data)}
+    previous_results = {'ET': et_est.get_previous_results(args,inputs['ET']), 'UGSOKE': ugsoke_est.get_previous_results(args,inputs['UGSOKE'])}
+    est_years = {'ET': et_est.get_est_years(args,wrsi_years,previous_results['ET']),
+                 'UGSOKE': ugsoke_est.get_est_years(args,wrsi_years,previous_results['UGSOKE'])}
+    results = {}
+    with ProcessPoolExecutor(max_workers=args.workers,initializer=init_worker,initargs=(wrsi_source,not args.no_cache)) as executor:
+        futures = {country: executor.submit(estimate_country,country,args,est_years) for country in countries}
+        df_WRSI_percentile = ugsoke_est.wrsi_rank(WRSI_data,est_years['UGSOKE'],args.engine) #Ranked once for Somalia and Kenya
+        futures.update({country: executor.submit(estimate_country,country,args,est_years,df_WRSI_percentile) for country in rank_countries})
+        for country, future in futures.items():
+            results[country], seconds = future.result()
+            print('Crop production estimates for ' + country + ' calculated in ' + str(round(seconds,3)) + ' seconds')
+    #Save and export results in the main process. Results are saved before moving to the export folder, crop production file paths are relative to the GDHI folder.
+    et_results = et_est.save_et_results(args,results['ET'],previous_results['ET'],est_years['ET'],inputs['ET'])
+    ugsoke_est.concat_ke_so_ug_data(args,results['KE'],results['SO'],results['UG'],ugsoke_est.get_fnids(WRSI_data),previous_results['UGSOKE'],est_years['UGSOKE'],inputs['UGSOKE'])
+    et_est.export_et_results(args,et_results,wrsi_years)
+    print('GDHI crop production estimates complete in ' + str(round(time.perf_counter() - start,3)) + ' seconds')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'estimate':
+        estimate(args)
+    elif args.command == 'curves':
+        gdhi_io.excel_cache = not args.no_cache
+        gdhi_scenario.get_curves(os.path.abspath(args.wrsi_folder),args.wrsi_table,args.ke_admin1,rebuild=True)
+    elif args.command == 'whatif':
+        gdhi_io.excel_cache = not args.no_cache
+        gdhi_scenario.whatif(os.path.abspath(args.wrsi_folder),args.wrsi_table,args.ke_admin1,args.queries,args.output)
+    elif args.command == 'backtest':
+        gdhi_io.excel_cache = not args.no_cache
+        wrsi_folder = os.path.abspath(args.wrsi_folder)
+        estimates, metrics = gdhi_backtest.backtest(gdhi_io.get_wrsi_data(gdhi_io.get_wrsi_source(wrsi_folder,args.wrsi_table)),args.ke_admin1,args.workers)
+        output_folder = args.output_folder if args.output_folder else wrsi_folder
+        gdhi_io.export_results(estimates,os.path.join(output_folder,'GDHI_backtest_estimates'),args.output_formats)
+        gdhi_io.export_results(metrics,os.path.join(output_folder,'GDHI_backtest_metrics'),args.output_formats)
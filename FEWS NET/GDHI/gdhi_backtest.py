@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Leave-one-year-out backtest of the two methods used to turn WRSI into crop production estimates:
+
+    quantile - WRSI percent rank against the 2001 - 2015 baseline mapped onto the production time series (Somalia / Kenya in WRSI_Crop_Est_UGSOKE.py)
+    linear - linear scaling between the minimum and maximum production when WRSI is above 50 (Ethiopia in WRSI_Crop_Est_ET.py)
+
+    python gdhi.py backtest <wrsi_folder> [--wrsi_table <folder>] [--workers 4] [--output_folder <folder>]
+
+Each year with reported production and WRSI data is held out in turn, and the estimate for that year is calculated with both methods from the production
+data for the other years - the same as running the estimators once for each held out year, but every held out year is calculated at once as a 3D array
+(rows x held out years x production years). Both methods need at least five production data points after the year is held out, the same minimum used by
+the estimate scripts. Rows are the Somalia, Kenya and Ethiopia production time series joined to each FNID in the same way as in the estimate scripts,
+before fallback logic. Rows are split into batches which are calculated in a process pool.
+
+Two tables are exported: GDHI_backtest_estimates (reported production and the estimate from each method for every FNID, season, crop and held out year)
+and GDHI_backtest_metrics (number of years, mean absolute error, root mean square error, bias, and mean absolute percent error for each FNID, season,
+crop and method).
+"""
+
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import gdhi_calc
+import gdhi_io
+import WRSI_Crop_Est_ET as et_est
+import WRSI_Crop_Est_UGSOKE as ugsoke_est
+
+methods = ['quantile','linear']
+min_points = 5 #Minimum number of production data points used by the estimate scripts
+batch_size = 2000000 #Maximum number of values in the held out production array for a batch of rows
+
+def get_row_wrsi(WRSI_data, products, fnids, wrsi_years):
+    #WRSI for each row (rows x years), from the WRSI product used by the row
+    wrsi_cols = ['WRSI_' + str(year) for year in wrsi_years]
+    wrsi = np.full((len(fnids),len(wrsi_years)),np.nan)
+    for product in np.unique(products):
+        rows = products == product
+        wrsi[rows] = WRSI_data[product].loc[fnids[rows],wrsi_cols].to_numpy(dtype=float)
+    return wrsi
+
+def get_ranks(wrsi, wrsi_years):
+    #Percent rank of WRSI for each row and year, calculated in the same way as ugsoke_est.wrsi_rank - 2001 - 2015 are ranked within the baseline, later
+    #years are ranked against the baseline
+    baseline = np.array([year in range(2001,2016) for year in wrsi_years])
+    index = gdhi_calc.rank_index(wrsi[:,baseline])
+    pct = np.full(wrsi.shape,np.nan)
+    pct[:,baseline] = index.baseline_rank()
+    pct[:,~baseline] = index.percent_rank(wrsi[:,~baseline])
+    return pct
+
+def so_rows(WRSI_data, wrsi_years):
+    #Somalia production time series for each FNID, season and crop, same rows as the Somalia estimates
+    so_crop_final = ugsoke_est.pivot_clean_so_crop.filter_data(ugsoke_est.so_crop_data.clean_so_data())
+    series_years = [col for col in so_crop_final.columns.tolist() if type(col) is int]
+    products = np.array([ugsoke_est.set_so_wrsi_product(season,crop,rains) for season, crop, rains in \
+                         zip(so_crop_final['season_name'],so_crop_final['product'],so_crop_final['rains'])])
+    fnids = so_crop_final['fnid'].to_numpy()
+    keys = pd.DataFrame({'country':'SO','fnid':fnids,'season':so_crop_final['season_name'].to_numpy(),'crop':so_crop_final['product'].to_numpy()})
+    return keys, so_crop_final[series_years].to_numpy(dtype=float), series_years, get_row_wrsi(WRSI_data,products,fnids,wrsi_years)
+
+def ke_rows(WRSI_data, wrsi_years, admin1_units):
+    #Kenya annual maize production time series of the Admin1 unit for each FNID and season, same rows as the Kenya estimates
+    ke_crop = ugsoke_est.ke_crop_data.clean_ke_data(admin1_units)
+    keys = []
+    wrsi = []
+    admin1 = []
+    for season in ['L','S']:
+        df = WRSI_data['Range' + season]
+        df = df[(df['ADMIN0'] == 'Kenya') & (df['ADMIN1'].isin(admin1_units))]
+        keys.append(pd.DataFrame({'country':'KE','fnid':df.index,'season':season,'crop':'Maize'}))
+        wrsi.append(df[['WRSI_' + str(year) for year in wrsi_years]].to_numpy(dtype=float))
+        admin1 = admin1 + df['ADMIN1'].tolist()
+    series = ke_crop.reindex(admin1)
+    return pd.concat(keys,ignore_index=True), series.to_numpy(dtype=float), series.columns.tolist(), np.concatenate(wrsi)
+
+def et_rows(WRSI_data, wrsi_years):
+    #Ethiopia production time series for each FNID, season and crop. Meher data is joined on the Admin2 name, Belg data on the Admin1 name, same as the estimates.
+    et_crop = et_est.et_crop_data.aggregate_data()
+    series = et_crop.pivot_table(index=['ADMIN1','ADMIN2','SEASON','PRODUCT'],columns='YEAR',values='value',aggfunc='sum').reset_index()
+    series_years = [col for col in series.columns if type(col) is not str]
+    units = et_est.get_units(WRSI_data)
+    units['ADMIN2_CROP'] = et_est.get_admin2_crop(WRSI_data)
+    units['REGION'] = et_est.get_regions(WRSI_data)
+    units = units[units['REGION'].notna()].rename_axis('FNID').reset_index()
+    rows = []
+    for season in ['Meher','Belg']:
+        season_series = series[(series['SEASON'] == season) & (series['PRODUCT'].isin(et_est.et_crops))]
+        if season == 'Meher':
+            season_rows = units.merge(season_series.rename(columns={'ADMIN2':'ADMIN2_CROP'}),on=['ADMIN1','ADMIN2_CROP'])
+        else:
+            season_rows = units.merge(season_series.drop('ADMIN2',axis=1),on=['ADMIN1'])
+        rows.append(season_rows)
+    rows = pd.concat(rows,ignore_index=True)
+    products = np.array([et_est.get_wrsi_product(season,region,'Maize' if crop == 'Maize' else 'Grains') for season, region, crop in \
+                         zip(rows['SEASON'],rows['REGION'],rows['PRODUCT'])])
+    fnids = rows['FNID'].to_numpy()
+    keys = pd.DataFrame({'country':'ET','fnid':fnids,'season':rows['SEASON'].to_numpy(),'crop':rows['PRODUCT'].to_numpy()})
+    return keys, rows[series_years].to_numpy(dtype=float), series_years, get_row_wrsi(WRSI_data,products,fnids,wrsi_years)
+
+def backtest_batch(series, held, wrsi, pct):
+    #Leave one year out estimates for a batch of rows. series is the production time series (rows x production years), held is the position in the series
+    #of each held out year, and wrsi / pct are the WRSI and WRSI percent rank for the held out years (rows x held out years).
+    #Returns the reported production and the estimate from each method (rows x held out years).
+    rows, length = series.shape
+    train = np.repeat(series[:,np.newaxis,:],len(held),axis=1) #rows x held out years x production years
+    train[:,np.arange(len(held)),held] = np.nan #Hold out one year in each copy of the series
+    train = train.reshape(rows * len(held),length)
+    enough = (~np.isnan(train)).sum(axis=1) >= min_points
+    quantile = gdhi_calc.quantile_map(train,pct.reshape(-1,1))[:,0]
+    crop_min = np.where(np.isnan(train),np.inf,train).min(axis=1)
+    crop_max = np.where(np.isnan(train),-np.inf,train).max(axis=1)
+    linear = gdhi_calc.linear_scale(wrsi.reshape(-1,1),np.where(enough,crop_min,np.nan),np.where(enough,crop_max - crop_min,np.nan),np.zeros(len(train),dtype=bool))[:,0]
+    reported = series[:,held]
+    estimates = {}
+    for method, values in [('quantile',quantile),('linear',linear)]:
+        values = np.where(enough,values,np.nan).reshape(rows,len(held))
+        values[np.isnan(reported)] = np.nan
+        estimates[method] = values
+    return reported, estimates
+
+def backtest_rows(executor, keys, series, series_years, wrsi, wrsi_years):
+    #Run the backtest for the rows of one country in batches. Returns a long table with one row per FNID, season, crop and held out year with reported production.
+    years = [year for year in wrsi_years if year in series_years] #Years with WRSI and production data
+    cols = [wrsi_years.index(year) for year in years]
+    pct = get_ranks(wrsi,wrsi_years)[:,cols] #Ranks use all WRSI years, so baseline years are ranked against the full baseline
+    wrsi = wrsi[:,cols]
+    held = np.array([series_years.index(year) for year in years],dtype=np.intp)
+    batch_rows = max(1,batch_size // max(len(years) * len(series_years),1))
+    batches = [(series[start:start + batch_rows],held,wrsi[start:start + batch_rows],pct[start:start + batch_rows]) for start in range(0,len(keys),batch_rows)]
+    results = list(executor.map(backtest_batch,*zip(*batches))) if batches else []
+    table = keys.loc[keys.index.repeat(len(years))].reset_index(drop=True)
+    table['year'] = np.tile(years,len(keys))
+    table['reported'] = np.concatenate([reported.ravel() for reported, estimates in results]) if results else []
+    for method in methods:
+        table[method] = np.concatenate([estimates[method].ravel() for reported, estimates in results]) if results else []
+    return table[table['reported'].notna()]
+
+def calc_metrics(estimates):
+    #Error metrics for each FNID, season, crop and method, over the held out years with an estimate
+    metrics = []
+    for method in methods:
+        error = estimates[method] - estimates['reported']
+        errors = estimates[['country','fnid','season','crop']].assign(method=method,error=error,abs_error=error.abs(),sq_error=error ** 2,
+                                                                      pct_error=(error.abs() / estimates['reported']).where(estimates['reported'] > 0) * 100)
+        errors = errors[error.notna()]
+        method_metrics = errors.groupby(['country','fnid','season','crop','method']).agg(years=('error','size'),mae=('abs_error','mean'),rmse=('sq_error','mean'),
+                                                                                         bias=('error','mean'),mape=('pct_error','mean'))
+        method_metrics['rmse'] = np.sqrt(method_metrics['rmse'])
+        metrics.append(method_metrics)
+    return pd.concat(metrics).sort_index()
+
+def print_summary(metrics):
+    #Median error of each method by country, and number of FNID / season / crop series where each method has the lowest mean absolute error
+    summary = metrics.groupby(['country','method'])[['mae','rmse','mape']].median()
+    mae = metrics['mae'].unstack('method')
+    summary['best_mae'] = pd.Series({(country, method): int((mae.loc[country,method] < mae.loc[country].drop(method,axis=1).min(axis=1)).sum())
+                                     for country in mae.index.get_level_values('country').unique() for method in methods})
+    print(summary.to_string())
+
+def backtest(WRSI_data, admin1_units, workers):
+    start = time.perf_counter()
+    wrsi_years = gdhi_io.get_wrsi_years(WRSI_data)
+    print('Leave one year out backtest for ' + str(wrsi_years[0]) + ' - ' + str(wrsi_years[-1]))
+    country_rows = {'SO': so_rows(WRSI_data,wrsi_years), 'KE': ke_rows(WRSI_data,wrsi_years,admin1_units), 'ET': et_rows(WRSI_data,wrsi_years)}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tables = []
+        for country, (keys, series, series_years, wrsi) in country_rows.items():
+            print('Backtest ' + str(len(keys)) + ' production time series for ' + country)
+            tables.append(backtest_rows(executor,keys,series,series_years,wrsi,wrsi_years))
+    estimates = pd.concat(tables,ignore_index=True)
+    metrics = calc_metrics(estimates)
+    print_summary(metrics)
+    print('Backtest complete in ' + str(round(time.perf_counter() - start,3)) + ' seconds')
+    return estimates.set_index('fnid'), metrics.reset_index().set_index('fnid')
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the GDHI crop production estimate pipeline, runs on synthetic data so it does not need arcpy, the geodatabase, or the crop production files.
+
+    python gdhi_benchmark.py [--units 1000 10000 100000] [--years 25 60] [--engine vectorized] [--save_baseline] [--threshold 1.5]
+
+For each size (number of geographic units x number of WRSI years) the script generates WRSI tables for the six WRSI products, and crop production
+Excel files for Somalia, Kenya, and Ethiopia in the same format as the files downloaded from FDW (same sheets, columns, and product / season names).
+It then times each stage of the pipeline, starting with reading and cleaning the Excel files (the Excel cache is not used, so the workbook is parsed
+every time), and records its peak memory use. Units are split between Ethiopia, Somalia, Kenya, and Uganda.
+
+Each stage is timed --repeat times and the median time is used. Results are compared to the baseline saved in gdhi_benchmark_baseline.json (or the
+file set with --baseline). The script exits with an error if a stage takes longer, or uses more memory, than the baseline times the threshold and the
+difference is more than --min_seconds / --min_mb, so stages that only take a few milliseconds do not fail because of timing noise.
+
+The baseline in the repository was saved for the default size (1000 units x 25 years, vectorized engine). Times depend on the machine, so on a new
+machine (i.e: a CI runner) save a baseline first with --save_baseline, and compare later runs on the same machine to it.
+
+Run with --smoke to check the estimate scripts end to end instead of timing them:
+
+    python gdhi_benchmark.py --smoke [--units 1000] [--years 25]
+
+The synthetic crop production Excel files and WRSI tables (exported to csv, see --wrsi_table) are written to a temporary folder, and
+WRSI_Crop_Est_ET.py and WRSI_Crop_Est_UGSOKE.py are run on them twice (all years, then --incremental), the same way as from wrsi_batch_run.bat. The
+script exits with an error if a script fails, or a results workbook is not exported or is empty. The what-if response curves (see gdhi_scenario.py)
+are then calculated for the same data, and the what-if estimates for fractional WRSI values are compared with the Somalia and Kenya estimates for a year
+where every unit has that WRSI value. Run it before committing changes to the estimate
+scripts or gdhi_io.py, it does not need arcpy or the geodatabase.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import gdhi_io
+import gdhi_crosswalk
+import gdhi_scenario
+import WRSI_Crop_Est_ET as et_est
+import WRSI_Crop_Est_UGSOKE as ugsoke_est
+
+pd.options.mode.chained_assignment = None  # default='warn'
+
+parser = argparse.ArgumentParser(description='Benchmark the GDHI crop production estimate pipeline on synthetic data')
+parser.add_argument('--units',type=int,nargs='+',default=[1000])
+parser.add_argument('--years',type=int,nargs='+',default=[25]) #Number of WRSI years starting in 2001, at least 15 for the 2001 - 2015 baseline
+parser.add_argument('--engine',choices=['legacy','vectorized'],default='vectorized')
+parser.add_argument('--repeat',type=int,default=5) #Each stage is timed this many times and the median time is used
+parser.add_argument('--baseline',default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'gdhi_benchmark_baseline.json'))
+parser.add_argument('--save_baseline',action='store_true')
+#A stage fails if its time or peak memory is more than the baseline times the threshold, and more than min_seconds / min_mb above the baseline
+parser.add_argument('--threshold',type=float,default=1.5)
+parser.add_argument('--min_seconds',type=float,default=0.05)
+parser.add_argument('--min_mb',type=float,default=5)
+parser.add_argument('--seed',type=int,default=0)
+parser.add_argument('--smoke',action='store_true') #Run the estimate scripts end to end on synthetic Excel files instead of the benchmark
+
+#Share of units in each country
+country_share = {'ET':0.4,'SO':0.3,'KE':0.2,'UG':0.1}
+so_admin1 = ['Woqooyi Galbeed','Togdheer','Bay','Bakool','Gedo','Hiraan','Lower Juba','Middle Juba','Lower Shabelle','Middle Shabelle'] #Awdal is not used, units in Awdal are in the crosswalk
+et_admin1 = ['Amhara','Tigray','SNNPR','Oromia','Afar','Somali']
+et_regions = gdhi_crosswalk.read_regions()
+oromia_ag = et_regions.loc[(et_regions['admin1'] == 'Oromia') & (et_regions['region'] == 'AG'),'admin2'].tolist() #Agriculture zones in Oromia
+somali_sap = et_regions.loc[(et_regions['region'] == 'SAP') & (et_regions['admin3'] == ''),'admin2'].tolist() #Southern pastoral zones
+
+class synthetic_data():
+    def make_units(n_units):
+        #Admin unit attributes for each FNID, same columns as the WRSI feature classes
+        units = []
+        for country, share in country_share.items():
+            for i in range(max(int(n_units * share),1)):
+                if country == 'ET':
+                    admin1 = et_admin1[i % len(et_admin1)]
+                    if admin1 == 'Oromia':
+                        admin2 = oromia_ag[i % len(oromia_ag)]
+                    elif admin1 == 'Somali':
+                        admin2 = somali_sap[i % len(somali_sap)]
+                    else:
+                        admin2 = admin1 + ' Zone ' + str(i)
+                    units.append(['ET','Ethiopia',admin1,admin2])
+                elif country == 'SO':
+                    units.append(['SO','Somalia',so_admin1[i % len(so_admin1)],'District ' + str(i)])
+                elif country == 'KE':
+                    units.append(['KE','Kenya','County ' + str(i % max(n_units // 50,4)),'Subcounty ' + str(i)])
+                elif country == 'UG':
+                    units.append(['UG','Uganda','Karamoja','District ' + str(i)])
+        units = pd.DataFrame(units,columns=['COUNTRY','ADMIN0','ADMIN1','ADMIN2'])
+        units.insert(0,'OBJECTID',np.arange(1,len(units) + 1))
+        units['ADMIN3'] = ''
+        units['PCODE'] = ['P' + str(i) for i in range(len(units))]
+        units.index = pd.Index([country + str(i).zfill(10) for i, country in enumerate(units['COUNTRY'])],name='FNID')
+        return units
+
+    def make_wrsi_data(units, years, rng):
+        #WRSI tables for each product (FNID x WRSI_YYYY), WRSI is 0 - 100 with some missing values, same as the snapshot created by gdhi_io.get_wrsi_data
+        WRSI_data = {}
+        for product in gdhi_io.wrsi_products.values():
+            wrsi = rng.integers(0,101,(len(units),len(years))).astype('float32')
+            wrsi[rng.random(wrsi.shape) < 0.05] = np.nan
+            WRSI_data[product] = pd.concat([units,pd.DataFrame(wrsi,index=units.index,columns=['WRSI_' + str(year) for year in years])],axis=1)
+        return WRSI_data
+
+    def make_so_crop(units, years, rng):
+        #Somalia crop production data in the format of the SO_prod_FDW sheet, one row per unit, season, crop, and year. Some rows are off-season
+        #production, or were not collected.
+        so_units = units[units['COUNTRY'] == 'SO']
+        keys = pd.MultiIndex.from_product([so_units.index,['Gu','Deyr'],['Maize (Corn)','Sorghum','Cowpeas (Mixed)'],years],names=['fnid','season_name','product','year']).to_frame(index=False)
+        keys = keys[rng.random(len(keys)) > 0.2] #Some years have no data
+        keys['admin_1'] = so_units['ADMIN1'].reindex(keys['fnid']).to_numpy()
+        keys['admin_2'] = so_units['ADMIN2'].reindex(keys['fnid']).to_numpy()
+        keys['period_date'] = keys['year'].astype(str) + '-09-01'
+        keys['season_year'] = keys['season_name'] + ' ' + keys['year'].astype(str)
+        keys['season_name'] = np.where(rng.random(len(keys)) < 0.05,keys['season_name'] + ' off-season',keys['season_name'])
+        keys['value'] = rng.integers(0,20000,len(keys)).astype(float)
+        keys['crop_production_system'] = 'All (PS)'
+        keys['status'] = np.where(rng.random(len(keys)) < 0.05,'Not Collected','Collected')
+        return keys[ugsoke_est.so_crop_cols]
+
+    def make_ke_crop(units, years, rng):
+        #Kenya annual maize production for each Admin1 in the format of the KE_prod_FDW sheet. Before 2015 the data is reported in the admin_2 column.
+        admin1_units = sorted(units.loc[units['COUNTRY'] == 'KE','ADMIN1'].unique())
+        keys = pd.MultiIndex.from_product([admin1_units,years],names=['admin_1','year']).to_frame(index=False)
+        keys['admin_2'] = keys['admin_1']
+        keys['fnid'] = 'KE' + keys['admin_1'].str.replace(' ','')
+        keys['period_date'] = keys['year'].astype(str) + '-12-31'
+        keys['season_name'] = 'Annual'
+        keys['season_year'] = 'Annual ' + keys['year'].astype(str)
+        keys['value'] = rng.integers(0,50000,len(keys)).astype(float)
+        keys['product'] = 'Maize Grain (White)'
+        keys['status'] = 'Collected'
+        return keys[ugsoke_est.ke_crop_cols], admin1_units
+
+    def make_et_crop(units, years, rng):
+        #Ethiopia crop production data in the format of the FDW Excel file. Meher data for each Admin2, Belg data for each Admin1.
+        et_units = units[(units['COUNTRY'] == 'ET') & (~units['ADMIN1'].isin(['Afar','Somali']))]
+        meher = et_units[['ADMIN1','ADMIN2']].drop_duplicates().assign(SEASON='Meher')
+        belg = et_units[['ADMIN1']].drop_duplicates().assign(ADMIN2=lambda df: df['ADMIN1'],SEASON='Belg')
+        keys = pd.concat([meher,belg],ignore_index=True)
+        keys = keys.merge(pd.DataFrame({'PRODUCT':['Maize (Corn)','Sorghum','Wheat Grain','Mixed Teff']}),how='cross').merge(pd.DataFrame({'YEAR':years}),how='cross')
+        keys = keys[rng.random(len(keys)) > 0.2]
+        return pd.DataFrame({'country':'Ethiopia','fnid':'ET','country_code':'ET','admin_0':'Ethiopia','admin_1':keys['ADMIN1'],'admin_2':keys['ADMIN2'],
+                             'value':rng.integers(0,100000,len(keys)).astype(float),'product':keys['PRODUCT'],'season_name':keys['SEASON'],
+                             'season_year':keys['SEASON'] + ' ' + keys['YEAR'].astype(str)})
+
+    def write_crop_files(folder, units, years, rng):
+        #Write the crop production Excel files to a folder and point the estimate scripts at them, returns the Kenya Admin1 units
+        so_crop = synthetic_data.make_so_crop(units,years,rng)
+        ke_crop, admin1_units = synthetic_data.make_ke_crop(units,years,rng)
+        et_crop = synthetic_data.make_et_crop(units,years,rng)
+        ugsoke_est.so_crop_prod = os.path.join(folder,'SO_agprod_data.xlsx')
+        ugsoke_est.ke_crop_prod = os.path.join(folder,'KE_agprod_data.xlsx')
+        et_est.et_crop_prod = os.path.join(folder,'ET_agprod_data.xlsx')
+        so_crop.to_excel(ugsoke_est.so_crop_prod,sheet_name='SO_prod_FDW',index=False)
+        ke_crop.to_excel(ugsoke_est.ke_crop_prod,sheet_name='KE_prod_FDW',index=False)
+        et_crop.to_excel(et_est.et_crop_prod,index=False)
+        return admin1_units
+
+def run_stage(function, repeat):
+    #Time a stage (median of repeat runs) and measure peak memory in one extra run. Output printed by the stage is hidden.
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, {'seconds': float(np.median(seconds)), 'peak_mb': peak / 1024 ** 2}
+
+def run_benchmark(n_units, n_years, args):
+    rng = np.random.default_rng(args.seed)
+    years = list(range(2001,2001 + n_years))
+    print('Generate synthetic data for ' + str(n_units) + ' units and ' + str(n_years) + ' years')
+    units = synthetic_data.make_units(n_units)
+    WRSI_data = synthetic_data.make_wrsi_data(units,years,rng)
+    results = {}
+    gdhi_io.excel_cache = False #Parse the Excel files in every run
+    with tempfile.TemporaryDirectory() as folder:
+        admin1_units = synthetic_data.write_crop_files(folder,units,years,rng)
+        #Stages are run in pipeline order, each stage uses the output of the stages before it
+        so_crop_v1, results['so_read_clean'] = run_stage(ugsoke_est.so_crop_data.clean_so_data,args.repeat)
+        ke_crop, results['ke_read_clean'] = run_stage(lambda: ugsoke_est.ke_crop_data.clean_ke_data(admin1_units),args.repeat)
+        et_crop, results['et_read_clean'] = run_stage(et_est.et_crop_data.aggregate_data,args.repeat)
+    ranks, results['wrsi_rank'] = run_stage(lambda: ugsoke_est.wrsi_rank(WRSI_data,years,args.engine),args.repeat)
+    so_crop_final, results['so_crop_pivot'] = run_stage(lambda: ugsoke_est.pivot_clean_so_crop.filter_data(so_crop_v1),args.repeat)
+    so_est, results['calc_so_wrsi_prod_est'] = run_stage(lambda: ugsoke_est.calc_so_wrsi_prod_est(so_crop_final.copy(),ranks,years,args.engine),args.repeat)
+    so_results, results['transform_so_data'] = run_stage(lambda: ugsoke_est.transform_so_data(so_est,ugsoke_est.get_fnids(WRSI_data),years),args.repeat)
+    ke_results, results['calc_ke_wrsi_prod_est'] = run_stage(lambda: ugsoke_est.calc_ke_wrsi_prod_est(ke_crop,ranks,years,args.engine,admin1_units),args.repeat)
+    et_crop_stats, results['et_calc_min_max'] = run_stage(lambda: et_est.calc_min_max(et_crop),args.repeat)
+    admin2_crop = et_est.get_admin2_crop(WRSI_data)
+    regions, results['et_get_regions'] = run_stage(lambda: et_est.get_regions(WRSI_data),args.repeat)
+    region_fnids = regions.groupby(regions,observed=False).groups
+    et_results, results['et_get_data'] = run_stage(lambda: {region: et_est.prod_calc.get_data(region,WRSI_data,et_crop_stats,admin2_crop,region_fnids[region],years) for region in ['NAP','AG','SAP']},args.repeat)
+    return results
+
+def is_slower(value, base, threshold, tolerance):
+    return value > base * threshold and value - base > tolerance
+
+def compare_baseline(size, results, baseline, args):
+    #Print results for each stage next to the baseline, returns list of stages which are slower or use more memory than the baseline times the threshold
+    failed = []
+    print('{:<24}{:>12}{:>12}{:>14}{:>14}'.format('Stage','Seconds','Baseline','Peak MB','Baseline'))
+    for stage, result in results.items():
+        base = baseline.get(size,{}).get(stage)
+        print('{:<24}{:>12.4f}{:>12}{:>14.1f}{:>14}'.format(stage,result['seconds'],'-' if base is None else '{:.4f}'.format(base['seconds']),
+                                                            result['peak_mb'],'-' if base is None else '{:.1f}'.format(base['peak_mb'])))
+        if base is not None and (is_slower(result['seconds'],base['seconds'],args.threshold,args.min_seconds) or
+                                 is_slower(result['peak_mb'],base['peak_mb'],args.threshold,args.min_mb)):
+            failed.append(size + ' ' + stage)
+    return failed
+
+def write_wrsi_tables(folder, WRSI_data):
+    #Save the WRSI data of each product to csv, same tables as the WRSI feature classes exported from the geodatabase
+    os.makedirs(folder)
+    for code, product in gdhi_io.wrsi_products.items():
+        WRSI_data[product].to_csv(os.path.join(folder,'ea_wrsi_' + code + '.csv'))
+
+def check_exports(month_folder, names):
+    #Names of the results which were not exported to the month folder or have no rows
+    failed = []
+    for name in names:
+        path = os.path.join(month_folder,name + '.xlsx')
+        if not os.path.exists(path) or pd.read_excel(path).empty:
+            failed.append(name)
+    return failed
+
+def check_curves(wrsi_folder, wrsi_table, admin1_units, wrsi_values):
+    #Compare what-if estimates with the Somalia and Kenya estimates for a year (2100) where every unit has the same WRSI value in every product. Returns the
+    #WRSI values where the estimates do not match.
+    keys, curves, steps = gdhi_scenario.get_curves(wrsi_folder,wrsi_table,admin1_units)
+    WRSI_data = gdhi_io.get_wrsi_data(gdhi_io.get_wrsi_source(wrsi_folder,wrsi_table))
+    failed = []
+    for wrsi in wrsi_values:
+        WRSI_year = {product: df.assign(WRSI_2100=np.float32(wrsi)) for product, df in WRSI_data.items()} #float32 like the WRSI snapshot
+        ranks = ugsoke_est.wrsi_rank(WRSI_year,[2100],'vectorized')
+        results = {'SO': ugsoke_est.estimate_so(WRSI_year,ranks,[2100],'vectorized'), 'KE': ugsoke_est.estimate_ke(ranks,[2100],'vectorized',admin1_units)}
+        expected = []
+        for country, crops in {'SO': ugsoke_est.so_crops, 'KE': ['Maize','Sorghum']}.items():
+            for season, df in results[country].items():
+                for crop in crops:
+                    expected.append(pd.DataFrame({'fnid':df.index,'season':season,'crop':crop,'wrsi':wrsi,'expected':df['p2100_' + crop].to_numpy(dtype=float)}))
+        expected = pd.concat(expected,ignore_index=True)
+        if not np.allclose(gdhi_scenario.lookup(keys,curves,steps,expected),expected['expected'],rtol=1e-9,atol=0,equal_nan=True):
+            failed.append(wrsi)
+    return failed
+
+def run_smoke(args):
+    #Run WRSI_Crop_Est_ET.py and WRSI_Crop_Est_UGSOKE.py on synthetic Excel files and WRSI tables for the first size, all years and then incremental
+    rng = np.random.default_rng(args.seed)
+    years = list(range(2001,2001 + args.years[0]))
+    units = synthetic_data.make_units(args.units[0])
+    cwd = os.getcwd() #The scripts move into the export folder
+    with tempfile.TemporaryDirectory() as folder:
+        admin1_units = synthetic_data.write_crop_files(folder,units,years,rng)
+        WRSI_data = synthetic_data.make_wrsi_data(units,years,rng)
+        for df in WRSI_data.values(): #WRSI is a zonal mean, so real WRSI values are almost never whole numbers
+            wrsi_cols = [col for col in df.columns if col.startswith('WRSI_')]
+            df[wrsi_cols] = np.clip(df[wrsi_cols] + rng.random((len(df),len(wrsi_cols))).astype('float32'),0,100)
+        write_wrsi_tables(os.path.join(folder,'tables'),WRSI_data)
+        wrsi_folder = os.path.join(folder,'wrsi')
+        month_folder = os.path.join(wrsi_folder,str(years[-1]),'06')
+        os.makedirs(month_folder)
+        script_args = [wrsi_folder,str(years[-1]),'06','--wrsi_table',os.path.join(folder,'tables'),'--no_cache']
+        failed = []
+        try:
+            for run, options in {'all years': [], 'incremental': ['--incremental']}.items():
+                print('Smoke run of the estimate scripts (' + run + ') on ' + str(len(units)) + ' units and ' + str(len(years)) + ' years')
+                with contextlib.redirect_stdout(io.StringIO()):
+                    et_est.main(et_est.parser.parse_args(script_args + options))
+                    ugsoke_est.main(ugsoke_est.parser.parse_args(script_args + options + ['--ke_admin1'] + admin1_units))
+                failed = failed + check_exports(month_folder,list(et_est.result_names.values()) + ugsoke_est.result_names)
+            print('Compare what-if estimates with the Somalia and Kenya estimates')
+            so_wrsi = WRSI_data['MaizeL'].loc[WRSI_data['MaizeL']['COUNTRY'] == 'SO','WRSI_2005'].dropna()
+            wrsi_values = [37.3,37.5,62.2,float(so_wrsi.iloc[0])] #Last value is a baseline WRSI value of a Somalia unit
+            with contextlib.redirect_stdout(io.StringIO()):
+                failed = failed + ['what-if estimates at WRSI ' + str(wrsi) for wrsi in check_curves(wrsi_folder,os.path.join(folder,'tables'),admin1_units,wrsi_values)]
+        finally:
+            os.chdir(cwd)
+    if failed:
+        sys.exit('Smoke run failed, results not exported or empty, or not matching: ' + ', '.join(failed))
+    print('Smoke run Complete')
+
+def main(args):
+    if args.smoke:
+        run_smoke(args)
+        return
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    failed = []
+    for n_units in args.units:
+        for n_years in args.years:
+            size = str(n_units) + 'x' + str(n_years) + '_' + args.engine #Key in baseline file
+            results = run_benchmark(n_units,n_years,args)
+            failed = failed + compare_baseline(size,results,baseline,args)
+            baseline[size] = results
+    if args.save_baseline:
+        with open(args.baseline,'w') as f:
+            json.dump(baseline,f,indent=2)
+        print('Baseline saved to ' + args.baseline)
+    elif failed:
+        sys.exit('Stages slower or using more memory than baseline x ' + str(args.threshold) + ': ' + ', '.join(failed))
+    print('Benchmark Complete')
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Shared calculation functions for the GDHI crop production estimate scripts (WRSI_Crop_Est_UGSOKE.py and WRSI_Crop_Est_ET.py).
+
+The functions in this module work on whole numpy arrays (geographic units x years) instead of looping through rows of a dataframe, so that
+estimates for every unit and year can be calculated in a single pass.
+"""
+
+import numpy as np
+
+def quantile_map(series, quants):
+    #Calculate crop production estimates for a batch of production time series. series is a 2D array (rows x years of production data) and quants
+    #is a 2D array (rows x years to estimate) of WRSI percent ranks. Returns a 2D array (rows x years to estimate) with the same values as calling
+    #pandas Series.quantile(quant) (linear interpolation) on each row - NaNs in the production series are ignored and NaN quantiles return NaN.
+    values = np.sort(np.asarray(series, dtype=float), axis=1) #Sort each production time series once, NaNs are sorted to the end of each row
+    quants = np.asarray(quants, dtype=float)
+    count = (~np.isnan(values)).sum(axis=1)[:, np.newaxis] #Number of production data points in each row
+    last = np.maximum(count - 1, 0) #Position of the largest production value in each row
+    virtual = (count - 1) * np.where(np.isnan(quants), 0, quants) #Position of quantile in sorted time series, falls between two data points
+    previous = np.where(virtual >= count - 1, last, np.clip(np.floor(virtual), 0, last)) #If position is above last data point use the largest value
+    upper_index = np.minimum(previous + 1, last)
+    gamma = virtual - previous
+    lower = np.take_along_axis(values, previous.astype(np.intp), axis=1)
+    upper = np.take_along_axis(values, upper_index.astype(np.intp), axis=1)
+    diff = upper - lower
+    #Linear interpolation between the two closest data points, calculated the same way as numpy so that results match exactly
+    estimate = np.where(gamma >= 0.5, upper - diff * (1 - gamma), lower + diff * gamma)
+    estimate[np.isnan(quants) | np.broadcast_to(count == 0, estimate.shape)] = np.nan #If WRSI is nan or there is no production data set estimate to nan
+    return estimate
+
+def bootstrap_bands(series, quants, n_boot, percentiles, seed=0):
+    #Bootstrap percentile bands for quantile_map estimates. Each production series is resampled with replacement n_boot times (same number of data points as
+    #the series), the estimate for every resample is calculated in one call to quantile_map, and the percentiles are taken across the resamples.
+    #Returns a 3D array (rows x years to estimate x percentiles). seed can be an int or a numpy SeedSequence.
+    rng = np.random.default_rng(seed)
+    values = np.sort(np.asarray(series, dtype=float), axis=1) #Data points first, NaNs at the end of each row
+    quants = np.asarray(quants, dtype=float)
+    rows, length = values.shape
+    count = (~np.isnan(values)).sum(axis=1)[:, np.newaxis, np.newaxis]
+    draws = (rng.random((rows, n_boot, length)) * count).astype(np.intp) #Random data point for each position in each resample
+    resampled = np.take_along_axis(np.broadcast_to(values[:, np.newaxis, :], draws.shape), draws, axis=2)
+    resampled = np.where(np.arange(length) < count, resampled, np.nan) #Resample has the same number of data points as the series
+    estimates = quantile_map(resampled.reshape(rows * n_boot, length), np.repeat(quants, n_boot, axis=0)).reshape(rows, n_boot, -1)
+    return np.moveaxis(np.percentile(estimates, percentiles, axis=1), 0, -1) #Estimate is NaN for all resamples or none, so NaNs do not need to be ignored
+
+class rank_index():
+    #Sorted WRSI values for the frozen baseline period (2001 - 2015) for each geographic unit. Used to look up the percent rank of any WRSI value relative
+    #to the baseline, without re-ranking the whole baseline each time a new season is added.
+    def __init__(self, baseline):
+        self.baseline = np.asarray(baseline, dtype=float)
+        self.sorted = np.sort(self.baseline, axis=1) #NaNs are sorted to the end of each row
+        self.count = (~np.isnan(self.baseline)).sum(axis=1)[:, np.newaxis] #Number of baseline years with WRSI data for each unit
+
+    def search(self, values):
+        #Count the baseline values below and equal to each value (rows x years), same as searchsorted left position and right - left positions in each sorted row
+        values = np.asarray(values, dtype=float)
+        below = (self.sorted[:, np.newaxis, :] < values[:, :, np.newaxis]).sum(axis=2)
+        equal = (self.sorted[:, np.newaxis, :] == values[:, :, np.newaxis]).sum(axis=2)
+        return below, equal
+
+    def baseline_rank(self):
+        #Percent rank of each baseline year within the baseline, same as DataFrame.rank(axis=1, method='average', pct=True) on the baseline columns
+        below, equal = self.search(self.baseline)
+        pct = (below + (equal + 1) / 2) / np.maximum(self.count, 1) #Ties get the average of their ranks
+        pct[np.isnan(self.baseline)] = np.nan
+        return pct
+
+    def percent_rank(self, values):
+        #Percent rank of each value (rows x years) relative to the baseline plus that one value, same as ranking the baseline columns plus the year column
+        #with DataFrame.rank(axis=1, method='average', pct=True) and keeping the year column
+        values = np.asarray(values, dtype=float)
+        below, equal = self.search(values)
+        pct = (below + (equal + 2) / 2) / (self.count + 1) #Value ties with equal baseline values, so it shares the average of equal + 1 ranks
+        pct[np.isnan(values)] = np.nan
+        return pct
+
+def linear_scale(wrsi, crop_min, crop_diff, use_wrsi):
+    #Crop production estimates for a batch of units using linear scaling between minimum and maximum production. wrsi is a 2D array (units x years), crop_min
+    #and crop_diff are the minimum and max - min production for each unit, and use_wrsi marks units where the estimate is set to the WRSI value instead.
+    #If WRSI is 50 or less the estimate is the minimum production. WRSI is not converted to float64 before subtracting 50, same as the calculation in pandas.
+    wrsi = np.asarray(wrsi)
+    crop_min = np.asarray(crop_min, dtype=float)[:, np.newaxis]
+    crop_diff = np.asarray(crop_diff, dtype=float)[:, np.newaxis]
+    estimate = crop_min + crop_diff * (wrsi - 50) / 50 #Apply linear scalling formula
+    estimate = np.where(wrsi <= 50, crop_min, estimate) #If less than 50 set to minimum production
+    return np.where(np.asarray(use_wrsi, dtype=bool)[:, np.newaxis], wrsi, estimate)
+
+def crop_fallback(values, crops, fallbacks):
+    #Fill gaps in crop production estimates using estimates for other crops. values is a 3D array (units x years x crops), crops is the list of crop names
+    #in the order of the last axis, and fallbacks is a dictionary with the crops to use for each crop in priority order (i.e: {'Cowpeas':['Sorghum','Maize']}).
+    #Crops are filled in the order of the dictionary and a crop filled earlier can be used to fill a later crop, same as chaining fillna calls on each column.
+    values = np.array(values, dtype=float) #Copy, input array is not changed
+    for crop, fallback_crops in fallbacks.items():
+        target = values[:, :, crops.index(crop)] #View, filling target fills values
+        for fallback in fallback_crops:
+            missing = np.isnan(target)
+            target[missing] = values[:, :, crops.index(fallback)][missing]
+    return values
+
+def current_season_fill(values, average, current):
+    #Set estimates for the current season to the long term average where they are missing - WRSI has not started yet in areas where the season has not started.
+    #values is a 3D array (units x years x crops), average is a 2D array (units x crops), and current is a boolean list marking the current season in the years axis.
+    values = np.array(values, dtype=float)
+    season = values[:, np.asarray(current, dtype=bool), :]
+    season = np.where(np.isnan(season), np.asarray(average, dtype=float)[:, np.newaxis, :], season)
+    values[:, np.asarray(current, dtype=bool), :] = season
+    return values
+
+def get_rains_year(year_folder, month_folder):
+    #Year of the current rainy season. If January or February then in short rains season, rainy season year will be previous year.
+    if int(month_folder) in [1,2]:
+        return int(year_folder) - 1
+    return int(year_folder)
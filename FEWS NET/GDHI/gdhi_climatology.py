@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Dekadal WRSI climatology for each FNID, and the in-season standing of a new dekad compared to the climatology.
+
+For each WRSI product, FNID, and dekad of the rains year the WRSI values of the frozen 2001 - 2015 baseline (the same baseline used by wrsi_rank in
+WRSI_Crop_Est_UGSOKE.py) are read from the WRSI cube (see gdhi_cube.py), and the 10th, 25th, 50th, 75th and 90th percentiles are saved with the sorted
+baseline values to the climatology folder inside the cube. The climatology is calculated again when the baseline years in the cube change.
+
+The standing of a dekad is looked up for all FNIDs at once: the anomaly (WRSI minus the baseline median for that dekad), the percent rank against the
+baseline (calculated in the same way as the percent rank of a year after 2015 in wrsi_rank), and the percentile category (i.e: P10-P25 if the WRSI is
+between the 10th and 25th percentile). WRSI_Download_CHIRPS.py saves the standing of each dekad it processes to WRSI_dekad_standing in the month folder,
+so in-season standing is available right after the download, before the crop production estimates are run.
+
+The climatology needs dekadal WRSI for the baseline years in the cube, which can be added by running WRSI_Download_CHIRPS.py in backfill mode for 2001 - 2015.
+"""
+
+import os
+import json
+import warnings
+import numpy as np
+import pandas as pd
+import gdhi_calc
+import gdhi_cube
+import gdhi_io
+
+baseline_years = list(range(2001,2016))
+percentiles = [10,25,50,75,90]
+climatology_folder = 'climatology' #Folder inside the cube folder
+
+def get_categories(percentiles):
+    #Name of each percentile category, i.e: <P10, P10-P25, ..., >P90
+    names = ['P' + str(p) for p in percentiles]
+    return ['<' + names[0]] + [low + '-' + high for low, high in zip(names[:-1],names[1:])] + ['>' + names[-1]]
+
+def get_inputs(cube_folder, product):
+    #Baseline chunks the climatology is calculated from, saved with the climatology to check if it is up to date
+    paths = [gdhi_cube.chunk_path(cube_folder,product,year) for year in baseline_years]
+    return {'baseline': gdhi_io.file_fingerprint([path for path in paths if os.path.exists(path)]), 'percentiles': percentiles}
+
+def build_climatology(cube_folder, product):
+    #Sorted baseline WRSI (FNIDs x dekads x baseline years) and percentiles (FNIDs x dekads x percentiles) for each dekad of the rains year
+    baseline = gdhi_cube.get_dekads(cube_folder,product,baseline_years,dekads=range(gdhi_cube.n_dekads)).transpose(0,2,1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',category=RuntimeWarning) #Dekads outside the season have no baseline data
+        thresholds = np.nanpercentile(baseline,percentiles,axis=2).transpose(1,2,0).astype('float32')
+    return np.sort(baseline,axis=2), thresholds
+
+def get_climatology(cube_folder, product, rebuild=False):
+    #Load the climatology for a product (arrays are memory mapped), calculated and saved if it is missing or the baseline in the cube has changed
+    folder = os.path.join(cube_folder,climatology_folder,product)
+    manifest_path = os.path.join(folder,'manifest.json')
+    inputs = get_inputs(cube_folder,product)
+    if not rebuild and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == inputs:
+                return np.load(os.path.join(folder,'baseline.npy'),mmap_mode='r'), np.load(os.path.join(folder,'thresholds.npy'),mmap_mode='r')
+    print('Calculate dekadal WRSI climatology for ' + product)
+    baseline, thresholds = build_climatology(cube_folder,product)
+    os.makedirs(folder,exist_ok=True)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path) #Remove manifest first so a partly written climatology is never used
+    np.save(os.path.join(folder,'baseline.npy'),baseline)
+    np.save(os.path.join(folder,'thresholds.npy'),thresholds)
+    with open(manifest_path,'w') as f:
+        json.dump(inputs,f)
+    return baseline, thresholds
+
+def dekad_standing(cube_folder, product, year, month, dekad, wrsi=None):
+    #Standing of a dekad for each FNID compared to the climatology. wrsi is a Series of WRSI indexed by FNID, read from the cube if not set.
+    #Returns a df indexed by FNID with the WRSI, baseline median, anomaly, percent rank, and percentile category.
+    rains_year, index = gdhi_cube.get_dekad_index(product,year,month,dekad)
+    fnids = gdhi_cube.read_units(cube_folder).index
+    if wrsi is None:
+        values = gdhi_cube.get_dekads(cube_folder,product,[rains_year],dekads=[index])[:,0,0].astype(float)
+    else:
+        values = wrsi.reindex(fnids).to_numpy(dtype='float32').astype(float) #Same precision as the WRSI saved in the cube
+    baseline, thresholds = get_climatology(cube_folder,product)
+    baseline = np.asarray(baseline[:,index,:],dtype=float)
+    thresholds = np.asarray(thresholds[:,index,:],dtype=float)
+    has_baseline = ~np.isnan(baseline).all(axis=1)
+    category = (values[:,np.newaxis] >= thresholds).sum(axis=1) #Number of percentiles at or below the WRSI value
+    standing = pd.DataFrame({'product': product, 'rains_year': rains_year, 'month': month, 'dekad': dekad, 'wrsi': values,
+                             'median': thresholds[:,percentiles.index(50)] if 50 in percentiles else np.nanmedian(baseline,axis=1),
+                             'percent_rank': gdhi_calc.rank_index(baseline).percent_rank(values[:,np.newaxis])[:,0],
+                             'category': np.array(get_categories(percentiles),dtype=object)[category]},index=fnids)
+    standing['anomaly'] = standing['wrsi'] - standing['median']
+    standing.loc[np.isnan(values) | ~has_baseline,['percent_rank','category','anomaly']] = np.nan
+    return standing[['product','rains_year','month','dekad','wrsi','median','anomaly','percent_rank','category']]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Crosswalk between the admin units in the crop production data from FDW and the admin units (FNIDs) used in the GDHI, used by WRSI_Crop_Est_UGSOKE.py and
+WRSI_Crop_Est_ET.py. Special cases (boundary changes, units with a different FNID, and units which use crop production data from another unit) are listed
+in gdhi_crosswalk.csv, so new boundary changes can be added by editing the table.
+
+Each row in the table applies to rows of the data where field is equal to value, and has one of three actions:
+    set_fnid - set the FNID to target_fnid
+    set_admin_2 - set the Admin2 name used to join crop production data to target_admin_2, many units can be set to one name
+    copy - also use the crop production data for the unit as the data for target_fnid / target_admin_2, one unit can be copied to many units
+Rows with a season only apply to that season, rows without a season apply to all seasons.
+
+The rainfall pattern (Southern Agropastoral - SAP, Northern Agropastoral - NAP, or Agriculture - AG) of each admin unit in Ethiopia is listed in
+gdhi_et_regions.csv. Each row applies to units where ADMIN1, ADMIN2 and ADMIN3 match admin1, admin2 and admin3, a blank field matches any value, so a row
+can cover a whole region (Admin1), a zone (Admin2), or a woreda (Admin3).
+"""
+
+import os
+import functools
+import pandas as pd
+
+crosswalk_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'gdhi_crosswalk.csv')
+regions_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'gdhi_et_regions.csv')
+et_regions = ['SAP','NAP','AG']
+
+@functools.lru_cache()
+def read_crosswalk():
+    #Table is read once, and reused by every call below
+    return pd.read_csv(crosswalk_file,dtype=str,keep_default_na=False)
+
+def get_crosswalk(country, action):
+    crosswalk = read_crosswalk()
+    return crosswalk[(crosswalk['country'] == country) & (crosswalk['action'] == action)]
+
+def set_fnid(df, country, column='fnid'):
+    #Update FNIDs for units which have a different FNID in the crop production data
+    for row in get_crosswalk(country,'set_fnid').itertuples():
+        df.loc[df[row.field] == row.value, column] = row.target_fnid
+    return df
+
+def set_admin_2(df, country, column, season=None, season_col=None):
+    #Set Admin2 names used to join crop production data. New names are looked up by the value of the field in each row, groups of rows in the table are
+    #applied in order so later rows override earlier ones (i.e: all zones in Gambela are set to Gambela). Rows for one season are applied to rows of df with
+    #that season in season_col, or to all rows of df if season (the season of all data in df) matches.
+    for (field, row_season), rows in get_crosswalk(country,'set_admin_2').groupby(['field','season'],sort=False):
+        if row_season and season_col is None and row_season != season:
+            continue
+        lookup = rows.set_index('value')['target_admin_2']
+        match = df[field].isin(lookup.index)
+        if row_season and season_col is not None:
+            match = match & (df[season_col] == row_season)
+        df.loc[match, column] = df.loc[match, field].map(lookup)
+    return df
+
+def copy_units(df, country, keys, value_cols, fnid_col='fnid', admin_2_col='admin_2'):
+    #Add rows for units which use crop production data from another unit. Source rows are joined to the crosswalk on the field value, and the values are summed
+    #for each target unit and keys - same result as pivoting the source data with the FNID and Admin2 name of the target unit.
+    copies = []
+    for field, rows in get_crosswalk(country,'copy').groupby('field',sort=False):
+        source = df[df[field].isin(rows['value'])].merge(rows[['value','target_fnid','target_admin_2']],left_on=field,right_on='value')
+        copy = source.groupby(['target_fnid','target_admin_2'] + keys,sort=False)[value_cols].sum(min_count=1).reset_index()
+        copies.append(copy.rename(columns={'target_fnid':fnid_col,'target_admin_2':admin_2_col}))
+    return pd.concat([df] + copies,ignore_index=True)
+
+@functools.lru_cache()
+def read_regions():
+    return pd.read_csv(regions_file,dtype=str,keep_default_na=False)
+
+def get_regions(units):
+    #Rainfall pattern of each unit in units (df with ADMIN1, ADMIN2, and ADMIN3 columns), returned as a categorical series with the same index. Rows in the table
+    #are joined in groups with the same fields filled in, one join per group instead of one scan per row. If a unit matches rows in more than one group, the group
+    #which comes first in the table is used. Units which do not match any row are missing.
+    rules = read_regions()
+    fields = rules[['admin1','admin2','admin3']].ne('')
+    regions = pd.Series(pd.Categorical([None] * len(units),categories=et_regions),index=units.index)
+    for key, rows in rules.groupby([fields['admin1'],fields['admin2'],fields['admin3']],sort=False):
+        cols = [col for col, used in zip(['admin1','admin2','admin3'],key) if used]
+        rows = rows.drop_duplicates(cols)
+        lookup = pd.Series(rows['region'].to_numpy(),index=pd.MultiIndex.from_frame(rows[cols]))
+        match = lookup.reindex(pd.MultiIndex.from_frame(units[[col.upper() for col in cols]].astype(str),names=cols)).to_numpy()
+        missing = regions.isna().to_numpy() & pd.notna(match)
+        regions[missing] = match[missing]
+    return regions
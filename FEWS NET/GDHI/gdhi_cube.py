@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+WRSI cube - the WRSI of every FNID for each product, rains year, and dekad, saved in the GDHI_WRSI_Cube folder inside the WRSI folder.
+
+The WRSI feature classes only keep one WRSI_YYYY column for each year, which is overwritten by each run of WRSI_Download_CHIRPS.py, so only the last
+dekad of each season is kept. The cube keeps every dekad. WRSI_Download_CHIRPS.py appends the zonal statistics for each dekad it processes, and the
+cube is created from the WRSI tables (geodatabase or exported csv tables) the first time it is used, with the WRSI_YYYY columns of the tables saved as
+the end of season value for each year.
+
+The cube is saved in chunks, one .npy file (FNIDs x 43, float32) for each product and rains year (<product>/<year>.npy), which can be memory mapped so
+a product, season, or group of units can be read without reading the rest of the cube. The first 42 columns are the dekads of the rains year: dekads
+1 - 36 of the year, plus the six dekads of January and February of the next year which are part of the short rains season of the year (et, e1). The last
+column is the end of season value from the WRSI tables. cube.json lists the dekads saved for each product and year, and the FNIDs and admin unit attributes
+are saved in the units folder (same format as the WRSI snapshot).
+
+The cube can be used as the WRSI source of the crop production estimate scripts (--wrsi_table <wrsi_folder>/GDHI_WRSI_Cube). The WRSI_YYYY column of each
+year is the WRSI of the last dekad saved for the year, or the end of season value from the WRSI tables if no dekads have been saved.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import gdhi_io
+
+cube_folder = 'GDHI_WRSI_Cube' #Folder inside the WRSI folder
+n_dekads = 42 #Dekads in a rains year, including January and February of the next year for the short rains products
+eos_slot = 42 #Column with the end of season value from the WRSI tables
+#Dekads of each WRSI product's season (position in the rains year, see get_dekad_index), used to read the dekads of a season
+season_dekads = {'ee': range(6,33), 'el': range(9,33), 'ek': range(6,27), 'e2': range(6,21), 'e1': range(24,39), 'et': range(24,42)}
+
+def get_cube_folder(wrsi_folder, source):
+    #Cube folder inside the WRSI folder, the cube is created from the WRSI tables in source if it does not exist
+    folder = os.path.join(wrsi_folder,cube_folder)
+    if not gdhi_io.is_cube(folder):
+        create_cube(folder,source)
+    return folder
+
+def get_dekad_index(product, year, month, dekad):
+    #Rains year and position in the rains year of a dekad, the short rains products (et, e1) in January and February are part of the rains year before
+    #(same as gdhi_io.get_wrsi_column)
+    dekad_annual = (month - 1) * 3 + dekad
+    if product in ('et','e1') and month < 3:
+        return year - 1, 36 + dekad_annual - 1
+    return year, dekad_annual - 1
+
+def read_manifest(folder):
+    with open(os.path.join(folder,'cube.json')) as f:
+        return json.load(f)
+
+def save_manifest(folder, manifest):
+    #Written to a temporary file and renamed, so an interrupted run never leaves a partly written manifest
+    path = os.path.join(folder,'cube.json')
+    with open(path + '.tmp','w') as f:
+        json.dump(manifest,f)
+    os.replace(path + '.tmp',path)
+
+def read_units(folder):
+    return gdhi_io.load_columnar(os.path.join(folder,'units'))
+
+def chunk_path(folder, product, year):
+    return os.path.join(folder,product,str(year) + '.npy')
+
+def open_chunk(folder, product, year, n_units, mode='r'):
+    #Memory map the chunk for a product and rains year. In r+ mode the chunk is created (all missing) if it does not exist. Returns None if the chunk does
+    #not exist in r mode.
+    path = chunk_path(folder,product,year)
+    if os.path.exists(path):
+        return np.load(path,mmap_mode=mode)
+    if mode == 'r':
+        return None
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    chunk = np.lib.format.open_memmap(path,mode='w+',dtype='float32',shape=(n_units,n_dekads + 1))
+    chunk[:] = np.nan
+    return chunk
+
+def create_cube(folder, source):
+    #Create the cube from the WRSI tables in the geodatabase or a folder of exported csv tables, WRSI_YYYY columns are saved as the end of season value
+    print('Create WRSI cube from ' + source)
+    tables = {table[-2:]: gdhi_io.read_wrsi_table(source,table) for table in gdhi_io.list_wrsi_tables(source)}
+    units = next(iter(tables.values()))
+    units = units[[col for col in units.columns if not col.startswith('WRSI_')]]
+    manifest = {'dekads': {}, 'imported': {}}
+    for product, df in tables.items():
+        df = df.reindex(units.index)
+        years = [int(col[5:]) for col in df.columns if col.startswith('WRSI_')]
+        for year in years:
+            chunk = open_chunk(folder,product,year,len(units),'r+')
+            chunk[:,eos_slot] = df['WRSI_' + str(year)].to_numpy(dtype='float32')
+            chunk.flush()
+        manifest['dekads'][product] = {}
+        manifest['imported'][product] = sorted(years)
+    gdhi_io.save_columnar(units,os.path.join(folder,'units'),None)
+    save_manifest(folder,manifest) #Saved last, marks the cube as complete
+
+def append_dekads(folder, results):
+    #Save zonal statistics to the cube. results is a list of (product, year, month, dekad, Series of WRSI indexed by FNID). Each chunk is opened once
+    #and the manifest is saved once at the end.
+    manifest = read_manifest(folder)
+    fnids = read_units(folder).index
+    chunks = {}
+    for product, year, month, dekad, mean in results:
+        rains_year, index = get_dekad_index(product,year,month,dekad)
+        if (product, rains_year) not in chunks:
+            chunks[(product, rains_year)] = open_chunk(folder,product,rains_year,len(fnids),'r+')
+        chunks[(product, rains_year)][:,index] = mean.reindex(fnids).to_numpy(dtype='float32')
+        missing = len(mean.index.difference(fnids))
+        if missing:
+            print(str(missing) + ' FNIDs are not in the WRSI cube and are not saved')
+        saved = manifest['dekads'].setdefault(product,{}).setdefault(str(rains_year),[])
+        manifest['dekads'][product][str(rains_year)] = sorted(set(saved) | {index})
+    for chunk in chunks.values():
+        chunk.flush()
+    save_manifest(folder,manifest)
+
+def get_years(manifest, product):
+    #Rains years with data for a product
+    return sorted(set(manifest['imported'].get(product,[])) | {int(year) for year, dekads in manifest['dekads'].get(product,{}).items() if dekads})
+
+def get_dekads(folder, product, years, fnids=None, dekads=None):
+    #WRSI for each FNID, year and dekad of a product (FNIDs x years x dekads). dekads is a list of positions in the rains year (default is the product's
+    #season, see season_dekads), fnids is a list of FNIDs (default all FNIDs). Only the rows and columns needed are read from each chunk.
+    units = read_units(folder).index
+    rows = np.arange(len(units)) if fnids is None else units.get_indexer(fnids)
+    dekads = list(season_dekads[product] if dekads is None else dekads)
+    values = np.full((len(rows),len(years),len(dekads)),np.nan,dtype='float32')
+    for i, year in enumerate(years):
+        chunk = open_chunk(folder,product,year,len(units))
+        if chunk is not None:
+            values[rows >= 0,i] = chunk[rows[rows >= 0]][:,dekads]
+    return values
+
+def get_end_of_season(folder, manifest, product, year, n_units):
+    #WRSI of the last dekad saved for the year, or the end of season value from the WRSI tables if no dekads have been saved
+    chunk = open_chunk(folder,product,year,n_units)
+    if chunk is None:
+        return np.full(n_units,np.nan,dtype='float32')
+    dekads = manifest['dekads'].get(product,{}).get(str(year),[])
+    return np.array(chunk[:,max(dekads) if dekads else eos_slot])
+
+def list_tables(folder):
+    manifest = read_manifest(folder)
+    return sorted('ea_wrsi_' + product for product in set(manifest['imported']) | set(manifest['dekads']))
+
+def read_table(folder, table):
+    #WRSI table for a product in the same format as gdhi_io.read_wrsi_table, admin unit attributes and a WRSI_YYYY column for each year in the cube
+    manifest = read_manifest(folder)
+    product = table[-2:]
+    units = read_units(folder)
+    wrsi = pd.DataFrame({'WRSI_' + str(year): get_end_of_season(folder,manifest,product,year,len(units)) for year in get_years(manifest,product)},index=units.index)
+    return pd.concat([units,wrsi],axis=1)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Download WRSI zip files from the USGS website for WRSI_Download_CHIRPS.py.
+
+Files are named w<YYYY><DD><product>.zip, where DD is the dekad of the year (01 - 36), and are in the east<letter> folder for each product on the USGS
+website (i.e: ee files are in easte). The source can be the USGS website or a local folder with the same layout (a mirror), which can be used for testing
+or when the files have already been copied from the website.
+
+Many files can be downloaded at once (backfill) on a pooled HTTP session with a bounded number of downloads running at the same time. Failed downloads are
+retried with an increasing wait between attempts. Each file is downloaded to <file>.part and renamed when complete, so an interrupted download is resumed
+from the end of the .part file on the next run. Files already in the download folder are skipped if their size matches the source (or, with
+verify='checksum', their SHA-256 hash matches the hash recorded when the file was downloaded). Hashes are saved in download_manifest.json in the download
+folder.
+
+list_source lists the WRSI zip files available for a product (from the directory listing on the USGS website, or the product folder in a mirror), which is
+used by the watch mode of WRSI_Download_CHIRPS.py (see gdhi_watch.py) to find new files.
+"""
+
+import os
+import re
+import json
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import gdhi_io
+
+baseurl = r'https://edcftp.cr.usgs.gov/project/fews/africa/east/dekadal/wrsi-chirps-etos' #url to USGS website where data can be downloaded
+manifest_name = 'download_manifest.json'
+chunk_size = 1024 * 1024 #Downloads are written to disk in 1 MB chunks
+retry_status = (429, 500, 502, 503, 504) #Status codes for which a download is retried
+zip_pattern = r'w(\d{4})(\d{2})(e[a-z0-9])\.zip' #WRSI zip file name, w<YYYY><DD><product>.zip
+
+def parse_file(file_download):
+    #Split a product_year_month_dekad string (i.e: ee_2023_6_3) into the product code, year, month, and dekad of the month
+    file_split = file_download.split('_')
+    return file_split[0], int(file_split[1]), int(file_split[2]), int(file_split[3])
+
+def set_dekad(month, dekad):
+    #Convert dekad of month to dekad on an annual 1-36 scale, file name on USGS website is in a 1-36 format, with values 1 through 9 written as 01,02, etc.
+    return str((month - 1) * 3 + dekad).zfill(2)
+
+def zip_name(product, year, month, dekad):
+    return 'w' + str(year) + set_dekad(month,dekad) + product + '.zip'
+
+def parse_zip_name(zipfilename):
+    #Convert a WRSI zip file name (i.e: w202318ee.zip) to a product_year_month_dekad string (i.e: ee_2023_6_3), None if it is not a WRSI zip file
+    match = re.fullmatch(zip_pattern,zipfilename)
+    if match is None:
+        return None
+    dekad_annual = int(match.group(2))
+    return match.group(3) + '_' + match.group(1) + '_' + str((dekad_annual - 1) // 3 + 1) + '_' + str((dekad_annual - 1) % 3 + 1)
+
+def dekad_range(start, end):
+    #List of (year, month, dekad) from start to end (inclusive), start and end are year_month_dekad strings (i.e: 2023_1_1)
+    start_year, start_month, start_dekad = [int(x) for x in start.split('_')]
+    end_year, end_month, end_dekad = [int(x) for x in end.split('_')]
+    first = start_year * 36 + (start_month - 1) * 3 + start_dekad - 1
+    last = end_year * 36 + (end_month - 1) * 3 + end_dekad - 1
+    return [(i // 36, i % 36 // 3 + 1, i % 3 + 1) for i in range(first,last + 1)]
+
+def backfill_files(products, start, end):
+    #product_year_month_dekad strings for each product and dekad in the range
+    return [product + '_' + str(year) + '_' + str(month) + '_' + str(dekad) for year, month, dekad in dekad_range(start,end) for product in products]
+
+def is_mirror(source):
+    return not source.lower().startswith(('http://','https://'))
+
+def source_path(source, product, zipfilename):
+    #url (or path in the local mirror) of a WRSI zip file
+    if is_mirror(source):
+        return os.path.join(source,'east' + product[1],zipfilename)
+    return source.rstrip('/') + '/east' + product[1] + '/' + zipfilename
+
+def list_source(session, source, product):
+    #Names of the WRSI zip files for a product at the source, from the product folder in the local mirror or the directory listing on the USGS website
+    folder = source_path(source,product,'')
+    if is_mirror(source):
+        return sorted(name for name in os.listdir(folder) if re.fullmatch(zip_pattern,name)) if os.path.isdir(folder) else []
+    response = session.get(folder,timeout=60)
+    if response.status_code == 404:
+        return []
+    response.raise_for_status()
+    return sorted({match.group(1) for match in re.finditer(r'href="(?:[^"]*/)?(' + zip_pattern + ')"',response.text)})
+
+def get_session(workers):
+    #HTTP session shared by all downloads, the connection pool is as large as the number of downloads running at once so connections are reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1,pool_maxsize=workers)
+    session.mount('https://',adapter)
+    session.mount('http://',adapter)
+    return session
+
+def read_manifest(folder):
+    path = os.path.join(folder,manifest_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(folder, manifest):
+    #Written to a temporary file and renamed, so an interrupted run never leaves a partly written manifest
+    path = os.path.join(folder,manifest_name)
+    with open(path + '.tmp','w') as f:
+        json.dump(manifest,f,indent=1)
+    os.replace(path + '.tmp',path)
+
+def source_size(session, path):
+    #Size of the file at the source in bytes, None if the server does not report it. Raises FileNotFoundError if the file is not available.
+    if is_mirror(path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return os.path.getsize(path)
+    response = session.head(path,allow_redirects=True,timeout=60)
+    if response.status_code == 404:
+        raise FileNotFoundError(path)
+    response.raise_for_status()
+    return int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+
+def is_complete(path, size, entry, verify):
+    #Check if a file already in the download folder matches the source, by size or by the hash recorded when it was downloaded
+    if not os.path.exists(path):
+        return False
+    if verify == 'checksum':
+        return entry is not None and entry['size'] == os.path.getsize(path) and entry['sha256'] == gdhi_io.file_hash(path)
+    return size is not None and size == os.path.getsize(path)
+
+def copy_part(session, path, part_path):
+    #Copy the source file to the .part file in chunks, starting from the end of the .part file if part of the file was downloaded by an earlier run
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if is_mirror(path):
+        with open(path,'rb') as source, open(part_path,'ab') as f:
+            source.seek(offset)
+            shutil.copyfileobj(source,f,chunk_size)
+        return
+    headers = {'Range': 'bytes=' + str(offset) + '-'} if offset else {}
+    with session.get(path,headers=headers,stream=True,timeout=60) as response:
+        if response.status_code == 404:
+            raise FileNotFoundError(path)
+        if response.status_code == 416: #.part file is already the full file
+            return
+        response.raise_for_status()
+        with open(part_path,'ab' if response.status_code == 206 else 'wb') as f: #Server sends the whole file (200) if it does not support resuming
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+
+def download_file(session, source, file_download, folder, manifest, verify='size', retries=5, backoff=2.0):
+    #Download one WRSI zip file to the download folder. Returns the file name, status (skipped, downloaded, or missing), and the manifest entry for the file.
+    product, year, month, dekad = parse_file(file_download)
+    zipfilename = zip_name(product,year,month,dekad)
+    path = source_path(source,product,zipfilename)
+    local_path = os.path.join(folder,zipfilename)
+    part_path = local_path + '.part'
+    for attempt in range(retries + 1):
+        try:
+            size = source_size(session,path)
+            if is_complete(local_path,size,manifest.get(zipfilename),verify):
+                return zipfilename, 'skipped', manifest[zipfilename] if zipfilename in manifest else None
+            copy_part(session,path,part_path)
+            if size is not None and os.path.getsize(part_path) != size:
+                os.remove(part_path) #Size does not match the source, start again from the beginning on the next attempt
+                raise IOError(zipfilename + ' size does not match the source')
+            os.replace(part_path,local_path)
+            return zipfilename, 'downloaded', {'size': os.path.getsize(local_path), 'sha256': gdhi_io.file_hash(local_path)}
+        except FileNotFoundError:
+            return zipfilename, 'missing', None
+        except (requests.RequestException, IOError) as error:
+            status = error.response.status_code if isinstance(error,requests.HTTPError) else None
+            if attempt == retries or (status is not None and status not in retry_status):
+                raise
+            wait = backoff * 2 ** attempt
+            print('Download of ' + zipfilename + ' failed (' + str(error) + '), retry in ' + str(wait) + ' seconds\n',end='') #One write, downloads run in several threads
+            time.sleep(wait)
+
+def download_files(files, folder, source=baseurl, workers=4, verify='size', retries=5, backoff=2.0):
+    #Download a list of product_year_month_dekad files to the download folder, at most workers files at a time. Returns the status of each file (skipped,
+    #downloaded, missing, or failed) in the same order as the list. The manifest is saved after each file so completed downloads are not repeated if the run is interrupted.
+    os.makedirs(folder,exist_ok=True)
+    manifest = read_manifest(folder)
+    statuses = {}
+    with get_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {file_download: executor.submit(download_file,session,source,file_download,folder,dict(manifest),verify,retries,backoff) for file_download in files}
+        for file_download, future in futures.items():
+            try:
+                zipfilename, status, entry = future.result()
+            except (requests.RequestException, IOError) as error: #Out of retries, the file is downloaded again on the next run
+                zipfilename, status, entry = file_download, 'failed', None
+                print(file_download + ' download failed: ' + str(error))
+            print(zipfilename + ': ' + status)
+            statuses[file_download] = status
+            if entry is not None:
+                manifest[zipfilename] = entry
+                save_manifest(folder,manifest)
+    return statuses
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Shared functions for reading and saving data used by the GDHI crop production estimate scripts (WRSI_Crop_Est_UGSOKE.py and WRSI_Crop_Est_ET.py).
+
+WRSI data is read from the ea_wrsi_<product> feature classes in GDHI_Admin_Units.gdb (attribute columns only, geometry is not read), or from a folder
+of the same tables exported to csv so that the scripts can be run without ArcGIS, or from the WRSI cube (see gdhi_cube.py). The WRSI data is saved to a snapshot folder next to the geodatabase
+(one .npy file per column, WRSI columns stored as float32) which is reused by later runs until the geodatabase or exported tables change. The worker
+processes started by gdhi.py memory map the snapshot instead of reading the WRSI data again. WRSI_Download_CHIRPS.py writes the zonal statistics for
+all downloaded dekads to the same tables with write_wrsi_columns, one write for each product, and WRSI columns are saved as DOUBLE fields.
+
+float32 keeps about seven significant digits of the WRSI zonal means, and the estimates are calculated from the float32 values, so results differ slightly
+from results exported before the snapshot was added (when WRSI was read as float64) if the WRSI values have many decimals: Ethiopia estimates by up to
+about 0.01 (linear scaling), and Uganda values (the WRSI) by about 1e-5. Somalia and Kenya estimates only change if two WRSI values of a unit are closer
+than float32 precision, as the percent rank only depends on the order of the WRSI values.
+
+Crop production Excel files are read with read_excel_cached, which saves the columns used by the scripts to a cache folder next to the Excel file in the same
+format as the WRSI snapshot. Later runs memory map the cached copy instead of parsing the workbook, until the contents of the Excel file change.
+
+Results from each run are saved in the GDHI_Estimates folder inside the WRSI folder, before averages and fallback logic are applied. When the scripts
+are run in incremental mode only the current rains year is recalculated and merged into the results saved from the last run. The results are saved with
+a fingerprint of the crop production files and a hash of the WRSI data for every year except the current rains year, so all years are recalculated if
+the crop production data or the WRSI data for earlier years (i.e: after a backfill) has changed since the last run.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+results_folder = 'GDHI_Estimates' #Folder inside the WRSI folder where results from the last run are saved
+
+#WRSI Product codes used by USGS, and name of product used in GDHI scripts. Product code is the last two letters of the feature class name (i.e: ea_wrsi_ee)
+wrsi_products = {'ee':'MaizeL','el':'GrainsL','ek':'GrainsB','e2':'RangeL','e1':'RangeS','et':'MaizeS'}
+
+excel_cache = True #Read Excel files from the cached copy, set to False by the --no_cache option of the scripts to always read the Excel files
+
+def get_product(product):
+    return wrsi_products[product]
+
+def list_files(folder):
+    #List all files in a folder and its subfolders, a file geodatabase is a folder of files. Lock files are skipped, ArcGIS creates them when the geodatabase is open.
+    return sorted(os.path.join(root, name) for root, dirs, names in os.walk(folder) for name in names if not name.endswith('.lock'))
+
+def save_columnar(df, folder, inputs):
+    #Save a df as a folder with one .npy file per column, plus a manifest with the column names and the input files the data was created from.
+    #Numeric columns can be memory mapped when read back, text columns are saved as object arrays.
+    os.makedirs(folder, exist_ok=True)
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path) #Remove manifest first so a partly written snapshot is never used
+    columns = []
+    for i, (col, values) in enumerate([(df.index.name, df.index)] + list(df.items())):
+        values = np.asarray(values)
+        np.save(os.path.join(folder, str(i) + '.npy'), values, allow_pickle=values.dtype == object)
+        columns.append({'name': col, 'file': str(i) + '.npy', 'object': bool(values.dtype == object)})
+    with open(manifest_path, 'w') as f:
+        json.dump({'columns': columns, 'inputs': inputs}, f)
+
+def load_columnar(folder, inputs=None):
+    #Read a df saved with save_columnar, numeric columns are memory mapped. Returns None if there is no saved data or it was created from different input files.
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if inputs is not None and manifest['inputs'] != inputs:
+        return None
+    data = {}
+    for col in manifest['columns']:
+        path = os.path.join(folder, col['file'])
+        data[col['name']] = np.load(path, allow_pickle=True) if col['object'] else np.load(path, mmap_mode='r')
+    index_name = manifest['columns'][0]['name']
+    index = pd.Index(data.pop(index_name), dtype=object if manifest['columns'][0]['object'] else None, name=index_name)
+    #Text columns are kept as object columns, same as when the data is read from the geodatabase
+    return pd.DataFrame({name: pd.Series(values, index=index, dtype=object if values.dtype == object else None) for name, values in data.items()}, index=index)
+
+def file_hash(path):
+    #SHA-256 hash of the contents of a file, read in blocks so large files are not loaded into memory
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def read_excel_cached(path, sheet_name=0, usecols=None):
+    #Read a sheet of an Excel file into a df. The first time a sheet / set of columns is read, a columnar copy is saved to <Excel file name>_cache, with one
+    #folder for each sheet and set of columns. Later runs memory map the copy instead of parsing the workbook. The copy is replaced if the file contents change.
+    if not excel_cache:
+        return pd.read_excel(path, sheet_name=sheet_name, usecols=usecols)
+    inputs = {'sha256': file_hash(path), 'sheet': sheet_name, 'columns': usecols}
+    key = hashlib.sha256(json.dumps([sheet_name, usecols]).encode()).hexdigest()[:16]
+    folder = os.path.join(os.path.splitext(path)[0] + '_cache', key)
+    df = load_columnar(folder, inputs)
+    if df is None:
+        print('Excel cache is missing or out of date, read ' + path)
+        df = pd.read_excel(path, sheet_name=sheet_name, usecols=usecols)
+        save_columnar(df, folder, inputs)
+    return df
+
+def get_wrsi_years(WRSI_data):
+    #Get sorted list of years with WRSI data, based on the WRSI_YYYY columns in the WRSI data for each product
+    years = set()
+    for df in WRSI_data.values():
+        years.update(int(col[5:]) for col in df.columns if col.startswith('WRSI_'))
+    return sorted(years)
+
+def is_cube(source):
+    #Check if a WRSI source is a WRSI cube folder
+    return os.path.exists(os.path.join(source, 'cube.json'))
+
+def list_wrsi_tables(source):
+    #List the WRSI feature classes in the geodatabase, or the exported csv tables in a folder. All tables except the admin unit polygons contain WRSI data.
+    #source can also be a WRSI cube (see gdhi_cube.py).
+    if is_cube(source):
+        import gdhi_cube
+        return gdhi_cube.list_tables(source)
+    if source.lower().endswith('.gdb'):
+        import arcpy #arcpy is only needed when reading WRSI data from the geodatabase
+        arcpy.env.workspace = source
+        tables = arcpy.ListFeatureClasses()
+    else:
+        tables = [os.path.splitext(name)[0] for name in os.listdir(source) if name.lower().endswith('.csv')]
+    return sorted(table for table in tables if table != 'EA_GDHI_Admin_Units')
+
+def read_wrsi_table(source, table):
+    #Read the attribute columns of a WRSI feature class (geometry is not read) or exported csv table into a df
+    if is_cube(source):
+        import gdhi_cube #WRSI columns from the cube are already float32
+        return gdhi_cube.read_table(source, table)
+    if source.lower().endswith('.gdb'):
+        import arcpy
+        fc_path = os.path.join(source, table)
+        fields = [field.name for field in arcpy.ListFields(fc_path) if field.type not in ('Geometry','Raster','Blob')]
+        with arcpy.da.SearchCursor(fc_path, fields) as cursor:
+            df = pd.DataFrame.from_records(list(cursor), columns=fields)
+    else:
+        df = pd.read_csv(os.path.join(source, table + '.csv'), dtype=object) #Read as text like the feature class attributes, WRSI columns are converted below
+    df.set_index('FNID', inplace=True) #Make FNID the Index
+    for col in [col for col in df.columns if col.startswith('WRSI_')]: #Some year columns are stored as text in the feature classes
+        df[col] = pd.to_numeric(df[col], errors='coerce').astype('float32')
+    return df
+
+def get_wrsi_column(product, year, month):
+    #WRSI_YYYY column updated by a dekad of a WRSI product. Columns are dated by year of rains, so for the short rains products (et, e1) in January
+    #and February one is subtracted from the year.
+    if product in ('et','e1') and month < 3:
+        return 'WRSI_' + str(year - 1)
+    return 'WRSI_' + str(year)
+
+def write_wrsi_columns(source, product, columns):
+    #Update WRSI columns of the ea_wrsi_<product> feature class (or exported csv table) in one pass. columns is a dictionary of column name and Series of WRSI
+    #values indexed by FNID, FNIDs not in the Series are set to missing. Columns are saved as DOUBLE fields, columns stored as text are replaced.
+    table = 'ea_wrsi_' + product
+    if source.lower().endswith('.gdb'):
+        import arcpy
+        fc_path = os.path.join(source, table)
+        field_types = {field.name: field.type for field in arcpy.ListFields(fc_path)}
+        for col in columns:
+            if col in field_types and field_types[col] not in ('Double','Single'):
+                arcpy.management.DeleteField(fc_path, col) #All values in the column are replaced below, so the text column is not copied
+            if field_types.get(col) not in ('Double','Single'):
+                arcpy.management.AddField(fc_path, col, 'DOUBLE')
+        values = [col_values.to_dict() for col_values in columns.values()]
+        with arcpy.da.UpdateCursor(fc_path, ['FNID'] + list(columns)) as cursor:
+            for row in cursor:
+                cursor.updateRow([row[0]] + [None if pd.isna(col_values.get(row[0])) else float(col_values[row[0]]) for col_values in values])
+    else:
+        path = os.path.join(source, table + '.csv')
+        df = pd.read_csv(path, dtype=object)
+        for col, col_values in columns.items():
+            df[col] = col_values.reindex(df['FNID']).to_numpy(dtype=float)
+        df.to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path) #Written to a temporary file first so the table is not left partly written
+    print('Updated ' + ', '.join(columns) + ' in ' + table)
+
+def get_wrsi_source(wrsi_folder, wrsi_table=None):
+    #Read WRSI data from geodatabase unless a folder of exported tables is specified
+    return (wrsi_table if wrsi_table else os.path.join(wrsi_folder,'GDHI_Admin_Units.gdb')).rstrip('/\\')
+
+def get_snapshot_inputs(source):
+    #Snapshot folder for a WRSI source, and fingerprint of the source files used to check if the snapshot is up to date
+    snapshot_folder = os.path.splitext(source)[0] + '_snapshot'
+    inputs = file_fingerprint(list_files(source)) if os.path.isdir(source) else file_fingerprint([source])
+    return snapshot_folder, inputs
+
+def load_wrsi_snapshot(source):
+    #Read WRSI data for each product from the snapshot, numeric columns are memory mapped so processes reading the same snapshot share the data.
+    #Returns None if there is no snapshot or the source has changed since it was created.
+    snapshot_folder, inputs = get_snapshot_inputs(source)
+    tables = load_columnar(os.path.join(snapshot_folder, 'tables'), inputs)
+    if tables is None:
+        return None
+    return {get_product(table[-2:]): load_columnar(os.path.join(snapshot_folder, table)) for table in tables['table']}
+
+def get_wrsi_data(source):
+    #Import WRSI data for each product into a dictionary of pandas dfs. Key in dictionary is the WRSI Product name, value is the df containing the data.
+    #source is the path to GDHI_Admin_Units.gdb or a folder of exported csv tables. Data is read from the snapshot if the source has not changed since it was created.
+    print('Read WRSI Data')
+    source = source.rstrip('/\\')
+    WRSI_data = load_wrsi_snapshot(source)
+    if WRSI_data is not None:
+        return WRSI_data
+    print('WRSI snapshot is missing or out of date, read WRSI data from ' + source)
+    snapshot_folder, inputs = get_snapshot_inputs(source)
+    WRSI_data = {}
+    table_list = list_wrsi_tables(source)
+    for table in table_list:
+        df = read_wrsi_table(source, table)
+        save_columnar(df, os.path.join(snapshot_folder, table), inputs)
+        WRSI_data[get_product(table[-2:])] = df
+    save_columnar(pd.DataFrame({'table': table_list}, index=pd.Index(range(len(table_list)), name='id')), os.path.join(snapshot_folder, 'tables'), inputs) #Saved last, marks snapshot as complete
+    return WRSI_data
+
+def file_fingerprint(paths):
+    #Name, size, and modified time of input files. Saved with the results so the incremental mode can tell if crop production data changed since the last run.
+    return [[os.path.basename(path), os.path.getsize(path), os.path.getmtime(path)] for path in paths]
+
+def get_wrsi_inputs(WRSI_data, rains_year):
+    #Hash of the WRSI data for every year except the current rains year, the current rains year is updated by every run of WRSI_Download_CHIRPS.py
+    digest = hashlib.sha256()
+    for product in sorted(WRSI_data):
+        df = WRSI_data[product]
+        wrsi_cols = [col for col in df.columns if col.startswith('WRSI_') and col != 'WRSI_' + str(rains_year)]
+        digest.update(json.dumps([product, df.index.astype(str).tolist(), wrsi_cols]).encode())
+        digest.update(np.ascontiguousarray(df[wrsi_cols].to_numpy(dtype='float32')).tobytes())
+    return digest.hexdigest()
+
+def load_previous_results(wrsi_folder, name, inputs):
+    #Load results saved by the last run. Returns None if there are no saved results or input files have changed since the last run, in which case all years need to be calculated.
+    path = os.path.join(wrsi_folder, results_folder, name + '.pkl')
+    if not os.path.exists(path):
+        print('No saved results found for ' + name + ', calculate all years')
+        return None
+    saved = pd.read_pickle(path)
+    if saved['inputs'] != inputs:
+        print('Crop production data or WRSI data for earlier years has changed since the last run, calculate all years for ' + name)
+        return None
+    return saved['results']
+
+def save_results(wrsi_folder, name, results, inputs):
+    #Save results so that the next run in incremental mode only needs to calculate the current rains year
+    os.makedirs(os.path.join(wrsi_folder, results_folder), exist_ok=True)
+    pd.to_pickle({'results': results, 'inputs': inputs}, os.path.join(wrsi_folder, results_folder, name + '.pkl'))
+
+def write_excel(df, path):
+    #Write a df to Excel, same layout as DataFrame.to_excel (index in first column, bold header, blank cells for missing data). Uses xlsxwriter constant
+    #memory mode and writes one row at a time, each row is written to the file before the next one so the whole workbook is not kept in memory.
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Sheet1')
+    worksheet.set_column(0, 120, 15)
+    header = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    worksheet.write_row(0, 0, [df.index.name] + df.columns.tolist(), header)
+    values = df.to_numpy(dtype=object,copy=True) #Copy, for a df of one dtype to_numpy can return a read-only view
+    values[df.isna().to_numpy()] = None #Missing data is left blank
+    for i, (index, row) in enumerate(zip(df.index.tolist(), values.tolist())):
+        worksheet.write(i + 1, 0, index, header)
+        worksheet.write_row(i + 1, 1, row)
+    workbook.close()
+
+def export_results(df, name, output_formats=('xlsx',)):
+    #Export results to Excel, and optionally to parquet and csv files with the same name. Excel files are always saved, they are used by the GDHI.
+    for output_format in ['xlsx'] + [output_format for output_format in output_formats if output_format != 'xlsx']:
+        if output_format == 'xlsx':
+            write_excel(df, name + '.xlsx')
+        elif output_format == 'parquet':
+            df.to_parquet(name + '.parquet') #Requires pyarrow
+        elif output_format == 'csv':
+            df.to_csv(name + '.csv')
+
+def merge_results(previous, current, columns):
+    #Replace the recalculated columns in the results from the last run with the new results. Columns for a year not in the last run are added at the end.
+    merged = previous.reindex(previous.index.union(current.index, sort=False))
+    for col in columns:
+        merged[col] = current[col]
+    return merged
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+What-if crop production estimates for the GDHI - the estimate a unit would get if the final WRSI for the season came in at a given value.
+
+    python gdhi.py curves <wrsi_folder> [--wrsi_table <folder>]
+    python gdhi.py whatif <wrsi_folder> <queries.csv> [--output <results.csv>]
+
+The curves command calculates a response curve for each FNID, season, and crop: the crop production estimate for every whole WRSI value from 0 to 100.
+Curves are calculated with the same functions as the estimate scripts, by passing a WRSI table where each column is one WRSI value instead of one year.
+Somalia and Kenya curves use quantile mapping against the frozen 2001 - 2015 rank baseline, Ethiopia curves use linear scaling, and fallback logic is
+applied in the same way as the estimates. Uganda is not included as the Uganda estimate is the WRSI value.
+
+The percent rank of a WRSI value only changes at the 2001 - 2015 WRSI values of the unit, so the Somalia and Kenya estimates are step functions of
+WRSI. For these curves the estimate is also calculated at each baseline WRSI value of the unit (in any product) and at one value between each pair of
+baseline values, and the whatif command takes the estimate from the step the WRSI falls on, which is the same as the estimate scripts for any WRSI value.
+Ethiopia estimates are linear between whole WRSI values, so WRSI values between two whole numbers are interpolated between the two points on the curve.
+
+Curves are saved to GDHI_Estimates/response_curves inside the WRSI folder, as one float32 array (curves x 101 WRSI values), the steps of the Somalia and
+Kenya curves, and a table with the FNID, season, and crop of each curve. The whatif command reads a csv file with fnid, season, crop, and wrsi columns,
+and looks up the estimate for every row at once. Seasons are named as in the estimate scripts: Gu / Deyr (Somalia), L / S (Kenya), and Meher / Belg
+(Ethiopia). WRSI values are rounded to float32, the same as the WRSI snapshot. Curves are recalculated if the WRSI data or crop production data have changed.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import gdhi_calc
+import gdhi_io
+import WRSI_Crop_Est_ET as et_est
+import WRSI_Crop_Est_UGSOKE as ugsoke_est
+
+curves_folder = 'response_curves' #Folder inside GDHI_Estimates where curves are saved
+wrsi_grid = list(range(101)) #WRSI values on each curve, passed to the estimate functions in place of the list of years
+grid_cols = ['WRSI_' + str(wrsi) for wrsi in wrsi_grid]
+step_arrays = ['breaks','at','between'] #Arrays saved for the step curves, see step_curves
+
+def grid_wrsi_data(WRSI_data):
+    #WRSI data with a WRSI_0 - WRSI_100 column for each WRSI value, instead of one column per year. Every unit has the same value in each column.
+    grid = {}
+    for product, df in WRSI_data.items():
+        attributes = df[[col for col in df.columns if not col.startswith('WRSI_')]]
+        values = np.broadcast_to(np.array(wrsi_grid,dtype='float32'),(len(df),len(wrsi_grid)))
+        grid[product] = pd.concat([attributes,pd.DataFrame(values,index=df.index,columns=grid_cols)],axis=1)
+    return grid
+
+def get_breaks(WRSI_data):
+    #2001 - 2015 WRSI values of each Kenya / Somalia unit in all products, sorted with duplicates removed and padded with NaN (units x most values in a unit).
+    #The percent rank of a WRSI value relative to the baseline only changes at these values.
+    fnids = ugsoke_est.get_fnids(WRSI_data)
+    fnids = fnids.index[fnids['ADMIN0'].isin(['Kenya','Somalia'])]
+    values = np.sort(np.concatenate([df.reindex(fnids)[ugsoke_est.baseline_cols].to_numpy(dtype=float) for df in WRSI_data.values()],axis=1),axis=1)
+    values[:,1:][values[:,1:] == values[:,:-1]] = np.nan #Remove duplicates, NaNs are sorted to the end of each row below
+    values = np.sort(values,axis=1)
+    return pd.DataFrame(values[:,:int((~np.isnan(values)).sum(axis=1).max(initial=0))],index=fnids)
+
+def step_points(breaks):
+    #WRSI values the Kenya / Somalia estimates are calculated at, one value below the first break, between each pair of breaks, and above the last break
+    #(units x breaks + 1), followed by the breaks (units x breaks). The estimate is the same for any WRSI value between two breaks.
+    breaks = breaks.to_numpy(dtype=float)
+    lower = np.concatenate([np.full((len(breaks),1),-np.inf),breaks],axis=1)
+    upper = np.concatenate([breaks,np.full((len(breaks),1),np.nan)],axis=1)
+    between = np.where(np.isnan(upper),lower + 1,(lower + upper) / 2) #Padding stays NaN
+    between = np.where(np.isneginf(lower),np.where(np.isnan(upper),50,upper - 1),between) #Units without baseline WRSI have one step
+    return np.concatenate([between,breaks],axis=1)
+
+def point_rank(WRSI_data, points):
+    #Percent rank of WRSI values relative to the 2001 - 2015 WRSI of each Kenya / Somalia unit, same as the percent rank of a year after 2015 in
+    #ugsoke_est.wrsi_rank. points is a df of WRSI values for each unit (one column for each value), returned in the same format as wrsi_rank with a WRSI_i
+    #column for column i of points.
+    fnids = ugsoke_est.get_fnids(WRSI_data)
+    point_cols = ['WRSI_' + str(i) for i in range(points.shape[1])]
+    df_WRSI_percentile = {}
+    for product, df in WRSI_data.items():
+        df = df[df['ADMIN0'].isin(['Kenya','Somalia'])]
+        index = gdhi_calc.rank_index(df[ugsoke_est.baseline_cols].to_numpy(dtype=float))
+        pct = index.percent_rank(points.reindex(df.index).to_numpy(dtype=float))
+        df_WRSI_percentile[product] = fnids.merge(pd.DataFrame(pct,index=df.index,columns=point_cols),left_index=True,right_index=True)
+    return df_WRSI_percentile
+
+def step_lookup(breaks, at, between, wrsi):
+    #Estimates from step curves, breaks are the sorted breaks of each curve (NaN padded), at the estimate at each break, and between the estimate below the
+    #first break, between each pair of breaks, and above the last break. wrsi is a 2D array (curves x WRSI values).
+    breaks = np.asarray(breaks,dtype=float)[:,np.newaxis,:]
+    wrsi = np.asarray(wrsi,dtype=float)[:,:,np.newaxis]
+    position = (breaks < wrsi).sum(axis=2) #Number of breaks below the WRSI value, NaN padding is never below
+    estimate = np.take_along_axis(np.asarray(between,dtype=float),position,axis=1)
+    if breaks.shape[2]:
+        on_break = (breaks == wrsi).any(axis=2)
+        at_est = np.take_along_axis(np.asarray(at,dtype=float),np.minimum(position,breaks.shape[2] - 1),axis=1)
+        estimate = np.where(on_break,at_est,estimate)
+    return estimate
+
+def step_curves(results, country, season, crops, breaks):
+    #Step curves for each FNID and crop from a df of results calculated at the step_points of each unit, with a p{i}_{crop} column for each point.
+    #Returns the keys, the curves at each whole WRSI value, and the breaks, estimate at each break, and estimate between breaks of each curve.
+    #Units without an estimate for any WRSI value are left out.
+    n_breaks = breaks.shape[1]
+    unit_breaks = breaks.reindex(results.index).to_numpy(dtype=float)
+    keys = []
+    curves = []
+    for crop in crops:
+        values = results[['p' + str(i) + '_' + crop for i in range(2 * n_breaks + 1)]].to_numpy(dtype=float)
+        has_curve = ~np.isnan(values).all(axis=1)
+        steps = {'breaks': unit_breaks[has_curve], 'at': values[has_curve,n_breaks + 1:], 'between': values[has_curve,:n_breaks + 1]}
+        grid = np.broadcast_to(np.array(wrsi_grid,dtype=float),(int(has_curve.sum()),len(wrsi_grid)))
+        keys.append(pd.DataFrame({'country':country,'fnid':results.index[has_curve],'season':season,'crop':crop}))
+        curves.append((step_lookup(steps['breaks'],steps['at'],steps['between'],grid).astype('float32'),steps))
+    return keys, curves
+
+def stack_curves(results, country, season, crops, column, n_breaks):
+    #Curves for each FNID and crop from a df of results with one column per crop and WRSI value, column is the format of the column names (i.e: '{crop}_p{wrsi}').
+    #Curves are not step curves, so the step arrays are NaN. Units without an estimate for any WRSI value are left out.
+    keys = []
+    curves = []
+    for crop in crops:
+        values = results[[column.format(wrsi=wrsi,crop=crop) for wrsi in wrsi_grid]].to_numpy(dtype='float32')
+        has_curve = ~np.isnan(values).all(axis=1)
+        rows = int(has_curve.sum())
+        steps = {'breaks': np.full((rows,n_breaks),np.nan), 'at': np.full((rows,n_breaks),np.nan), 'between': np.full((rows,n_breaks + 1),np.nan)}
+        keys.append(pd.DataFrame({'country':country,'fnid':results.index[has_curve],'season':season,'crop':crop}))
+        curves.append((values[has_curve],steps))
+    return keys, curves
+
+def build_curves(WRSI_data, admin1_units):
+    #Calculate curves for Somalia, Kenya and Ethiopia, returns a df with the country, FNID, season and crop of each curve, a 2D array of the curves,
+    #and a dictionary with the step arrays of the curves (NaN for the Ethiopia curves)
+    print('Calculate what-if response curves for WRSI values 0 - 100')
+    breaks = get_breaks(WRSI_data)
+    points = step_points(breaks)
+    df_WRSI_percentile = point_rank(WRSI_data,pd.DataFrame(points,index=breaks.index))
+    point_years = list(range(points.shape[1])) #Passed to the estimate functions in place of the list of years
+    so_results = ugsoke_est.estimate_so(WRSI_data,df_WRSI_percentile,point_years,'vectorized') #Includes fallback logic
+    ke_results = ugsoke_est.estimate_ke(df_WRSI_percentile,point_years,'vectorized',admin1_units)
+    et_results = et_est.estimate_et(grid_wrsi_data(WRSI_data),wrsi_grid)
+    keys = []
+    curves = []
+    for season, results in so_results.items():
+        season_keys, season_curves = step_curves(results,'SO',season,ugsoke_est.so_crops,breaks)
+        keys, curves = keys + season_keys, curves + season_curves
+    for season, results in ke_results.items():
+        season_keys, season_curves = step_curves(results,'KE',season,['Maize','Sorghum'],breaks) #No Cowpeas production in Kenya
+        keys, curves = keys + season_keys, curves + season_curves
+    for season, results in et_results.items():
+        crop_cols = [crop + '_p' + str(wrsi) for wrsi in wrsi_grid for crop in et_est.et_crops]
+        values = results[crop_cols].to_numpy(dtype=float).reshape(len(results),len(wrsi_grid),len(et_est.et_crops)) #units x WRSI values x crops
+        results[crop_cols] = gdhi_calc.crop_fallback(values,et_est.et_crops,et_est.et_fallbacks).reshape(len(results),-1) #Same fallback logic as the ET estimates
+        season_keys, season_curves = stack_curves(results,'ET',season,et_est.et_crops,'{crop}_p{wrsi}',breaks.shape[1])
+        keys, curves = keys + season_keys, curves + season_curves
+    steps = {name: np.concatenate([curve_steps[name] for values, curve_steps in curves]) for name in step_arrays}
+    return pd.concat(keys,ignore_index=True), np.concatenate([values for values, curve_steps in curves]), steps
+
+def get_inputs(wrsi_source, admin1_units):
+    #WRSI and crop production files the curves are calculated from, saved with the curves to check if they are up to date
+    return {'wrsi': gdhi_io.get_snapshot_inputs(wrsi_source)[1], 'crop': ugsoke_est.get_crop_inputs() + et_est.get_crop_inputs(), 'ke_admin1': admin1_units}
+
+def save_curves(wrsi_folder, keys, curves, steps, inputs):
+    folder = os.path.join(wrsi_folder,gdhi_io.results_folder,curves_folder)
+    os.makedirs(folder,exist_ok=True)
+    manifest_path = os.path.join(folder,'manifest.json')
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path) #Curves are saved before the keys, remove manifest first so a partly written set of curves is never used
+    np.save(os.path.join(folder,'curves.npy'),curves)
+    for name in step_arrays:
+        np.save(os.path.join(folder,'steps_' + name + '.npy'),steps[name])
+    gdhi_io.save_columnar(keys,folder,inputs) #Manifest written last
+
+def load_curves(wrsi_folder, inputs=None):
+    #Read saved curves, the curves and step arrays are memory mapped. Returns None if there are no saved curves, the inputs have changed, or the curves
+    #were saved without steps by an earlier version.
+    folder = os.path.join(wrsi_folder,gdhi_io.results_folder,curves_folder)
+    keys = gdhi_io.load_columnar(folder,inputs)
+    if keys is None or not all(os.path.exists(os.path.join(folder,'steps_' + name + '.npy')) for name in step_arrays):
+        return None
+    steps = {name: np.load(os.path.join(folder,'steps_' + name + '.npy'),mmap_mode='r') for name in step_arrays}
+    return keys, np.load(os.path.join(folder,'curves.npy'),mmap_mode='r'), steps
+
+def get_curves(wrsi_folder, wrsi_table, admin1_units, rebuild=False):
+    #Load curves if they are up to date, otherwise calculate and save them
+    wrsi_source = gdhi_io.get_wrsi_source(wrsi_folder,wrsi_table)
+    WRSI_data = gdhi_io.get_wrsi_data(wrsi_source) #Creates the WRSI snapshot if it is missing, so the inputs below match the snapshot
+    inputs = get_inputs(wrsi_source,admin1_units)
+    saved = None if rebuild else load_curves(wrsi_folder,inputs)
+    if saved is not None:
+        return saved
+    keys, curves, steps = build_curves(WRSI_data,admin1_units)
+    save_curves(wrsi_folder,keys,curves,steps,inputs)
+    print(str(len(keys)) + ' response curves saved to ' + os.path.join(wrsi_folder,gdhi_io.results_folder,curves_folder))
+    return keys, curves, steps
+
+def lookup(keys, curves, steps, queries):
+    #Estimates for a batch of hypothetical WRSI values. queries is a df with fnid, season, crop, and wrsi columns, returns the estimate for each row (NaN if there
+    #is no curve for the FNID, season, and crop, or WRSI is missing). WRSI is limited to 0 - 100. Somalia and Kenya estimates are taken from the step curves,
+    #Ethiopia estimates between whole numbers are interpolated.
+    rows = pd.MultiIndex.from_frame(keys[['fnid','season','crop']].astype(str)).get_indexer(pd.MultiIndex.from_frame(queries[['fnid','season','crop']].astype(str)))
+    wrsi = np.clip(queries['wrsi'].to_numpy(dtype='float32'),0,100).astype(float) #Rounded to float32 like the WRSI snapshot
+    lower = np.nan_to_num(np.floor(wrsi)).astype(np.intp)
+    upper = np.minimum(lower + 1,100)
+    found = np.where(rows >= 0,rows,0)
+    lower_est = np.asarray(curves[found,lower],dtype=float)
+    upper_est = np.asarray(curves[found,upper],dtype=float)
+    estimate = lower_est + (upper_est - lower_est) * (wrsi - lower)
+    step = np.asarray(keys['country'].isin(['SO','KE']))[found]
+    estimate[step] = step_lookup(steps['breaks'][found[step]],steps['at'][found[step]],steps['between'][found[step]],wrsi[step,np.newaxis])[:,0]
+    estimate[(rows < 0) | np.isnan(wrsi)] = np.nan
+    return estimate
+
+def whatif(wrsi_folder, wrsi_table, admin1_units, queries_path, output=None):
+    keys, curves, steps = get_curves(wrsi_folder,wrsi_table,admin1_units)
+    queries = pd.read_csv(queries_path,dtype={'fnid':str,'season':str,'crop':str})
+    queries['estimate'] = lookup(keys,curves,steps,queries)
+    print(str(len(queries)) + ' what-if estimates, ' + str(int(queries['estimate'].isna().sum())) + ' without a response curve')
+    if output:
+        queries.to_csv(output,index=False)
+    else:
+        print(queries.to_string(index=False))
+    return queries
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Watch mode for WRSI_Download_CHIRPS.py - poll the USGS website (or a local mirror with the same layout) for new WRSI zip files and process them as they
+are published, instead of starting WRSI_Download_CHIRPS.py by hand for each new dekad.
+
+Each poll lists the zip files of the selected products at the source (see gdhi_download.list_source), and the files from the start dekad onwards which
+are not in the ledger are downloaded and processed in one batch, in date order. Files which were downloaded and processed are added to the ledger
+(GDHI_watch_ledger.json in the WRSI folder) after the batch is written to the WRSI tables, so when the watch is stopped and started again files already
+processed are not downloaded or processed again. Files which fail to download are not added to the ledger and are tried again on the next poll.
+
+Files which are downloaded but can not be processed (i.e: a corrupt zip file) are left out of the batch, the other files in the batch are still written
+to the WRSI tables. The failed file is added to the ledger with status failed and the error, so it is not tried again on every poll.
+
+A file is only processed once, to process a file again (i.e: if USGS publishes an updated version of a dekad, or a failed file is fixed) remove it
+from the ledger.
+"""
+
+import os
+import json
+import time
+import requests
+import gdhi_download
+
+ledger_name = 'GDHI_watch_ledger.json' #Saved in the WRSI folder
+
+def read_ledger(wrsi_folder):
+    path = os.path.join(wrsi_folder,ledger_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_ledger(wrsi_folder, ledger):
+    #Written to a temporary file and renamed, so stopping the watch never leaves a partly written ledger
+    path = os.path.join(wrsi_folder,ledger_name)
+    with open(path + '.tmp','w') as f:
+        json.dump(ledger,f,indent=1)
+    os.replace(path + '.tmp',path)
+
+def new_files(session, source, products, start, ledger):
+    #product_year_month_dekad strings for the files at the source from start (year_month_dekad) onwards which are not in the ledger, in date order
+    first = tuple(int(x) for x in start.split('_'))
+    files = []
+    for product in products:
+        for zipfilename in gdhi_download.list_source(session,source,product):
+            file_download = gdhi_download.parse_zip_name(zipfilename)
+            if zipfilename not in ledger and gdhi_download.parse_file(file_download)[1:] >= first:
+                files.append(file_download)
+    return sorted(files,key=lambda file_download: (gdhi_download.parse_file(file_download)[1:], products.index(file_download[:2])))
+
+def update_ledger(wrsi_folder, ledger, statuses, errors):
+    #Add the files which were downloaded (or already in the download folder) and processed to the ledger, and the files which could not be processed
+    #with status failed and the error
+    processed = time.strftime('%Y-%m-%d %H:%M:%S')
+    for file_download, status in statuses.items():
+        zipfilename = gdhi_download.zip_name(*gdhi_download.parse_file(file_download))
+        if file_download in errors:
+            ledger[zipfilename] = {'file': file_download, 'processed': processed, 'status': 'failed', 'error': errors[file_download]}
+        elif status in ('downloaded','skipped'):
+            ledger[zipfilename] = {'file': file_download, 'processed': processed, 'status': 'processed'}
+    save_ledger(wrsi_folder,ledger)
+
+def count_failed(ledger):
+    return sum(1 for entry in ledger.values() if entry.get('status') == 'failed')
+
+def watch(wrsi_folder, source, products, start, poll_seconds, process):
+    #Poll the source for new files every poll_seconds until the watch is stopped (Ctrl+C). process is called with the list of new files, downloads and
+    #processes them, and returns the status of each file (see gdhi_download.download_files) and the error for each file which could not be processed.
+    ledger = read_ledger(wrsi_folder)
+    print('Watching ' + source + ' for new ' + ', '.join(products) + ' files from ' + start + ', ' + str(len(ledger) - count_failed(ledger)) + ' files already processed, ' +
+          str(count_failed(ledger)) + ' failed (remove from ' + ledger_name + ' to try again)')
+    with requests.Session() as session:
+        try:
+            while True:
+                try:
+                    files = new_files(session,source,products,start,ledger)
+                    if files:
+                        print('New files: ' + ', '.join(files))
+                        update_ledger(wrsi_folder,ledger,*process(files))
+                    else:
+                        print('No new files at ' + time.strftime('%Y-%m-%d %H:%M:%S'))
+                except (requests.RequestException, IOError) as error: #Source not available or a file could not be read, tried again on the next poll
+                    print('Watch poll failed (' + str(error) + '), try again in ' + str(poll_seconds) + ' seconds')
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            print('Watch stopped, ' + str(len(ledger) - count_failed(ledger)) + ' files processed, ' + str(count_failed(ledger)) + ' failed')
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Zonal statistics (mean WRSI of each FNID) for the WRSI rasters downloaded by WRSI_Download_CHIRPS.py, without arcpy or the Spatial Analyst extension.
+
+The EA_GDHI_Admin_Units polygons are rasterized once onto the grid of the WRSI rasters, a cell belongs to the polygon containing the centre of the cell
+(same as ZonalStatisticsAsTable). The label array (0 = outside the admin units, i = the i-th FNID) is split into windows, one window for the bounding box
+of the admin units in each country (one window for all admin units if it is smaller), and saved to GDHI_Admin_Units_labels in the WRSI folder with one folder for each grid (transform, shape, and
+projection). Where windows overlap the cells are only labelled in the first window, so each cell is counted once. Later runs memory map the saved label
+windows, and the mean of each FNID is calculated with np.bincount over the cells of each window. Run with rebuild=True (--rebuild_labels) if the admin
+unit polygons are changed.
+
+The WRSI raster is read straight from the zip file downloaded from USGS, without extracting it to disk, and only the windows covering the admin units
+are read into memory (the GDHI only covers parts of the East Africa raster). The windows read from each raster are saved to a compressed archive
+(GDHI_WRSI_Clipped in the WRSI folder, one .npz file for each zip file) with the size and SHA-256 hash of the zip file, and the archive is read instead
+of the raster when the same file is processed again. The archive is not used if the zip file has changed since the archive was saved (i.e: an updated
+file was downloaded), and is used on its own if the zip file no longer exists, so a dekad can be processed again without the original download. The
+raster is always read when the admin units are rasterized again (rebuild_labels).
+
+The reclass rules from reclass_raster are applied to the array: no start (253) cells count as 0, yet to start (254) and NoData cells are left out.
+
+Requires rasterio to read the WRSI rasters, and geopandas to read the admin unit polygons when the label array is created.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features
+from affine import Affine
+from rasterio.windows import Window
+import gdhi_io
+
+labels_folder = 'GDHI_Admin_Units_labels' #Folder inside the WRSI folder where the label arrays are saved
+clip_folder = 'GDHI_WRSI_Clipped' #Folder inside the WRSI folder where the windows read from each WRSI raster are saved
+no_start = 253 #Season has not started, counted as a WRSI of 0
+yet_to_start = 254 #Season is yet to start, left out of the mean
+labels_lock = threading.Lock() #Zonal stats can run for several rasters at the same time, the label arrays are only created by one
+
+def get_grid(dataset):
+    #Grid of a raster opened with rasterio, label arrays are saved for each grid
+    return {'transform': list(dataset.transform)[:6], 'shape': [dataset.height, dataset.width], 'crs': dataset.crs.to_wkt() if dataset.crs else None}
+
+def get_grid_key(grid):
+    return hashlib.sha256(json.dumps(grid).encode()).hexdigest()[:16]
+
+def read_admin_units(wrsi_folder):
+    import geopandas #geopandas is only needed when the label array is created
+    return geopandas.read_file(os.path.join(wrsi_folder,'GDHI_Admin_Units.gdb'),layer='EA_GDHI_Admin_Units',columns=['FNID'])
+
+def rasterize_units(units, grid):
+    #Label array for the grid, value of each cell is the position of the admin unit + 1 (0 for cells outside the admin units)
+    if grid['crs'] and units.crs:
+        units = units.to_crs(grid['crs'])
+    shapes = zip(units.geometry,range(1,len(units) + 1))
+    return rasterio.features.rasterize(shapes,out_shape=tuple(grid['shape']),transform=Affine(*grid['transform']),fill=0,dtype='int32')
+
+def get_window(mask):
+    #Window of the grid (row_off, col_off, height, width) covering all cells in a mask
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return [int(rows[0]),int(cols[0]),int(rows[-1] - rows[0] + 1),int(cols[-1] - cols[0] + 1)]
+
+def split_windows(labels, groups):
+    #Split the label array into the bounding window of the admin units in each group (i.e: country). groups is the group of each admin unit.
+    #Returns the windows and the label array of each window, cells already in an earlier window are set to 0. If the windows cover more cells than the
+    #bounding window of all admin units, the bounding window is used instead.
+    windows = []
+    window_labels = []
+    covered = np.zeros(labels.shape,dtype=bool)
+    unit_groups = np.concatenate([[''],np.asarray(groups,dtype=object)])[labels] #Group of each cell, '' outside the admin units
+    for group in pd.unique(np.asarray(groups,dtype=object)):
+        window = get_window(unit_groups == group)
+        if window is None:
+            continue
+        rows = slice(window[0],window[0] + window[2])
+        cols = slice(window[1],window[1] + window[3])
+        windows.append(window)
+        window_labels.append(np.where(covered[rows,cols],0,labels[rows,cols]))
+        covered[rows,cols] = True
+    window = get_window(labels > 0)
+    if window is not None and window[2] * window[3] <= sum(window[2] * window[3] for window in windows): #Country windows overlap, use one window instead
+        return [window], [labels[window[0]:window[0] + window[2],window[1]:window[1] + window[3]]]
+    return windows, window_labels
+
+def get_labels(wrsi_folder, grid, rebuild=False):
+    #Load the windows, label array for each window, and FNIDs for the grid. Label arrays are memory mapped.
+    #Created from the admin unit polygons and saved if they do not exist.
+    with labels_lock:
+        return load_labels(wrsi_folder,grid,rebuild)
+
+def load_labels(wrsi_folder, grid, rebuild=False):
+    folder = os.path.join(wrsi_folder,labels_folder,get_grid_key(grid))
+    fnids = None if rebuild else gdhi_io.load_columnar(folder,grid)
+    if fnids is not None and os.path.exists(os.path.join(folder,'windows.json')):
+        with open(os.path.join(folder,'windows.json')) as f:
+            windows = json.load(f)
+        return windows, [np.load(os.path.join(folder,'labels_' + str(i) + '.npy'),mmap_mode='r') for i in range(len(windows))], fnids.index
+    print('Rasterize admin units for zonal statistics\n',end='') #One write, zonal stats can run in several threads
+    units = read_admin_units(wrsi_folder)
+    windows, window_labels = split_windows(rasterize_units(units,grid),units['FNID'].str[:2]) #FNIDs start with the country code
+    print('Zonal statistics read ' + str(sum(window[2] * window[3] for window in windows)) + ' of ' + str(grid['shape'][0] * grid['shape'][1]) + ' cells of each raster in ' + str(len(windows)) + ' windows\n',end='')
+    fnids = pd.DataFrame({'unit': np.arange(1,len(units) + 1)},index=pd.Index(units['FNID'].to_numpy(dtype=object),name='FNID'))
+    os.makedirs(folder,exist_ok=True)
+    manifest_path = os.path.join(folder,'manifest.json')
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path) #Label arrays are saved before the FNIDs, remove manifest first so partly written label arrays are never used
+    for i, labels in enumerate(window_labels):
+        np.save(os.path.join(folder,'labels_' + str(i) + '.npy'),labels)
+    with open(os.path.join(folder,'windows.json'),'w') as f:
+        json.dump(windows,f)
+    gdhi_io.save_columnar(fnids,folder,grid) #Manifest written last
+    return windows, window_labels, fnids.index
+
+def zonal_sums(wrsi, labels, n_units, nodata=None):
+    #Sum and count of the WRSI cells of each admin unit in a WRSI array and label array with the same shape
+    valid = (labels > 0) & (wrsi != yet_to_start)
+    if nodata is not None:
+        valid &= wrsi != nodata
+    if np.issubdtype(wrsi.dtype,np.floating):
+        valid &= ~np.isnan(wrsi)
+    zones = labels[valid]
+    values = np.where(wrsi[valid] == no_start,0,wrsi[valid]).astype(float)
+    return np.bincount(zones,weights=values,minlength=n_units + 1)[1:], np.bincount(zones,minlength=n_units + 1)[1:]
+
+def zonal_mean(arrays, window_labels, n_units, nodata=None):
+    #Mean WRSI of each admin unit from the WRSI array and label array of each window, NaN for units without any cells with data
+    sums = np.zeros(n_units)
+    counts = np.zeros(n_units,dtype=np.int64)
+    for wrsi, labels in zip(arrays,window_labels):
+        window_sums, window_counts = zonal_sums(wrsi,labels,n_units,nodata)
+        sums += window_sums
+        counts += window_counts
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.where(counts > 0,sums / counts,np.nan)
+
+def zip_member(zipfilename, tiffile):
+    #GDAL path to a file inside a zip file, the file is read from the zip file without extracting it
+    return '/vsizip/' + os.path.abspath(zipfilename).replace('\\','/') + '/' + tiffile
+
+def source_file(path):
+    #File a WRSI raster is read from, the zip file for a file inside a zip file
+    if path.startswith('/vsizip/'):
+        return path[len('/vsizip/'):].rsplit('/',1)[0]
+    return path
+
+def get_archive_path(wrsi_folder, zipfilename):
+    #Compressed archive of the windows read from a WRSI zip file
+    return os.path.join(wrsi_folder,clip_folder,os.path.splitext(os.path.basename(zipfilename))[0] + '.npz')
+
+def get_source(path):
+    #Size and SHA-256 hash of the file a WRSI raster is read from, saved in the archive. None if the file does not exist.
+    path = source_file(path)
+    if not os.path.exists(path):
+        return None
+    return {'size': os.path.getsize(path), 'sha256': gdhi_io.file_hash(path)}
+
+def read_archive(archive, wrsi_folder, source):
+    #Read the windows of a WRSI raster from the compressed archive. Returns None if there is no archive, the windows have changed since it was saved, or
+    #the source file exists and is not the file the archive was saved from. source is None if the source file no longer exists.
+    if archive is None or not os.path.exists(archive):
+        return None
+    with np.load(archive) as saved:
+        if source is not None and json.loads(str(saved['source'])) != source:
+            return None
+        grid = json.loads(str(saved['grid']))
+        windows, window_labels, fnids = get_labels(wrsi_folder,grid)
+        if json.loads(str(saved['windows'])) != windows:
+            return None
+        nodata = float(saved['nodata']) if saved['nodata'].size else None
+        return [saved['window_' + str(i)] for i in range(len(windows))], window_labels, fnids, nodata
+
+def save_archive(archive, source, grid, windows, arrays, nodata):
+    os.makedirs(os.path.dirname(archive),exist_ok=True)
+    with open(archive + '.tmp','wb') as f: #Written to a temporary file and renamed, so a partly written archive is never used
+        np.savez_compressed(f,source=json.dumps(source),grid=json.dumps(grid),windows=json.dumps(windows),nodata=np.array([] if nodata is None else nodata),
+                            **{'window_' + str(i): array for i, array in enumerate(arrays)})
+    os.replace(archive + '.tmp',archive)
+
+def read_wrsi(path, wrsi_folder, rebuild_labels=False, archive=None):
+    #Read the windows of a WRSI raster (tif file or file in a zip file, see zip_member) covering the admin units. Returns the WRSI array and label array of
+    #each window, FNIDs, and NoData value of the raster. If archive is set the windows are read from the archive if it exists, otherwise they are saved to it.
+    source = get_source(path) if archive is not None else None
+    saved = None if rebuild_labels else read_archive(archive,wrsi_folder,source)
+    if saved is not None:
+        return saved
+    with rasterio.open(path) as dataset:
+        grid = get_grid(dataset)
+        windows, window_labels, fnids = get_labels(wrsi_folder,grid,rebuild_labels)
+        arrays = [dataset.read(1,window=Window(window[1],window[0],window[3],window[2])) for window in windows]
+        nodata = dataset.nodata
+    if archive is not None:
+        save_archive(archive,source,grid,windows,arrays,nodata)
+    return arrays, window_labels, fnids, nodata
+
+def zonal_stats(wrsi_folder, path, rebuild_labels=False, archive=None):
+    #Mean WRSI of each FNID for a WRSI raster, same results as ZonalStatisticsAsTable with the MEAN statistic on the reclassed raster.
+    #Returns a Series indexed by FNID, FNIDs without data are left out (same as the DATA option).
+    arrays, window_labels, fnids, nodata = read_wrsi(path,wrsi_folder,rebuild_labels,archive)
+    mean = zonal_mean(arrays,window_labels,len(fnids),nodata)
+    return pd.Series(mean,index=fnids,name='MEAN').dropna()
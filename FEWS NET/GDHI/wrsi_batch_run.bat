@@ -15,6 +15,57 @@ Format for selecting file to run zonal statistics on is EE_YYYY_M_D. EE is the U
 
 Add a : to mark when an analysis is not needed - this will result in command line ignoring that row.
 
+To rebuild the history of one or more products, run one backfill command instead of one command per dekad (downloads run at the same time and files
+already downloaded are skipped, so the command can be run again if it is interrupted):
+"%PYTHON_PATH%" WRSI_Download_CHIRPS.py "%WRSI_FOLDER%" %YEAR% %MONTH% --products ee el --start 2023_3_1 --end 2023_6_3
+
+To process new dekads as soon as USGS publishes them, leave a watch running instead (checks for new files every hour, stop with Ctrl+C). Files already
+processed are listed in GDHI_watch_ledger.json in the WRSI folder and are not processed again when the watch is started again. Each batch of new files
+is saved to the year and month folders of the date it is processed, %YEAR% and %MONTH% are not used by the watch. Files which can not be processed
+(i.e: a corrupt zip file) are listed as failed in the ledger with the error, remove them from the ledger to try them again:
+"%PYTHON_PATH%" WRSI_Download_CHIRPS.py "%WRSI_FOLDER%" %YEAR% %MONTH% --watch --products ee el --start 2023_3_1 --poll_seconds 3600
+
+Zonal statistics are calculated with NumPy and do not need the Spatial Analyst extension (requires rasterio, and geopandas the first time the admin
+units are rasterized). Add --zonal_engine arcpy to use ZonalStatisticsAsTable instead, and --rebuild_labels after changing the admin unit polygons.
+Only the windows of each WRSI raster covering the admin units are read, and they are kept in GDHI_WRSI_Clipped in the WRSI folder (compressed), so a
+dekad can be processed again without reading the full raster.
+
+The WRSI of every dekad processed is also saved to the WRSI cube (GDHI_WRSI_Cube in the WRSI folder). Add --wrsi_table "%WRSI_FOLDER%\GDHI_WRSI_Cube"
+to the crop production estimate commands to read WRSI data from the cube.
+The standing of each dekad compared to the 2001 - 2015 dekadal climatology (anomaly, percent rank, and percentile category for each unit) is saved to
+WRSI_dekad_standing.xlsx in the month folder. The climatology needs a backfill of the 2001 - 2015 dekads (--start 2001_1_1 --end 2016_2_3).
+
+Add --incremental to the end of the crop production estimate commands to only recalculate the current rains year, results for other years are taken
+from the last run (saved in the GDHI_Estimates folder in the WRSI folder). All years are recalculated automatically if crop production data or WRSI data
+for previous years (i.e: after a backfill) has been updated since the last run.
+
+WRSI data is read from a snapshot with the WRSI stored as float32 (see gdhi_io.py), so Ethiopia and Uganda estimates can differ slightly (Ethiopia by up
+to about 0.01) from results exported before the snapshot was added.
+
+The two crop production estimate commands can be replaced with one command which reads the WRSI data once and calculates the estimates for all four
+countries at the same time: "%PYTHON_PATH%" gdhi.py estimate "%WRSI_FOLDER%" %YEAR% %MONTH%
+
+Add --output_formats xlsx csv (or parquet) to also save the results as csv / parquet files next to the Excel files.
+
+Add --workers 4 to WRSI_Crop_Est_ET.py (or --et_workers 4 to gdhi.py estimate) to calculate the Ethiopia region / season / crop combinations in parallel.
+The time taken by each combination is printed.
+
+The columns used from the crop production Excel files are cached in a folder next to each file (i.e: SO_agprod_data_cache) the first time the file is read,
+and the cached copy is used until the file is changed. Add --no_cache to the crop production estimate commands to always read the Excel files.
+
+To answer what-if questions (estimate for a unit if the final WRSI is a given value), list fnid, season, crop, and wrsi in a csv file and run:
+"%PYTHON_PATH%" gdhi.py whatif "%WRSI_FOLDER%" queries.csv --output whatif_results.csv
+Response curves are calculated on the first run and reused until the WRSI or crop production data change.
+
+Add --bootstrap 2000 to WRSI_Crop_Est_UGSOKE.py to also save KESO_bootstrap_bands.xlsx, with 5th, 50th and 95th percentile bands (set with --bands)
+for each Somalia / Kenya estimate from 2000 resamples of the crop production time series.
+
+To compare the quantile mapping and linear scaling methods, run a leave one year out backtest (saves GDHI_backtest_estimates.xlsx and
+GDHI_backtest_metrics.xlsx in the WRSI folder): "%PYTHON_PATH%" gdhi.py backtest "%WRSI_FOLDER%"
+
+After changing the crop production estimate scripts, check that they still run end to end on crop production Excel files in the FDW format (synthetic
+data, does not need ArcGIS): "%PYTHON_PATH%" gdhi_benchmark.py --smoke
+
 :EndComment1
 
 set PYTHON_PATH=C:\Users\bjanocha\AppData\Local\ESRI\conda\envs\arcgispro-py3-clone\python.exe